@@ -2,13 +2,26 @@
 # Python flask server to interact with webGL.
 # Octavio Navarro. 2024
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS, cross_origin
-from randomAgents.model import CityModel
-from randomAgents.agent import *
-
-from mesa.visualization import Slider, SolaraViz, make_space_component
-from mesa.visualization.components import AgentPortrayalStyle
+from randomAgents.model import REPORT_URL
+from randomAgents.city_map import DEFAULT_MAP, available_maps
+from randomAgents.spawn_queue import ADMISSION_POLICIES
+from randomAgents.heatmap import HEATMAP_LAYERS
+from randomAgents.agent import Borrachito, Traffic_Light
+import static_cache
+from randomAgents.packing import pack_state, pack_records, FLAG_BORRACHITO, FLAG_CRASHED
+from randomAgents.recorder import TrajectoryReader
+from randomAgents.snapshot import snapshot_model, restore_model, fork_model
+from ticker import Broadcaster, Ticker
+from model_pool import ModelPool
+from profiler import Profile, Sampler, SCOPES, DEFAULT_INTERVAL, MAX_DURATION
+import threading
+import time
+import argparse
+import atexit
+import os
+import uuid
 
 # Size of the board:
 number_agents = 10
@@ -16,6 +29,28 @@ width = 28
 height = 28
 randomModel = None
 currentStep = 0
+# City map used when /init does not ask for one (see --map)
+defaultMap = DEFAULT_MAP
+# Step timing metrics of the models, served by /metrics (see --no-metrics)
+instrumentModels = True
+
+# Replay mode: the state comes from a recording instead of a model (see --replay)
+replay = None
+# Directory where every model created by /init is recorded, each one in its own
+# run_<n> subdirectory (see --record)
+recordPath = None
+
+# Pre-built models handed out by /init (see --pool-size and --warmup)
+modelPool = ModelPool(size=1)
+
+# Models created by /fork, selected with ?session=<id>, and snapshots taken with /snapshot
+sessions = {}
+snapshots = {}
+
+# The model can be stepped by /update and by the ticker thread at the same time
+modelLock = threading.RLock()
+broadcaster = Broadcaster()
+ticker = Ticker(lambda: randomModel, modelLock, broadcaster)
 
 # This application will be used to interact with WebGL
 app = Flask("Traffic example")
@@ -28,76 +63,196 @@ cors = CORS(app, origins=['http://localhost'])
 def initModel():
     global currentStep, randomModel, number_agents
 
+    if replay is not None:
+        currentStep = replay.first_step
+        return jsonify({"message": f"Replay restarted.\nSteps recorded: {replay.steps}"})
+
+    # Optional parameters: seed, spawnRate (steps between spawns), warmup (steps simulated before starting)
+    # map (name of a city map, see /getMaps), demand (vehicles per step at each spawn gate, instead of
+    # spawnRate) and admission (what to do with vehicles that cannot enter: "queue" or "drop")
+    config = {
+        "N": number_agents, "seed": 42, "spawn_of_cars": 5, "warmup_steps": 0, "map_name": defaultMap,
+        "spawn_demand": None, "admission": "queue", "instrument": instrumentModels,
+    }
+
     if request.method == 'POST':
         try:
-            number_agents = int(request.json.get('N', 10))
+            data = request.json
+            number_agents = int(data.get('N', 10))
+            config = {
+                "N": number_agents,
+                "seed": int(data.get('seed', 42)),
+                "spawn_of_cars": int(data.get('spawnRate', 5)),
+                "warmup_steps": int(data.get('warmup', 0)),
+                "map_name": str(data.get('map', defaultMap)),
+                "spawn_demand": float(data['demand']) if data.get('demand') is not None else None,
+                "admission": str(data.get('admission', 'queue')),
+                "instrument": instrumentModels,
+            }
             currentStep = 0
         except Exception as e:
             print(e)
             return jsonify({"message": "Error initializing the model"}), 500
 
+        if config["map_name"] not in available_maps():
+            return jsonify({"message": f"Unknown map {config['map_name']}", "maps": available_maps()}), 400
+        if config["admission"] not in ADMISSION_POLICIES:
+            return jsonify({"message": f"admission must be one of {', '.join(ADMISSION_POLICIES)}"}), 400
+
     # Reset current step
     currentStep = 0
 
-    print(f"[SERVER] Init params: N={number_agents}")
+    print(f"[SERVER] Init params: {config}")
     print(f"[SERVER] State reset: step={currentStep}")
 
-    # Create the model using the parameters sent by the application
-    randomModel = CityModel(N=number_agents)
+    # Take a model from the pool (or build it if the pool has none for these parameters)
+    model, pooled = modelPool.get(**config)
 
-    print(f"[SERVER] Init complete")
+    with modelLock:
+        if randomModel is not None:
+            randomModel.stop_recording()
+        randomModel = model
+        currentStep = model.current_step
+        if recordPath:
+            startRecording(randomModel)
+        broadcaster.reset()
+
+    print(f"[SERVER] Init complete (pooled: {pooled})")
     print(f"[SERVER] System ready")
 
     # Return a message to saying that the model was created successfully
-    return jsonify({"message": f"Parameters received, model initiated.\nNumber of agents: {number_agents}"})
-
+    return jsonify({
+        "message": f"Parameters received, model initiated.\nNumber of agents: {number_agents}",
+        "map": model.map_name,
+        "currentStep": currentStep,
+        "pooled": pooled
+    })
+
+
+def startRecording(model):
+    """Records a model in the next free run_<n> subdirectory of recordPath."""
+    os.makedirs(recordPath, exist_ok=True)
+    runs = [name for name in os.listdir(recordPath) if name.startswith("run_") and name[4:].isdigit()]
+    path = os.path.join(recordPath, f"run_{max((int(name[4:]) for name in runs), default=0) + 1:04d}")
+    model.start_recording(path)
+    print(f"[SERVER] Recording to {path}")
+
+def stopRecording():
+    """Writes the pending steps of the main model's recording (at shutdown)."""
+    with modelLock:
+        if randomModel is not None:
+            randomModel.stop_recording()
+
+def getModel():
+    """Model of the session given with ?session=<id> (created by /fork), or the main model."""
+    session = request.args.get('session')
+    if session is None:
+        return randomModel
+    return sessions[session]
+
+# Requests for a session that does not exist (never created, or deleted) get a 404
+# before reaching the routes, so getModel can assume the session exists.
+@app.before_request
+def checkSession():
+    session = request.args.get('session')
+    if session is not None and session not in sessions:
+        return jsonify({"message": f"No session {session}"}), 404
+
+def vehiclePosition(a):
+    """
+    Serializes a vehicle for WebGL.
+    The y coordinate is set to 1, since the agents are in a 3D world. The z coordinate corresponds to the row (y coordinate) of the grid in mesa.
+    """
+    coordinate = a.cell.coordinate
+    return {
+        "id": str(a.unique_id),
+        "x": coordinate[0],
+        "y":1,
+        "z":coordinate[1],
+        "type": "Borrachito" if isinstance(a, Borrachito) else "Car",
+        "crashed": getattr(a, 'crashed', False),
+        "crash_timer": getattr(a, 'crash_timer', 0)
+    }
+
+def replayStep():
+    """Step requested with ?step=, or the current step of the replay."""
+    step = request.args.get('step', default=currentStep, type=int)
+    return min(max(step, replay.first_step), replay.last_step)
+
+def replayAgents(step):
+    """Vehicle positions of a recorded step, with the same fields as vehiclePosition."""
+    records = replay.vehicles(step)
+    return [
+        {
+            "id": str(i),
+            "x": x,
+            "y": 1,
+            "z": z,
+            "type": "Borrachito" if flags & FLAG_BORRACHITO else "Car",
+            "crashed": bool(flags & FLAG_CRASHED),
+            "crash_timer": timer
+        }
+        for i, x, z, flags, timer in zip(
+            records["id"].tolist(), records["x"].tolist(), records["z"].tolist(),
+            records["flags"].tolist(), records["crash_timer"].tolist()
+        )
+    ]
+
+def staticPayload(layer):
+    """Cached payload of a static layer, from the model or from the recording."""
+    if replay is not None:
+        return static_cache.cached_payload((replay.map_digest, layer), lambda: replay.static_layer(layer))
+    return static_cache.get_payload(getModel(), layer)
 
 # This route will be used to get the positions of the agents
+# With ?since=<step> only the vehicles that changed after that step are sent, plus the ids of
+# the vehicles that arrived. If the step is too old a full snapshot is sent instead ("full": true).
 @app.route('/getAgents', methods=['GET'])
 @cross_origin()
 def getAgents():
     global randomModel
 
     if request.method == 'GET':
-        # Get the positions of the agents and return them to WebGL in JSON.json.t.
-        # Note that the positions are sent as a list of dictionaries, where each dictionary has the id and position of an agent.
-        # The y coordinate is set to 1, since the agents are in a 3D world. The z coordinate corresponds to the row (y coordinate) of the grid in mesa.
         try:
-            from randomAgents.agent import Borrachito
-
-            agentCells = randomModel.grid.all_cells.select(
-                lambda cell: any(isinstance(obj, (Car, Borrachito)) for obj in cell.agents)
-            ).cells
-            # print(f"CELLS: {agentCells}")
-
-            agents = [
-                (cell.coordinate, agent)
-                for cell in agentCells
-                for agent in cell.agents
-                if isinstance(agent, (Car, Borrachito))
-            ]
-            # print(f"AGENTS: {agents}")
-
-            agentPositions = [
-                {
-                    "id": str(a.unique_id),
-                    "x": coordinate[0],
-                    "y":1,
-                    "z":coordinate[1],
-                    "type": "Borrachito" if isinstance(a, Borrachito) else "Car",
-                    "crashed": getattr(a, 'crashed', False),
-                    "crash_timer": getattr(a, 'crash_timer', 0)
-                }
-                for (coordinate, a) in agents
-            ]
-            # print(f"AGENT POSITIONS: {agentPositions}")
-
-            return jsonify({'positions': agentPositions})
+            if replay is not None:
+                step = replayStep()
+                return jsonify({'positions': replayAgents(step), 'removed': [], 'step': step, 'full': True})
+
+            # The lock keeps the step and the change log consistent while another request steps the model
+            with modelLock:
+                model = getModel()
+                since = request.args.get('since', type=int)
+                changes = None
+                if since is not None:
+                    changes = model.vehicle_changes.changes_since(since)
+
+                if changes is None:
+                    agentPositions = [vehiclePosition(a) for a in model.vehicles()]
+                    return jsonify({
+                        'positions': agentPositions,
+                        'removed': [],
+                        'step': model.current_step,
+                        'full': True
+                    })
+
+                changed, removed = changes
+                agentPositions = [
+                    vehiclePosition(a) for a in model.vehicles() if a.unique_id in changed
+                ]
+
+                return jsonify({
+                    'positions': agentPositions,
+                    'removed': [str(unique_id) for unique_id in removed],
+                    'step': model.current_step,
+                    'full': False
+                })
         except Exception as e:
             print(e)
             return jsonify({"message": "Error with the agent positions"}), 500
 
 # This route will be used to get the positions of the obstacles
+# The static layers never change once the model is built, so they are serialized once
+# per map and served from cache (with ETag and gzip support).
 @app.route('/getObstacles', methods=['GET'])
 @cross_origin()
 def getObstacles():
@@ -105,29 +260,7 @@ def getObstacles():
 
     if request.method == 'GET':
         try:
-            # Get the positions of the obstacles and return them to WebGL in JSON.json.t.
-            # Same as before, the positions are sent as a list of dictionaries, where each dictionary has the id and position of an obstacle.
-
-            obstacleCells = randomModel.grid.all_cells.select(
-                lambda cell: any(isinstance(obj, Obstacle) for obj in cell.agents)
-            )
-            # print(f"CELLS: {agentCells}")
-
-            agents = [
-                (cell.coordinate, agent)
-                for cell in obstacleCells
-                for agent in cell.agents
-                if isinstance(agent, Obstacle)
-            ]
-            # print(f"AGENTS: {agents}")
-
-            obstaclePositions = [
-                {"id": str(a.unique_id), "x": coordinate[0], "y":0, "z":coordinate[1]}
-                for (coordinate, a) in agents
-            ]
-            # print(f"OBSTACLE POSITIONS: {obstaclePositions}")
-
-            return jsonify({'positions': obstaclePositions})
+            return static_cache.make_response(staticPayload("obstacles"), request)
         except Exception as e:
             print(e)
             return jsonify({"message": "Error with obstacle positions"}), 500
@@ -139,29 +272,7 @@ def getDestinations():
 
     if request.method == 'GET':
         try:
-            # Get the positions of the obstacles and return them to WebGL in JSON.json.t.
-            # Same as before, the positions are sent as a list of dictionaries, where each dictionary has the id and position of an obstacle.
-
-            destinationCells = randomModel.grid.all_cells.select(
-                lambda cell: any(isinstance(obj, Destination) for obj in cell.agents)
-            )
-            # print(f"CELLS: {agentCells}")
-
-            agents = [
-                (cell.coordinate, agent)
-                for cell in destinationCells
-                for agent in cell.agents
-                if isinstance(agent, Destination)
-            ]
-            # print(f"AGENTS: {agents}")
-
-            destinationPositions = [
-                {"id": str(a.unique_id), "x": coordinate[0], "y":1, "z":coordinate[1]}
-                for (coordinate, a) in agents
-            ]
-            # print(f"OBSTACLE POSITIONS: {obstaclePositions}")
-
-            return jsonify({'positions': destinationPositions})
+            return static_cache.make_response(staticPayload("destinations"), request)
         except Exception as e:
             print(e)
             return jsonify({"message": "Error with destination positions"}), 500
@@ -173,33 +284,203 @@ def getRoads():
 
     if request.method == 'GET':
         try:
-            # Get the positions of the obstacles and return them to WebGL in JSON.json.t.
-            # Same as before, the positions are sent as a list of dictionaries, where each dictionary has the id and position of an obstacle.
+            return static_cache.make_response(staticPayload("roads"), request)
+        except Exception as e:
+            print(e)
+            return jsonify({"message": "Error with road positions"}), 500
+        
+@app.route('/getMaps', methods=['GET'])
+@cross_origin()
+def getMaps():
+    # City maps that /init accepts
+    return jsonify({"maps": available_maps(), "default": defaultMap})
 
-            roadCells = randomModel.grid.all_cells.select(
-                lambda cell: any(isinstance(obj, Road) for obj in cell.agents)
-            )
-            # print(f"CELLS: {agentCells}")
+# This route exposes the step timing metrics of the model in the Prometheus text format:
+# a latency histogram per phase of the step, event counters and the model counters.
+@app.route('/metrics', methods=['GET'])
+@cross_origin()
+def metrics():
+    model = None if replay is not None else getModel()
+    if model is None or model.metrics is None:
+        return Response("# Metrics are disabled or there is no model\n", status=404, mimetype="text/plain")
+
+    with modelLock:
+        text = model.metrics.render(model)
+    return Response(text, mimetype="text/plain; version=0.0.4")
+
+# This route runs the sampling profiler and returns the collapsed stacks (for flame graphs)
+# and the functions with the most self time. Options, in the json or as query parameters:
+#   seconds:  sample the server for this long (the ticker and other requests keep running)
+#   steps:    or step the model (the main one, or ?session=<id>) this many times while sampling
+#   interval: milliseconds between samples (default 5)
+#   scope:    "simulation" (threads running the model, default) or "all"
+#   top:      number of functions in "top" (default 20)
+#   format:   "json" (default) or "collapsed" (text/plain, for flamegraph.pl or speedscope)
+# The profiler is a thread that only exists while a profile runs, and only one can run at a time.
+@app.route('/profile', methods=['GET', 'POST'])
+@cross_origin()
+def profileServer():
+    global currentStep
 
-            agents = [
-                (cell.coordinate, agent)
-                for cell in roadCells
-                for agent in cell.agents
-                if isinstance(agent, Road)
-            ]
-            # print(f"AGENTS: {agents}")
+    options = dict(request.args)
+    if request.method == 'POST':
+        options.update(request.get_json(silent=True) or {})
 
-            roadPositions = [
-                {"id": str(a.unique_id), "x": coordinate[0], "y":0, "z":coordinate[1], "direction": a.direction}
-                for (coordinate, a) in agents
-            ]
-            # print(f"OBSTACLE POSITIONS: {obstaclePositions}")
+    try:
+        seconds = float(options['seconds']) if options.get('seconds') is not None else None
+        steps = int(options['steps']) if options.get('steps') is not None else None
+        interval = float(options.get('interval', DEFAULT_INTERVAL * 1000)) / 1000
+        limit = int(options.get('top', 20))
+        scope = str(options.get('scope', 'simulation'))
+        outputFormat = str(options.get('format', 'json'))
+    except (TypeError, ValueError):
+        return jsonify({"message": "seconds, interval and top must be numbers, steps an integer"}), 400
+
+    if (seconds is None) == (steps is None):
+        return jsonify({"message": "Give either seconds or steps"}), 400
+    if seconds is not None and not 0 < seconds <= MAX_DURATION:
+        return jsonify({"message": f"seconds must be between 0 and {MAX_DURATION}"}), 400
+    if steps is not None and not 1 <= steps <= MAX_BATCH_STEPS:
+        return jsonify({"message": f"steps must be between 1 and {MAX_BATCH_STEPS}."}), 400
+    if scope not in SCOPES:
+        return jsonify({"message": f"scope must be one of {', '.join(SCOPES)}"}), 400
+    if outputFormat not in ("json", "collapsed"):
+        return jsonify({"message": "format must be json or collapsed"}), 400
+
+    model = None
+    if steps is not None:
+        model = None if replay is not None else getModel()
+        if model is None:
+            return jsonify({"message": "There is no model to step"}), 404
+
+    # While sampling for some seconds this thread only waits, so it is left out of the samples
+    profile = Profile(interval, scope)
+    sampler = Sampler(profile, ignore=() if steps is not None else (threading.get_ident(),))
+    if not sampler.try_start():
+        return jsonify({"message": "A profile is already running"}), 409
+
+    try:
+        if model is None:
+            time.sleep(seconds)
+        else:
+            with modelLock:
+                model.run_steps(steps)
+                if model is randomModel:
+                    currentStep = model.current_step
+    except Exception as e:
+        print(e)
+        return jsonify({"message": "Error during the profile"}), 500
+    finally:
+        sampler.stop()
+
+    if outputFormat == 'collapsed':
+        return Response(profile.collapsed(), mimetype="text/plain")
+
+    result = profile.summary(limit)
+    if model is not None:
+        result.update({"steps": steps, "currentStep": model.current_step})
+    return jsonify(result)
+
+# This route returns the spawn queues: offered, spawned and dropped vehicles, backlog and
+# waits (in steps), in total and per spawn gate.
+@app.route('/getSpawnStats', methods=['GET'])
+@cross_origin()
+def getSpawnStats():
+    if replay is not None:
+        return jsonify({"message": "Spawn queues are not recorded"}), 404
+
+    try:
+        with modelLock:
+            return jsonify(getModel().spawn_queue.stats())
+    except Exception as e:
+        print(e)
+        return jsonify({"message": "Error with the spawn queues"}), 500
+
+# This route returns the trip statistics: travel times and delays (steps over the free-flow
+# route) of the vehicles that arrived, in total and per origin-destination pair, with the
+# OD matrix of trip counts. ?top=N limits the pairs to the N with the most trips.
+@app.route('/getTripStats', methods=['GET'])
+@cross_origin()
+def getTripStats():
+    if replay is not None:
+        return jsonify({"message": "Trip stats are not recorded"}), 404
+
+    top = request.args.get('top', type=int)
+    if top is not None and top < 0:
+        return jsonify({"message": "top must be a non-negative integer"}), 400
+
+    try:
+        with modelLock:
+            stats = getModel().trip_stats.stats()
+        if top is not None:
+            stats["pairs"] = stats["pairs"][:top]
+        return jsonify(stats)
+    except Exception as e:
+        print(e)
+        return jsonify({"message": "Error with the trip stats"}), 500
+
+# This route returns a congestion heatmap of the recent steps (see randomAgents/heatmap.py).
+# Query parameters:
+#   layer:  "occupancy" (default), "stops" or "queue" (vehicles queued at the red lights)
+#   format: "binary" (default, header and one byte per cell, for a WebGL texture),
+#           "png" (grayscale image, north up) or "json" (grid of bytes and the hotspots)
+#   scale:  value that maps to 255 (default: the maximum of the layer), to compare frames
+#   top:    number of hotspots in the json format (default 10)
+@app.route('/getHeatmap', methods=['GET'])
+@cross_origin()
+def getHeatmap():
+    if replay is not None:
+        return jsonify({"message": "Heatmaps are not recorded"}), 404
+
+    layer = request.args.get('layer', 'occupancy')
+    outputFormat = request.args.get('format', 'binary')
+    scale = request.args.get('scale', type=float)
+    top = request.args.get('top', default=10, type=int)
+    if layer not in HEATMAP_LAYERS:
+        return jsonify({"message": f"layer must be one of {', '.join(HEATMAP_LAYERS)}"}), 400
+    if outputFormat not in ("binary", "png", "json"):
+        return jsonify({"message": "format must be binary, png or json"}), 400
+    if (scale is not None and scale <= 0) or top < 0:
+        return jsonify({"message": "scale must be positive and top non-negative"}), 400
+
+    try:
+        with modelLock:
+            heatmap = getModel().heatmap
+            if outputFormat == "binary":
+                return Response(heatmap.pack(layer, scale), mimetype='application/octet-stream')
+            if outputFormat == "png":
+                return Response(heatmap.png(layer, scale), mimetype='image/png')
+
+            grid, usedScale = heatmap.quantized(layer, scale)
+            return jsonify({
+                "layer": layer,
+                "step": getModel().current_step,
+                "width": grid.shape[1],
+                "height": grid.shape[0],
+                "halfLife": heatmap.half_life,
+                "scale": usedScale,
+                "grid": grid.tolist(),
+                "hotspots": heatmap.hotspots(layer, top),
+            })
+    except Exception as e:
+        print(e)
+        return jsonify({"message": "Error with the heatmap"}), 500
+
+# This route returns the gridlocks (cycles of vehicles waiting for each other): how many
+# were detected and broken, their durations (in steps) and the ones still active.
+@app.route('/getGridlockStats', methods=['GET'])
+@cross_origin()
+def getGridlockStats():
+    if replay is not None:
+        return jsonify({"message": "Gridlocks are not recorded"}), 404
+
+    try:
+        with modelLock:
+            return jsonify(getModel().gridlock.stats())
+    except Exception as e:
+        print(e)
+        return jsonify({"message": "Error with the gridlock stats"}), 500
 
-            return jsonify({'positions': roadPositions})
-        except Exception as e:
-            print(e)
-            return jsonify({"message": "Error with obstacle positions"}), 500
-        
 @app.route('/getTlights', methods=['GET'])
 @cross_origin()
 def getTlights():
@@ -207,7 +488,17 @@ def getTlights():
 
     if request.method == 'GET':
         try:
-            tlCells = randomModel.grid.all_cells.select(
+            if replay is not None:
+                lights = replay.lights(replayStep())
+                return jsonify({'positions': [
+                    {"id": str(i), "x": x, "y": 1, "z": z, "state": "green" if state else "red"}
+                    for i, x, z, state in zip(
+                        lights["id"].tolist(), lights["x"].tolist(), lights["z"].tolist(), lights["state"].tolist()
+                    )
+                ]})
+
+            model = getModel()
+            tlCells = model.grid.all_cells.select(
                 lambda cell: any(isinstance(obj, Traffic_Light) for obj in cell.agents)
             )
 
@@ -235,26 +526,235 @@ def getTlights():
             print(e)
             return jsonify({"message": "Error with traffic light positions"}), 500
 
+# This route sends the vehicles and traffic lights in a packed binary format
+# (see randomAgents/packing.py), so the client can read them with typed arrays.
+@app.route('/getStateBinary', methods=['GET'])
+@cross_origin()
+def getStateBinary():
+    global randomModel
+
+    if request.method == 'GET':
+        try:
+            if replay is not None:
+                step = replayStep()
+                data = pack_records(step, replay.vehicles(step), replay.lights(step))
+                return Response(data, mimetype='application/octet-stream')
+
+            with modelLock:
+                data = pack_state(getModel())
+            return Response(data, mimetype='application/octet-stream')
+        except Exception as e:
+            print(e)
+            return jsonify({"message": "Error with the binary state"}), 500
+
+# Upper limit of steps for a single /update request
+MAX_BATCH_STEPS = 1_000_000
+
 # This route will be used to update the model
+# Optional query parameters:
+#   steps:   number of steps to advance (default 1)
+#   budget:  maximum milliseconds to spend; the batch stops early when it runs out
+#   metrics: 1 to also return per-step aggregate metrics (vehicles, crashed, counters)
 @app.route('/update', methods=['GET'])
 @cross_origin()
 def updateModel():
     global currentStep, randomModel
     if request.method == 'GET':
+        steps = request.args.get('steps', default=1, type=int)
+        budget = request.args.get('budget', type=float)
+        collectMetrics = request.args.get('metrics', default=0, type=int) == 1
+
+        if steps is None or not 1 <= steps <= MAX_BATCH_STEPS:
+            return jsonify({"message": f"steps must be between 1 and {MAX_BATCH_STEPS}."}), 400
+
         try:
+            if replay is not None:
+                # Replay: move the cursor of the recording, nothing is simulated
+                currentStep = min(currentStep + steps, replay.last_step)
+                spawned, arrived = replay.counters(currentStep)
+                return jsonify({
+                    'message': f'Replay at step {currentStep}.',
+                    'currentStep': currentStep,
+                    'carsSpawned': spawned,
+                    'carsArrived': arrived,
+                    'replayEnded': currentStep >= replay.last_step
+                })
+
         # Update the model and return a message to WebGL saying that the model was updated successfully
-            randomModel.step()
-            currentStep += 1
-            return jsonify({
-                'message': f'Model updated to step {currentStep}.',
-                'currentStep': currentStep,
-                'carsSpawned': randomModel.cars_spawned,
-                'carsArrived': randomModel.cars_arrived
-            })
+            with modelLock:
+                model = getModel()
+                if steps == 1 and not collectMetrics:
+                    model.step()
+                    batch = None
+                else:
+                    batch = model.run_steps(
+                        steps,
+                        time_budget=budget / 1000 if budget is not None else None,
+                        collect_metrics=collectMetrics
+                    )
+                step = model.current_step
+                if model is randomModel:
+                    currentStep = step
+
+            result = {
+                'message': f'Model updated to step {step}.',
+                'currentStep': step,
+                'carsSpawned': model.cars_spawned,
+                'carsArrived': model.cars_arrived,
+                'spawnBacklog': model.spawn_queue.backlog
+            }
+            if batch is not None:
+                result.update(batch)
+
+            return jsonify(result)
         except Exception as e:
             print(e)
             return jsonify({"message": "Error during step."}), 500
         
+# This route streams the simulation with Server-Sent Events.
+# Every tick of the ticker is pushed as an "tick" event: counters, the vehicles that changed
+# (or every vehicle when "full" is true), the ids of the vehicles that arrived and the lights.
+# Slow clients skip intermediate ticks and receive a full snapshot when they catch up.
+@app.route('/stream', methods=['GET'])
+@cross_origin()
+def stream():
+    subscription = broadcaster.subscribe()
+
+    def events():
+        try:
+            yield "retry: 1000\n\n"
+            while True:
+                data = subscription.next(timeout=15)
+                if data is None:
+                    # Keeps the connection alive and detects closed clients
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"id: {subscription.last_step}\nevent: tick\ndata: {data}\n\n"
+        finally:
+            broadcaster.unsubscribe(subscription)
+
+    response = Response(stream_with_context(events()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# This route starts or stops the ticker that advances the model for /stream.
+# Expects a json with "running" (bool) and optionally "interval" (seconds between steps).
+@app.route('/ticker', methods=['GET', 'POST'])
+@cross_origin()
+def tickerControl():
+    try:
+        if request.method == 'POST':
+            data = request.json or {}
+            interval = data.get("interval")
+            if data.get("running", True):
+                ticker.start(float(interval) if interval is not None else None)
+            else:
+                ticker.stop()
+
+        return jsonify({
+            "running": ticker.running,
+            "interval": ticker.interval,
+            "subscribers": len(broadcaster.subscriptions)
+        })
+    except Exception as e:
+        print(e)
+        return jsonify({"message": "Error controlling the ticker"}), 500
+
+# This route takes a snapshot of a model (the main one, or ?session=<id>).
+# POST {"name": ...} keeps it in memory under that name; GET ?name=... downloads it.
+@app.route('/snapshot', methods=['GET', 'POST'])
+@cross_origin()
+def snapshotModel():
+    try:
+        if request.method == 'GET':
+            name = request.args.get('name', 'default')
+            if name not in snapshots:
+                return jsonify({"message": f"No snapshot named {name}"}), 404
+            return Response(snapshots[name], mimetype='application/octet-stream')
+
+        name = (request.get_json(silent=True) or {}).get('name', 'default')
+        with modelLock:
+            model = getModel()
+            snapshots[name] = snapshot_model(model)
+
+        return jsonify({"name": name, "step": model.current_step, "size": len(snapshots[name])})
+    except Exception as e:
+        print(e)
+        return jsonify({"message": "Error taking the snapshot"}), 500
+
+def snapshotFromRequest():
+    """Snapshot bytes sent in the body (octet-stream) or named in the json ("name"), None if there is no such name."""
+    if request.mimetype == 'application/octet-stream':
+        return request.get_data()
+    return snapshots.get((request.get_json(silent=True) or {}).get('name', 'default'))
+
+def unknownSnapshot():
+    name = (request.get_json(silent=True) or {}).get('name', 'default')
+    return jsonify({"message": f"No snapshot named {name}"}), 404
+
+# This route replaces the main model with a snapshot (by name, or uploaded as octet-stream).
+# The restored model reports to the same endpoint as the models created by /init.
+@app.route('/restore', methods=['POST'])
+@cross_origin()
+def restoreModel():
+    global currentStep, randomModel
+
+    try:
+        data = snapshotFromRequest()
+        if data is None:
+            return unknownSnapshot()
+        model = restore_model(data, REPORT_URL)
+        with modelLock:
+            if randomModel is not None:
+                randomModel.stop_recording()
+            randomModel = model
+            currentStep = model.current_step
+            if recordPath:
+                startRecording(randomModel)
+            broadcaster.reset()
+
+        return jsonify({"message": f"Model restored at step {currentStep}.", "currentStep": currentStep})
+    except ValueError as e:
+        return jsonify({"message": f"Invalid snapshot: {e}"}), 400
+    except Exception as e:
+        print(e)
+        return jsonify({"message": "Error restoring the snapshot"}), 500
+
+# This route creates a new session from a snapshot, or from the current state of a model
+# when no snapshot is given. The new session is used with ?session=<id> on the other routes.
+@app.route('/fork', methods=['POST'])
+@cross_origin()
+def forkModel():
+    try:
+        data = request.get_json(silent=True) or {}
+        if request.mimetype == 'application/octet-stream' or 'name' in data:
+            snapshot = snapshotFromRequest()
+            if snapshot is None:
+                return unknownSnapshot()
+            model = restore_model(snapshot, REPORT_URL)
+        else:
+            with modelLock:
+                model = fork_model(getModel())
+
+        session = uuid.uuid4().hex[:12]
+        sessions[session] = model
+
+        return jsonify({"session": session, "currentStep": model.current_step})
+    except ValueError as e:
+        return jsonify({"message": f"Invalid snapshot: {e}"}), 400
+    except Exception as e:
+        print(e)
+        return jsonify({"message": "Error forking the model"}), 500
+
+# This route deletes a session created by /fork.
+@app.route('/session/<session>', methods=['DELETE'])
+@cross_origin()
+def deleteSession(session):
+    if sessions.pop(session, None) is None:
+        return jsonify({"message": f"No session {session}"}), 404
+    return jsonify({"message": f"Session {session} deleted"})
+
 @app.route('/setCarSpawnRate', methods=['POST'])
 @cross_origin()
 def setCarSpawnRate():
@@ -265,7 +765,7 @@ def setCarSpawnRate():
         new_rate = int(data.get("rate", 5))
 
         # Guardamos el valor en el modelo MESA
-        randomModel.car_spawn_rate = new_rate
+        getModel().car_spawn_rate = new_rate
 
         print(f"[SERVER] Rate adjusted: {new_rate}")
 
@@ -285,7 +785,7 @@ def setBorrachitoMode():
         borrachito_on = bool(data.get("borrachitoOn", False))
 
         # Guardamos el valor en el modelo MESA
-        randomModel.borrachito_mode = borrachito_on
+        getModel().borrachito_mode = borrachito_on
 
         print(f"[SERVER] Mode updated: {borrachito_on}")
 
@@ -297,5 +797,34 @@ def setBorrachitoMode():
 
 
 if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="Traffic simulation server")
+    parser.add_argument("--record", help="Record the trajectory of every model created by /init, each one in a run_<n> subdirectory of this directory")
+    parser.add_argument("--replay", help="Serve a recorded trajectory instead of running a model")
+    parser.add_argument("--pool-size", type=int, default=1, help="Ready models kept per /init configuration")
+    parser.add_argument("--pool-configs", type=int, default=4, help="/init configurations that keep ready models (least recently used are dropped)")
+    parser.add_argument("--map", default=DEFAULT_MAP, choices=available_maps(), help="City map used when /init does not ask for one")
+    parser.add_argument("--no-metrics", action="store_true", help="Do not time the steps of the models (/metrics is disabled)")
+    parser.add_argument("--warmup", type=int, default=0, help="Steps simulated by the pooled default model before /init")
+    args = parser.parse_args()
+
+    modelPool.size = args.pool_size
+    modelPool.max_configs = args.pool_configs
+    defaultMap = args.map
+    instrumentModels = not args.no_metrics
+    if args.pool_size > 0 and not args.replay:
+        modelPool.prewarm(
+            N=number_agents, seed=42, spawn_of_cars=5, warmup_steps=args.warmup, map_name=defaultMap,
+            spawn_demand=None, admission="queue", instrument=instrumentModels,
+        )
+
+    recordPath = args.record
+    if recordPath:
+        atexit.register(stopRecording)
+    if args.replay:
+        replay = TrajectoryReader(args.replay)
+        currentStep = replay.first_step
+        print(f"[SERVER] Replaying {args.replay}: steps {replay.first_step}-{replay.last_step}")
+
     # Run the flask server in port 8585
-    app.run(host="localhost", port=8585, debug=True)
+    # threaded=True lets /stream clients stay connected while other requests are served
+    app.run(host="localhost", port=8585, debug=True, threaded=True)
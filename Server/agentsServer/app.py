@@ -1,31 +1,25 @@
-from randomAgents.agent import RandomAgent, ObstacleAgent
-from randomAgents.model import RandomModel
+import solara
 from mesa.visualization import (
     CommandConsole,
     Slider,
     SolaraViz,
-    SpaceRenderer,
 )
-from mesa.visualization.components import AgentPortrayalStyle
+from mesa.visualization.utils import update_counter
 
+from randomAgents.city_map import DEFAULT_MAP, available_maps
+from randomAgents.model import CityModel
+from randomAgents.raster import FrameRenderer, encode_png
 
-def random_portrayal(agent):
-    if agent is None:
-        return
+# Pixels per cell side of the frames
+CELL_SIZE = 8
 
-    portrayal = AgentPortrayalStyle(
-        size=50,
-        marker="o",
-        zorder=2,
-    )
 
-    if isinstance(agent, RandomAgent):
-        portrayal.update(("color", "red"))
-    elif isinstance(agent, ObstacleAgent):
-        portrayal.update(("color", "gray"))
-        portrayal.update(("marker", "s"), ("size", 125), ("zorder", 1))
-
-    return portrayal
+@solara.component
+def CityFrame(model):
+    """Frame of the model drawn by the raster renderer (see randomAgents/raster.py)."""
+    update_counter.get()
+    renderer = solara.use_memo(lambda: FrameRenderer(model.city_map, CELL_SIZE), [model.map_digest])
+    solara.Image(encode_png(renderer.render(model), level=1), width="100%")
 
 
 model_params = {
@@ -34,29 +28,30 @@ model_params = {
         "value": 42,
         "label": "Random Seed",
     },
-    "num_agents": Slider("Number of agents", 10, 1, 50),
-    "width": Slider("Grid width", 28, 1, 50),
-    "height": Slider("Grid height", 28, 1, 50),
+    "map_name": {
+        "type": "Select",
+        "value": DEFAULT_MAP,
+        "values": available_maps(),
+        "label": "City map",
+    },
+    "spawn_of_cars": Slider("Steps between spawns", 5, 1, 20),
+    "N": 10,
+    "report_url": None,
 }
 
 
 # Create the model using the initial parameters from the settings
-model = RandomModel(
-    num_agents=model_params["num_agents"].value,
-    width=model_params["width"].value,
-    height=model_params["height"].value,
-    seed=model_params["seed"]["value"])
-
-renderer = SpaceRenderer(
-    model,
-    backend="matplotlib",
+model = CityModel(
+    N=model_params["N"],
+    seed=model_params["seed"]["value"],
+    spawn_of_cars=model_params["spawn_of_cars"].value,
+    map_name=model_params["map_name"]["value"],
+    report_url=None,
 )
-renderer.draw_agents(random_portrayal)
 
 page = SolaraViz(
     model,
-    renderer,
-    components=[CommandConsole],
+    components=[CityFrame],
     model_params=model_params,
-    name="Random Model",
+    name="City Model",
 )
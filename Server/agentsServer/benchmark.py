@@ -0,0 +1,376 @@
+# TC2008B. Sistemas Multiagentes y Gráficas Computacionales
+# Benchmarks of the simulation core and of the HTTP API.
+#
+#   python benchmark.py --output results.json
+#   python benchmark.py --quick --compare results.json
+#   python benchmark.py --sections imports
+#
+# Every section uses fixed seeds. The results are written as JSON, so runs of
+# different commits can be compared with --compare.
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is not reported there
+    resource = None
+
+from randomAgents.city_map import DEFAULT_MAP, available_maps, benchmark as benchmark_maps
+from randomAgents.model import CityModel
+
+SECTIONS = ("construction", "steps", "astar", "http", "imports")
+
+# Fields that identify the entries of a list when comparing results
+ENTRY_KEYS = ("map", "demand", "endpoint", "target", "module")
+
+# Entry points whose cold start is measured by the imports section
+IMPORT_TARGETS = ("randomAgents.model", "headless", "ensemble", "agents_server")
+# Modules that should not be loaded by any entry point
+HEAVY_MODULES = ("mesa.visualization", "solara", "matplotlib", "requests")
+
+SERVER_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def peak_rss_mb():
+    """Peak resident memory of the process so far, in MB (None when it cannot be measured)."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return rss / 1024 ** 2 if sys.platform == "darwin" else rss / 1024
+
+
+def summarize(values):
+    """Mean, percentiles and max of a list of numbers."""
+    if not values:
+        return {"count": 0}
+    values = np.asarray(values, dtype=float)
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {
+        "count": len(values),
+        "mean": float(values.mean()),
+        "p50": float(p50),
+        "p90": float(p90),
+        "p99": float(p99),
+        "max": float(values.max()),
+    }
+
+
+def seeded_model(seed, **kwargs):
+    return CityModel(N=10, seed=seed, report_url=None, **kwargs)
+
+
+def bench_construction(args):
+    """Compile, cached load and CityModel construction time of every map."""
+    return benchmark_maps(args.maps or available_maps(), repeat=args.repeat)
+
+
+def bench_steps(args):
+    """Steps per second at increasing spawn demand (and so vehicle count)."""
+    results = []
+    for demand in args.demands:
+        model = seeded_model(args.seed, map_name=args.map, spawn_demand=demand)
+        model.run_steps(args.warmup)
+
+        step_times = []
+        vehicles = []
+        for _ in range(args.steps):
+            start = time.perf_counter()
+            model.step()
+            step_times.append((time.perf_counter() - start) * 1000)
+            vehicles.append(sum(1 for _ in model.vehicles()))
+
+        results.append({
+            "demand": demand,
+            "vehicles_mean": float(np.mean(vehicles)),
+            "vehicles_max": int(np.max(vehicles)),
+            "steps_per_sec": 1000 * len(step_times) / sum(step_times),
+            "step_ms": summarize(step_times),
+        })
+    return results
+
+
+def bench_astar(args):
+    """Latency and node expansions of A* searches from the vehicles of a loaded model."""
+    model = seeded_model(args.seed, map_name=args.map, spawn_demand=max(args.demands))
+    model.run_steps(args.warmup)
+
+    latencies = []
+    expansions = []
+    failures = 0
+    vehicles = sorted(model.vehicles(), key=lambda v: v.unique_id)[:args.astar_vehicles]
+    for _ in range(args.astar_repeat):
+        for vehicle in vehicles:
+            start = time.perf_counter()
+            path = vehicle.aStar()
+            latencies.append((time.perf_counter() - start) * 1000)
+            expansions.append(vehicle.last_expansions)
+            failures += path is None
+
+    return {
+        "vehicles": len(vehicles),
+        "searches": len(latencies),
+        "failures": failures,
+        "latency_ms": summarize(latencies),
+        "expansions": summarize(expansions),
+    }
+
+
+def bench_http(args):
+    """Latency of the API endpoints, served locally and called by concurrent clients."""
+    import requests
+    from werkzeug.serving import make_server
+    import agents_server
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, agents_server.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    init_body = {"N": 10, "seed": args.seed, "map": args.map}
+    endpoints = [
+        ("POST", "/init", init_body, max(1, args.requests // 10)),
+        ("GET", "/update", None, args.requests),
+        ("GET", "/getAgents", None, args.requests),
+        ("GET", "/getTlights", None, args.requests),
+        ("GET", "/getRoads", None, args.requests),
+        ("GET", "/getObstacles", None, args.requests),
+        ("GET", "/getDestinations", None, args.requests),
+    ]
+
+    def run(method, path, body, count):
+        latencies = []
+        errors = 0
+        lock = threading.Lock()
+        remaining = iter(range(count))
+
+        def client():
+            nonlocal errors
+            session = requests.Session()
+            while True:
+                with lock:
+                    if next(remaining, None) is None:
+                        return
+                start = time.perf_counter()
+                try:
+                    response = session.request(method, base_url + path, json=body, timeout=60)
+                    failed = response.status_code >= 400
+                except requests.RequestException:
+                    failed = True
+                elapsed = (time.perf_counter() - start) * 1000
+                with lock:
+                    latencies.append(elapsed)
+                    errors += failed
+
+        start = time.perf_counter()
+        clients = [threading.Thread(target=client) for _ in range(args.concurrency)]
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+        elapsed = time.perf_counter() - start
+
+        return {
+            "endpoint": path,
+            "requests": count,
+            "errors": errors,
+            "concurrency": args.concurrency,
+            "requests_per_sec": count / elapsed,
+            "latency_ms": summarize(latencies),
+        }
+
+    try:
+        requests.post(base_url + "/init", json=init_body, timeout=60)
+        # Some vehicles on the map before measuring
+        requests.get(base_url + f"/update?steps={args.warmup}", timeout=600)
+        return [run(*endpoint) for endpoint in endpoints]
+    finally:
+        server.shutdown()
+
+
+def parse_importtime(text):
+    """
+    Reads the output of python -X importtime.
+
+    Returns:
+        list: (module, depth, self seconds, cumulative seconds), in import order
+    """
+    modules = []
+    for line in text.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules.append((name.strip(), depth, int(own) / 1e6, int(cumulative) / 1e6))
+    return modules
+
+
+def bench_imports(args):
+    """Cold start of the entry points: import time in a fresh interpreter and the slowest imports."""
+    results = []
+    for target in IMPORT_TARGETS:
+        code = f"import sys; import {target}; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+
+        walls = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            loaded = subprocess.run(
+                [sys.executable, "-c", code], capture_output=True, text=True, check=True, cwd=SERVER_DIRECTORY
+            ).stdout.strip()
+            walls.append(time.perf_counter() - start)
+
+        # A separate run with -X importtime, which slows the imports down a bit
+        profile = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {target}"],
+            capture_output=True, text=True, check=True, cwd=SERVER_DIRECTORY,
+        ).stderr
+        modules = parse_importtime(profile)
+        # Packages imported by the target (nested ones are also inside the time of their parent)
+        packages = sorted(
+            (m for m in modules if "." not in m[0] and m[1] > 0), key=lambda m: m[3], reverse=True
+        )
+
+        results.append({
+            "target": target,
+            "wall_sec": summarize(walls),
+            "modules": len(modules),
+            "heavy_modules": loaded.split(",") if loaded else [],
+            "slowest": [
+                {"module": name, "cumulative_sec": cumulative, "self_sec": own}
+                for name, _, own, cumulative in packages[:args.import_top]
+            ],
+        })
+    return results
+
+
+BENCHMARKS = {
+    "construction": bench_construction,
+    "steps": bench_steps,
+    "astar": bench_astar,
+    "http": bench_http,
+    "imports": bench_imports,
+}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(value, prefix=""):
+    """Numeric leaves of a result, keyed by path (list entries by their identifying field)."""
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, list):
+        items = []
+        for i, entry in enumerate(value):
+            key = next((f"{k}={entry[k]}" for k in ENTRY_KEYS if isinstance(entry, dict) and k in entry), str(i))
+            items.append((key, entry))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {prefix: value}
+    else:
+        return {}
+
+    leaves = {}
+    for key, entry in items:
+        leaves.update(flatten(entry, f"{prefix}.{key}" if prefix else str(key)))
+    return leaves
+
+
+def compare(baseline, results):
+    """Prints the numeric results that are in both runs with their relative change."""
+    old = flatten({k: v for k, v in baseline.items() if k != "meta"})
+    new = flatten({k: v for k, v in results.items() if k != "meta"})
+
+    print(f"{'metric':<60}{'baseline':>14}{'current':>14}{'change':>10}")
+    for key in sorted(old.keys() & new.keys()):
+        change = f"{(new[key] - old[key]) / old[key] * 100:+.1f}%" if old[key] else ""
+        print(f"{key:<60}{old[key]:>14.3f}{new[key]:>14.3f}{change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the traffic simulation")
+    parser.add_argument("--sections", default=",".join(SECTIONS), help=f"Comma separated, from {', '.join(SECTIONS)}")
+    parser.add_argument("--quick", action="store_true", help="Fewer steps and requests (for a fast check)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--map", default=DEFAULT_MAP, help="Map of the steps, A* and HTTP sections")
+    parser.add_argument("--maps", nargs="*", help="Maps of the construction section (all by default)")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each construction measure")
+    parser.add_argument("--demands", type=float, nargs="*", default=[0.05, 0.1, 0.2, 0.4],
+                        help="Vehicles per step at each spawn gate, one steps/sec measure each")
+    parser.add_argument("--warmup", type=int, default=100, help="Steps simulated before measuring")
+    parser.add_argument("--steps", type=int, default=100, help="Steps measured at each demand")
+    parser.add_argument("--astar-vehicles", type=int, default=50)
+    parser.add_argument("--astar-repeat", type=int, default=5)
+    parser.add_argument("--requests", type=int, default=200, help="Requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent HTTP clients")
+    parser.add_argument("--import-top", type=int, default=10, help="Slowest packages reported per entry point")
+    parser.add_argument("--output", help="Write the results to this file (default: stdout)")
+    parser.add_argument("--compare", help="Results of a previous run to compare with")
+    args = parser.parse_args()
+
+    if args.quick:
+        args.warmup, args.steps, args.repeat = 30, 30, 2
+        args.astar_vehicles, args.astar_repeat, args.requests = 20, 2, 40
+        args.demands = args.demands[:2]
+
+    sections = [s.strip() for s in args.sections.split(",") if s.strip()]
+    for section in sections:
+        if section not in BENCHMARKS:
+            parser.error(f"Unknown section {section}")
+
+    results = {
+        "meta": {
+            "commit": git_commit(),
+            "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+    }
+
+    # Peak memory after each section (it only grows, so the last one is the peak of the run)
+    memory = {}
+    for section in sections:
+        print(f"[BENCH] {section}...", file=sys.stderr)
+        start = time.perf_counter()
+        # The model and the server print progress, stdout is kept for the results
+        with contextlib.redirect_stdout(sys.stderr):
+            results[section] = BENCHMARKS[section](args)
+        memory[section] = {"peak_rss_mb": peak_rss_mb()}
+        print(f"[BENCH] {section} done in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+    results["memory"] = dict(memory, peak_rss_mb=peak_rss_mb())
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+# TC2008B. Sistemas Multiagentes y Gráficas Computacionales
+# Ensembles of seeded simulation runs, spread over a pool of processes.
+#
+#   python ensemble.py --seeds 20 --spawn-rates 2 5 10 --borrachito off on --output runs.jsonl
+#
+# Every combination of the grid (maps x spawn rates x borrachito settings x seeds) is
+# one run. Each finished run is appended to the results file as a line of JSON, so an
+# interrupted ensemble is resumed by running the same command again: the runs already
+# in the file are skipped. Runs are independent processes (each model has its own
+# random streams), so the ensemble scales with the number of cores.
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from randomAgents.city_map import DEFAULT_MAP, available_maps, load_map
+from randomAgents.model import CityModel
+from randomAgents.trip_stats import TripStats
+
+# Parameters that identify a run in the results file
+RUN_KEYS = ("map", "spawn_rate", "borrachito", "seed", "steps")
+
+# Per-run metrics averaged in the summary
+SUMMARY_METRICS = (
+    "cars_spawned", "cars_arrived", "crashes", "mean_trip_steps", "travel_p90", "delay_p50", "delay_p90",
+    "steps_per_sec",
+)
+
+
+def run_key(run):
+    return tuple(run[key] for key in RUN_KEYS)
+
+
+def simulate(run):
+    """
+    Runs one simulation. Called in the worker processes.
+
+    Args:
+        run: Dict with the RUN_KEYS
+
+    Returns:
+        dict: The run with its metrics
+    """
+    start = time.perf_counter()
+    model = CityModel(
+        N=10, seed=run["seed"], spawn_of_cars=run["spawn_rate"], report_url=None,
+        map_name=run["map"], instrument=False,
+    )
+    model.borrachito_mode = run["borrachito"]
+    model.run_steps(run["steps"])
+    elapsed = time.perf_counter() - start
+    trips = model.trip_stats.total
+
+    return dict(
+        run,
+        cars_spawned=model.cars_spawned,
+        cars_arrived=model.cars_arrived,
+        crashes=model.crashes,
+        gridlocks=model.gridlock.detected,
+        mean_trip_steps=model.mean_trip_steps,
+        travel_p90=trips.travel.quantile(0.9),
+        delay_p50=trips.delay.quantile(0.5),
+        delay_p90=trips.delay.quantile(0.9),
+        # OD matrix with its sketches, merged over the seeds by merged_trips
+        trips=model.trip_stats.get_state(),
+        vehicles=sum(1 for _ in model.vehicles()),
+        backlog=model.spawn_queue.backlog,
+        elapsed=round(elapsed, 3),
+        steps_per_sec=round(run["steps"] / elapsed, 2),
+        pid=os.getpid(),
+    )
+
+
+def grid(maps, spawn_rates, borrachito, seeds, steps):
+    """Runs of every combination of the parameters."""
+    return [
+        {"map": map_name, "spawn_rate": rate, "borrachito": drunk, "seed": seed, "steps": steps}
+        for map_name, rate, drunk, seed in itertools.product(maps, spawn_rates, borrachito, seeds)
+    ]
+
+
+def read_results(path):
+    """
+    Runs already in a results file.
+    A line cut by an interruption is removed from the file, so new lines start clean.
+
+    Returns:
+        list: Results, in file order
+    """
+    if not os.path.exists(path):
+        return []
+
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+
+    results = []
+    for line in data[:end].splitlines():
+        if line.strip():
+            results.append(json.loads(line))
+    return results
+
+
+def run_ensemble(runs, output, workers=None):
+    """
+    Runs the simulations that are not in the results file yet and appends their results.
+
+    Args:
+        runs: Runs to do (see grid)
+        output: Results file (JSON lines)
+        workers: Processes of the pool (default: one per core)
+
+    Returns:
+        list: Every result of the file for the given runs
+    """
+    done = {run_key(result): result for result in read_results(output)}
+    pending = [run for run in runs if run_key(run) not in done]
+    print(f"[ENSEMBLE] {len(runs)} runs, {len(runs) - len(pending)} already done, {len(pending)} to run", file=sys.stderr)
+
+    if pending:
+        # Compiled once here, the workers load the maps from the disk cache
+        for map_name in {run["map"] for run in pending}:
+            load_map(map_name)
+
+        start = time.perf_counter()
+        with open(output, "a") as f, ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(simulate, run) for run in pending]
+            try:
+                for i, future in enumerate(as_completed(futures), 1):
+                    result = future.result()
+                    f.write(json.dumps(result) + "\n")
+                    f.flush()
+                    done[run_key(result)] = result
+                    print(f"[ENSEMBLE] {i}/{len(pending)} {result['map']} rate={result['spawn_rate']} "
+                          f"borrachito={result['borrachito']} seed={result['seed']}: {result['elapsed']}s",
+                          file=sys.stderr)
+            except KeyboardInterrupt:
+                for future in futures:
+                    future.cancel()
+                print("[ENSEMBLE] Interrupted, run the same command again to resume", file=sys.stderr)
+                raise
+        print(f"[ENSEMBLE] {len(pending)} runs in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+    return [done[run_key(run)] for run in runs]
+
+
+def summarize(results):
+    """
+    Mean and standard deviation of the metrics over the seeds of each configuration.
+
+    Returns:
+        list: One dict per (map, spawn rate, borrachito, steps)
+    """
+    groups = defaultdict(list)
+    for result in results:
+        groups[(result["map"], result["spawn_rate"], result["borrachito"], result["steps"])].append(result)
+
+    summary = []
+    for (map_name, rate, drunk, steps), group in groups.items():
+        row = {"map": map_name, "spawn_rate": rate, "borrachito": drunk, "steps": steps, "runs": len(group)}
+        for metric in SUMMARY_METRICS:
+            # Results files of older versions may miss some metrics
+            values = np.array([r[metric] for r in group if r.get(metric) is not None], dtype=float)
+            row[metric] = float(values.mean()) if len(values) else None
+            row[f"{metric}_std"] = float(values.std()) if len(values) else None
+        summary.append(row)
+    return summary
+
+
+def merged_trips(results):
+    """
+    Trip stats of several runs pooled together (the quantiles of all their trips,
+    not the mean of the per-run quantiles).
+
+    Returns:
+        TripStats: Merged OD matrix
+    """
+    merged = None
+    for result in results:
+        if "trips" not in result:
+            continue
+        trip_stats = TripStats.from_state(result["trips"])
+        if merged is None:
+            merged = trip_stats
+        else:
+            merged.merge(trip_stats)
+    return merged if merged is not None else TripStats()
+
+
+def print_summary(summary):
+    columns = ("map", "spawn_rate", "borrachito", "runs") + SUMMARY_METRICS
+    print("\t".join(columns))
+    for row in summary:
+        cells = []
+        for column in columns:
+            value = row[column]
+            if isinstance(value, float):
+                value = f"{value:.2f} ± {row[f'{column}_std']:.2f}"
+            cells.append(str(value))
+        print("\t".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seeded ensembles of the traffic simulation over a process pool")
+    parser.add_argument("--maps", nargs="*", default=[DEFAULT_MAP], help="City maps (see city_map.available_maps)")
+    parser.add_argument("--spawn-rates", type=int, nargs="*", default=[5], help="Steps between spawns")
+    parser.add_argument("--borrachito", nargs="*", default=["off"], choices=["off", "on"], help="Borrachito mode settings")
+    parser.add_argument("--seeds", type=int, default=10, help="Runs of each configuration (seeds first-seed, first-seed + 1, ...)")
+    parser.add_argument("--first-seed", type=int, default=0)
+    parser.add_argument("--steps", type=int, default=500, help="Steps of every run")
+    parser.add_argument("--workers", type=int, help="Processes (default: one per core)")
+    parser.add_argument("--output", default="ensemble.jsonl", help="Results file, one JSON line per run (resumed if it exists)")
+    parser.add_argument("--trips", help="Write the trip stats of every run pooled together to this JSON file")
+    args = parser.parse_args()
+
+    for map_name in args.maps:
+        if map_name not in available_maps():
+            parser.error(f"Unknown map {map_name}")
+
+    runs = grid(
+        args.maps, args.spawn_rates, [setting == "on" for setting in dict.fromkeys(args.borrachito)],
+        range(args.first_seed, args.first_seed + args.seeds), args.steps,
+    )
+
+    try:
+        results = run_ensemble(runs, args.output, args.workers)
+    except KeyboardInterrupt:
+        sys.exit(130)
+
+    print_summary(summarize(results))
+
+    if args.trips:
+        with open(args.trips, "w") as f:
+            json.dump(merged_trips(results).stats(), f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# TC2008B. Sistemas Multiagentes y Gráficas Computacionales
+# Runs the simulation from the command line, without Flask or the visualization.
+#
+#   python headless.py --map 2025_base --seed 7 --spawn-rate 3 --steps 2000 --every 100
+#   python headless.py --steps 500 --metrics run.jsonl --record recordings/run
+#   python headless.py --steps 2000 --demand 0.5 --trips trips.json
+#   python headless.py --steps 600 --frames frames/run --frame-format raw --cell-size 4
+#
+# Only the simulation core is imported (no flask, mesa.visualization or solara), so short
+# batch jobs start fast. Metrics are written every --every steps as JSON lines; the
+# trajectory can be recorded with --record and served later with agents_server.py --replay.
+
+import argparse
+import json
+import sys
+import time
+
+from randomAgents.city_map import DEFAULT_MAP, available_maps
+from randomAgents.gridlock import GRIDLOCK_POLICIES
+from randomAgents.model import CityModel
+from randomAgents.raster import FRAME_FORMATS, FrameRenderer, FrameWriter
+from randomAgents.spawn_queue import ADMISSION_POLICIES
+
+
+def model_metrics(model, elapsed):
+    """Counters of the model after a step, written as one line of the metrics output."""
+    vehicles = 0
+    crashed = 0
+    for vehicle in model.vehicles():
+        vehicles += 1
+        crashed += vehicle.crashed
+
+    return {
+        "step": model.current_step,
+        "vehicles": vehicles,
+        "crashed": crashed,
+        "cars_spawned": model.cars_spawned,
+        "cars_arrived": model.cars_arrived,
+        "crashes": model.crashes,
+        "mean_trip_steps": model.mean_trip_steps,
+        "travel_p50": model.trip_stats.total.travel.quantile(0.5),
+        "travel_p90": model.trip_stats.total.travel.quantile(0.9),
+        "delay_p50": model.trip_stats.total.delay.quantile(0.5),
+        "delay_p90": model.trip_stats.total.delay.quantile(0.9),
+        "backlog": model.spawn_queue.backlog,
+        "gridlocks": model.gridlock.detected,
+        "active_gridlocks": len(model.gridlock.active),
+        "elapsed": round(elapsed, 3),
+    }
+
+
+def main():
+    start = time.perf_counter()
+
+    parser = argparse.ArgumentParser(description="Run the traffic simulation without the web server")
+    parser.add_argument("--map", default=DEFAULT_MAP, help="City map (see city_map.available_maps)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--spawn-rate", type=int, default=5, help="Steps between spawns")
+    parser.add_argument("--demand", type=float, help="Vehicles per step at each spawn gate (instead of --spawn-rate)")
+    parser.add_argument("--admission", default="queue", choices=ADMISSION_POLICIES)
+    parser.add_argument("--borrachito", action="store_true", help="Turn on Borrachito mode")
+    parser.add_argument("--gridlock-policy", default="lane_change", choices=GRIDLOCK_POLICIES, help="How gridlocks are broken (see gridlock.py)")
+    parser.add_argument("--steps", type=int, default=1000, help="Steps to simulate")
+    parser.add_argument("--every", type=int, default=100, help="Steps between two lines of metrics")
+    parser.add_argument("--metrics", help="Write the metrics to this file (default: stdout)")
+    parser.add_argument("--record", help="Record the trajectory in this directory")
+    parser.add_argument("--trips", help="Write the trip stats and OD matrix of the run to this JSON file")
+    parser.add_argument("--frames", help="Draw frames of the run in this directory (see randomAgents/raster.py)")
+    parser.add_argument("--frame-format", default="ppm", choices=FRAME_FORMATS)
+    parser.add_argument("--frame-every", type=int, default=1, help="Steps between two frames")
+    parser.add_argument("--cell-size", type=int, default=4, help="Pixels per cell side of the frames")
+    parser.add_argument("--report", action="store_true", help="Also POST the counters to the metrics API every 100 steps")
+    args = parser.parse_args()
+
+    if args.map not in available_maps():
+        parser.error(f"Unknown map {args.map}, available: {', '.join(available_maps())}")
+    if args.steps < 1 or args.every < 1 or args.frame_every < 1 or args.cell_size < 1:
+        parser.error("--steps, --every, --frame-every and --cell-size must be positive")
+
+    kwargs = {} if args.report else {"report_url": None}
+    model = CityModel(
+        N=10, seed=args.seed, spawn_of_cars=args.spawn_rate, map_name=args.map,
+        spawn_demand=args.demand, admission=args.admission, instrument=False,
+        gridlock_policy=args.gridlock_policy, **kwargs,
+    )
+    model.borrachito_mode = args.borrachito
+    if args.record:
+        model.start_recording(args.record)
+    renderer = writer = None
+    if args.frames:
+        renderer = FrameRenderer(model.city_map, args.cell_size)
+        writer = FrameWriter(args.frames, renderer.size, args.frame_format)
+        writer.write(renderer.render(model), model.current_step)
+    print(f"[RUN] Model ready in {time.perf_counter() - start:.2f}s", file=sys.stderr)
+
+    output = open(args.metrics, "w") if args.metrics else sys.stdout
+    run_start = time.perf_counter()
+    try:
+        while model.current_step < args.steps:
+            # Up to the next multiple of --every
+            batch = min(args.every - model.current_step % args.every, args.steps - model.current_step)
+            if writer is None:
+                model.run_steps(batch)
+            else:
+                for _ in range(batch):
+                    model.run_steps(1)
+                    if model.current_step % args.frame_every == 0:
+                        writer.write(renderer.render(model), model.current_step)
+            output.write(json.dumps(model_metrics(model, time.perf_counter() - run_start)) + "\n")
+            output.flush()
+    except KeyboardInterrupt:
+        print(f"[RUN] Interrupted at step {model.current_step}", file=sys.stderr)
+    finally:
+        model.stop_recording()
+        if writer is not None:
+            writer.close()
+        if output is not sys.stdout:
+            output.close()
+
+    if args.trips:
+        with open(args.trips, "w") as f:
+            json.dump(model.trip_stats.stats(), f, indent=1)
+
+    elapsed = time.perf_counter() - run_start
+    print(f"[RUN] {model.current_step} steps in {elapsed:.1f}s ({model.current_step / elapsed:.1f} steps/s)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
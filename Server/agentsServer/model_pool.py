@@ -0,0 +1,158 @@
+# TC2008B. Sistemas Multiagentes y Gráficas Computacionales
+# Pool of pre-built (and optionally pre-simulated) models, so /init does not wait for construction.
+
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from randomAgents.model import CityModel, REPORT_URL
+from randomAgents.city_map import DEFAULT_MAP
+
+
+def build_model(N=10, seed=42, spawn_of_cars=5, warmup_steps=0, report_url=REPORT_URL, map_name=DEFAULT_MAP,
+                spawn_demand=None, admission="queue", instrument=True):
+    """
+    Builds a model and runs its warm-up steps.
+
+    Args:
+        N: Number of agents in the simulation
+        seed: Random seed for the model
+        spawn_of_cars: Steps between car spawns
+        warmup_steps: Steps to simulate before handing out the model (steady state)
+        report_url: Metrics API of the model (not used during the warm-up)
+        map_name: City map of the model
+        spawn_demand: Vehicles per step offered at each spawn gate (None follows spawn_of_cars)
+        admission: Admission policy of the spawn queues ("queue" or "drop")
+        instrument: Collect the step timing metrics
+
+    Returns:
+        CityModel: Model ready to use
+    """
+    model = CityModel(
+        N=N, seed=seed, spawn_of_cars=spawn_of_cars, report_url=None, map_name=map_name,
+        spawn_demand=spawn_demand, admission=admission, instrument=instrument,
+    )
+    if warmup_steps:
+        model.run_steps(warmup_steps)
+    model.report_url = report_url
+    return model
+
+
+class ModelPool:
+    """
+    Keeps up to `size` ready models for each of the `max_configs` configurations used last.
+
+    get() hands out a ready model when there is one and schedules a replacement,
+    which is built by a background thread. The first request of a configuration
+    builds its model on the spot. When a new configuration is prewarmed and the pool
+    already holds max_configs, the ready models of the least recently used one are
+    dropped (and its pending builds are discarded when they finish).
+    """
+    def __init__(self, size=1, build=build_model, max_configs=4):
+        """
+        Creates a new, empty pool.
+        Args:
+            size: Ready models kept per configuration (0 disables the pool)
+            build: Function that builds a model from a configuration
+            max_configs: Configurations that keep ready models
+        """
+        self.size = size
+        self.build = build
+        self.max_configs = max_configs
+        # Configuration key -> ready models, least recently used first
+        self.ready = OrderedDict()
+        self.pending = {}
+        self.evictions = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-pool")
+
+    @staticmethod
+    def key(config):
+        return tuple(sorted(config.items()))
+
+    def get(self, **config):
+        """
+        Returns a model for the configuration.
+
+        Args:
+            **config: Arguments of the build function
+
+        Returns:
+            tuple: (model, whether it came from the pool)
+        """
+        key = self.key(config)
+
+        with self._lock:
+            models = self.ready.get(key)
+            if models is not None:
+                self.ready.move_to_end(key)
+            model = models.popleft() if models else None
+            hit = model is not None
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if not hit:
+            model = self.build(**config)
+
+        if self.size > 0:
+            self.prewarm(**config)
+        return model, hit
+
+    def prewarm(self, **config):
+        """
+        Schedules the models that the configuration is missing.
+
+        Args:
+            **config: Arguments of the build function
+        """
+        key = self.key(config)
+
+        with self._lock:
+            if key not in self.ready:
+                while self.ready and len(self.ready) >= self.max_configs:
+                    self.ready.popitem(last=False)
+                    self.evictions += 1
+                if self.max_configs <= 0:
+                    return
+                self.ready[key] = deque()
+            self.ready.move_to_end(key)
+
+            missing = self.size - len(self.ready[key]) - self.pending.get(key, 0)
+            if missing <= 0:
+                return
+            self.pending[key] = self.pending.get(key, 0) + missing
+
+        for _ in range(missing):
+            self._executor.submit(self._fill, key, config)
+
+    def _fill(self, key, config):
+        try:
+            model = self.build(**config)
+        except Exception as e:
+            print("[POOL] Error building model:", e)
+            model = None
+
+        with self._lock:
+            self.pending[key] -= 1
+            if not self.pending[key]:
+                del self.pending[key]
+            # The configuration may have been evicted while the model was built
+            if model is not None and key in self.ready:
+                self.ready[key].append(model)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "configs": len(self.ready),
+                "maxConfigs": self.max_configs,
+                "evictions": self.evictions,
+                "ready": sum(len(models) for models in self.ready.values()),
+                "pending": sum(self.pending.values()),
+            }
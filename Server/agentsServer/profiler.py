@@ -0,0 +1,192 @@
+# TC2008B. Sistemas Multiagentes y Gráficas Computacionales
+# Sampling profiler of the running server, used by the /profile route.
+#
+# A background thread reads the stack of every other thread (sys._current_frames)
+# at a fixed interval. Nothing is installed in the interpreter (no sys.setprofile or
+# settrace), so the profiled code runs at full speed, and when no profile is running
+# there is no thread and no cost at all.
+
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+import randomAgents
+
+# Sampling interval and limits of a profile, in seconds
+DEFAULT_INTERVAL = 0.005
+MIN_INTERVAL = 0.001
+MAX_DURATION = 120
+
+# Which threads are sampled: the ones running the simulation (a frame of the
+# randomAgents package on their stack), or every thread that is not waiting
+SCOPES = ("simulation", "all")
+
+SIMULATION_DIRECTORY = os.path.dirname(os.path.abspath(randomAgents.__file__))
+
+# Leaf functions of threads that are blocked (waiting on a lock, a socket or a queue)
+IDLE_FUNCTIONS = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("selectors.py", "select"),
+    ("socket.py", "accept"),
+    ("socket.py", "readinto"),
+    ("socketserver.py", "serve_forever"),
+    ("queue.py", "get"),
+    # Idle worker of a ThreadPoolExecutor (blocked on its work queue)
+    ("thread.py", "_worker"),
+}
+
+
+def frame_label(code):
+    """Name of a function in the collapsed stacks: function (package/file.py:line)."""
+    path = code.co_filename.replace("\\", "/").split("/")
+    return f"{code.co_name} ({'/'.join(path[-2:])}:{code.co_firstlineno})"
+
+
+class Profile:
+    """
+    Stack samples of one profiling run, aggregated as they are taken.
+    """
+    def __init__(self, interval=DEFAULT_INTERVAL, scope="simulation"):
+        """
+        Creates an empty profile.
+        Args:
+            interval: Seconds between two samples
+            scope: Threads to sample, one of SCOPES
+        """
+        if scope not in SCOPES:
+            raise ValueError(f"scope must be one of {', '.join(SCOPES)}")
+        self.interval = max(float(interval), MIN_INTERVAL)
+        self.scope = scope
+        # Collapsed stack (root first) -> samples
+        self.stacks = Counter()
+        self.samples = 0
+        self.ticks = 0
+        self.duration = 0.0
+
+    def sample(self, ignore):
+        """
+        Adds the stacks of the running threads.
+
+        Args:
+            ignore: Thread ids that are never sampled (the sampler itself)
+        """
+        self.ticks += 1
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id in ignore:
+                continue
+
+            leaf = frame.f_code
+            if (os.path.basename(leaf.co_filename), leaf.co_name) in IDLE_FUNCTIONS:
+                continue
+
+            stack = []
+            simulation = False
+            while frame is not None:
+                code = frame.f_code
+                stack.append(frame_label(code))
+                simulation = simulation or code.co_filename.startswith(SIMULATION_DIRECTORY)
+                frame = frame.f_back
+
+            if self.scope == "simulation" and not simulation:
+                continue
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        """Stacks in the collapsed format of flamegraph.pl and speedscope ("a;b;c count" per line)."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def top(self, limit=20):
+        """
+        Functions with the most samples on top of the stack (self time).
+
+        Args:
+            limit: Number of functions returned
+
+        Returns:
+            list: Dicts with the self and total (self plus callees) samples, share and estimated seconds
+        """
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            functions = stack.split(";")
+            own[functions[-1]] += count
+            # A recursive function counts once per sample
+            for function in set(functions):
+                total[function] += count
+
+        # Time of one sample, so that the seconds add up to the sampled time of the threads
+        seconds = self.duration / self.ticks if self.ticks else self.interval
+        return [
+            {
+                "function": function,
+                "selfSamples": count,
+                "selfPercent": round(100 * count / self.samples, 2),
+                "selfSeconds": round(count * seconds, 4),
+                "totalSamples": total[function],
+                "totalPercent": round(100 * total[function] / self.samples, 2),
+            }
+            for function, count in own.most_common(limit)
+        ]
+
+    def summary(self, limit=20):
+        return {
+            "scope": self.scope,
+            "interval": self.interval,
+            "duration": round(self.duration, 4),
+            "ticks": self.ticks,
+            "samples": self.samples,
+            "top": self.top(limit),
+            "collapsed": self.collapsed(),
+        }
+
+
+class Sampler:
+    """
+    Thread that samples the stacks of the process until it is stopped.
+    Only one sampler can run at a time (see try_start).
+    """
+    _running = threading.Lock()
+
+    def __init__(self, profile, ignore=()):
+        """
+        Creates a sampler.
+        Args:
+            profile: Profile that receives the samples
+            ignore: Ids of threads that are not sampled (e.g. the one waiting for the profile)
+        """
+        self.profile = profile
+        self.ignore = set(ignore)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def try_start(self):
+        """Starts sampling. Returns False if another profile is already running."""
+        if not Sampler._running.acquire(blocking=False):
+            return False
+        self._thread.start()
+        return True
+
+    def stop(self):
+        """Stops sampling and waits for the last sample. Returns the profile."""
+        self._stop.set()
+        self._thread.join()
+        Sampler._running.release()
+        return self.profile
+
+    def _run(self):
+        ignore = self.ignore | {threading.get_ident()}
+        start = time.perf_counter()
+        next_sample = start
+        while not self._stop.is_set():
+            self.profile.sample(ignore)
+            next_sample += self.profile.interval
+            # Skip the samples that were missed while the interpreter was busy
+            now = time.perf_counter()
+            if next_sample < now:
+                next_sample = now
+            self._stop.wait(next_sample - now)
+        self.profile.duration = time.perf_counter() - start
@@ -1,10 +1,8 @@
 from mesa.discrete_space import CellAgent, FixedAgent
-import random
 from collections import Counter
 import heapq
 from typing import List, Tuple, Optional
-
-destinations = []
+from .instrumentation import timed, count_search, count_lane_change
 
 def heuristic(cell1, cell2):
     """
@@ -34,14 +32,24 @@ class Car(CellAgent):
         """
         super().__init__(model)
 
-        if not destinations:
+        if not model.destinations:
             raise ValueError("Initialization failed")
 
-        self.destination = random.choice(destinations)
+        self.destination = model.spawn_random.choice(model.destinations)
         self.cell = cell
+        # Step the vehicle entered the network, its spawn gate (set by the spawn queue) and
+        # the length of the shortest route to its destination, for the trip stats
+        self.spawn_step = model.current_step
+        self.origin = None
+        self.free_flow_steps = model.free_flow_steps(cell, self.destination)
         self.path = None
         self.path_index = 0
         self.stuck_counter = 0
+        # Vehicle on the next cell of the route or red light that kept this one from moving
+        # in the current step, and whether this one is in a gridlock (see gridlock.py)
+        self.blocked_by = None
+        self.waiting_light = None
+        self.gridlocked = False
 
         self.crashed = False
         self.crash_timer = 0
@@ -55,6 +63,22 @@ class Car(CellAgent):
         self.max_speed = 1
         self.steps_until_move = 0
 
+        # Nodes expanded by the last aStar search (for benchmarks)
+        self.last_expansions = 0
+
+    @property
+    def cell(self):
+        return self._mesa_cell
+
+    @cell.setter
+    def cell(self, cell):
+        # Keeps the vehicle count of each cell (model.occupancy) up to date
+        if self._mesa_cell is not None:
+            self.model.occupancy[self._mesa_cell.coordinate] -= 1
+        CellAgent.cell.fset(self, cell)
+        if cell is not None:
+            self.model.occupancy[cell.coordinate] += 1
+
     def get_orthogonal_neighbors(self, cell):
         """
         Gets neighboring cells for pathfinding.
@@ -201,6 +225,7 @@ class Car(CellAgent):
 
         return self.get_cell_ahead(from_cell, opposite_dir, distance)
 
+    @timed("astar", on_result=count_search)
     def aStar(self, avoid_cars=False):
         """
         Pathfinding algorithm to find optimal route.
@@ -215,6 +240,7 @@ class Car(CellAgent):
         goal = self.destination
 
         if start.coordinate == goal.coordinate:
+            self.last_expansions = 0
             return [start]
 
         open_set = []
@@ -236,6 +262,7 @@ class Car(CellAgent):
             explored_count += 1
 
             if current_cell.coordinate == goal.coordinate:
+                self.last_expansions = explored_count
                 path = self.reconstruct_path(parent_map, current_cell)
                 return path
 
@@ -244,7 +271,7 @@ class Car(CellAgent):
             neighbors_checked = 0
             neighbors_valid = 0
             all_neighbors = self.get_orthogonal_neighbors(current_cell)
-            random.shuffle(all_neighbors)
+            self.model.routing_random.shuffle(all_neighbors)
 
             for neighbor in all_neighbors:
                 neighbor_coord = neighbor.coordinate
@@ -270,21 +297,15 @@ class Car(CellAgent):
 
                 neighbors_valid += 1
 
-                is_spawn_or_destination = current_cell.coordinate == start.coordinate or any(
-                    isinstance(agent, Destination) for agent in current_cell.agents
-                )
+                is_spawn_or_destination = current_cell.coordinate == start.coordinate or self.model.is_destination(current_cell)
 
                 base_cost = 1
 
                 if is_first_move and current_cell.coordinate == start.coordinate:
-                    road_in_neighbor = None
-                    for agent in neighbor.agents:
-                        if isinstance(agent, Road):
-                            road_in_neighbor = agent
-                            break
+                    road_in_neighbor = self.model.road_direction(neighbor)
 
                     if road_in_neighbor:
-                        congestion = self.calculate_lane_congestion(neighbor, road_in_neighbor.direction)
+                        congestion = self.calculate_lane_congestion(neighbor, road_in_neighbor)
                         base_cost += congestion * 0.5
 
                 if not is_spawn_or_destination and self.is_lane_change(current_cell, neighbor):
@@ -298,14 +319,15 @@ class Car(CellAgent):
                     h = heuristic(neighbor, goal)
 
                     if is_spawn_or_destination:
-                        random_factor = random.uniform(0, 0.3)
+                        random_factor = self.model.routing_random.uniform(0, 0.3)
                     else:
-                        random_factor = random.uniform(0, 0.5)
+                        random_factor = self.model.routing_random.uniform(0, 0.5)
                     f_score[neighbor_coord] = tentative_g + h + random_factor
 
                     if neighbor_coord not in [item[1] for item in open_set]:
                         heapq.heappush(open_set, (f_score[neighbor_coord], neighbor_coord, neighbor))
 
+        self.last_expansions = explored_count
         return None
 
     def get_direction(self, from_cell, to_cell):
@@ -391,8 +413,8 @@ class Car(CellAgent):
             if not next_cell:
                 break
 
-            car_count = sum(1 for agent in next_cell.agents if isinstance(agent, (Car, Borrachito)))
-            congestion += car_count
+            # Vehicles in the cell (model.occupancy is kept up to date by Car.cell)
+            congestion += int(self.model.occupancy[next_cell.coordinate])
 
             for agent in next_cell.agents:
                 if isinstance(agent, Traffic_Light) and not agent.state:
@@ -421,30 +443,20 @@ class Car(CellAgent):
 
     def are_in_same_lane(self, cell1, cell2):
         """
-        Verifica si dos celdas están en el mismo carril (misma dirección de Road).
+        Verifica si dos celdas están en el mismo carril (misma dirección de calle).
 
         Args:
             cell1: Primera celda
             cell2: Segunda celda
 
         Returns:
-            bool: True si ambas celdas tienen Road agents con la misma dirección
+            bool: True si ambas celdas son calles con la misma dirección
         """
-        road1 = None
-        road2 = None
-
-        for agent in cell1.agents:
-            if isinstance(agent, Road):
-                road1 = agent
-                break
-
-        for agent in cell2.agents:
-            if isinstance(agent, Road):
-                road2 = agent
-                break
+        road1 = self.model.road_direction(cell1)
+        road2 = self.model.road_direction(cell2)
 
         if road1 and road2:
-            return road1.direction == road2.direction
+            return road1 == road2
 
         return False
 
@@ -475,14 +487,14 @@ class Car(CellAgent):
         for nx, ny in neighbor_coords:
             neighbor_cell = self.get_cell_at(nx, ny)
             if neighbor_cell:
-                for agent in neighbor_cell.agents:
-                    if isinstance(agent, Road):
-                        neighbor_directions.add(agent.direction)
+                direction = self.model.road_direction(neighbor_cell)
+                if direction:
+                    neighbor_directions.add(direction)
 
         # Also check current cell
-        for agent in cell.agents:
-            if isinstance(agent, Road):
-                neighbor_directions.add(agent.direction)
+        direction = self.model.road_direction(cell)
+        if direction:
+            neighbor_directions.add(direction)
 
         # An intersection has roads with perpendicular directions
         # Check for Up/Down with Left/Right combinations
@@ -510,20 +522,16 @@ class Car(CellAgent):
         if movement_direction in ["UpRight", "UpLeft", "DownRight", "DownLeft"]:
             return True
 
-        road_agent = None
-        for agent in from_cell.agents:
-            if isinstance(agent, Road):
-                road_agent = agent
-                break
+        road_direction = self.model.road_direction(from_cell)
 
-        if not road_agent:
+        if not road_direction:
             return False
 
         if movement_direction in ["Left", "Right"]:
-            if road_agent.direction in ["Up", "Down"]:
+            if road_direction in ["Up", "Down"]:
                 return True
         elif movement_direction in ["Up", "Down"]:
-            if road_agent.direction in ["Left", "Right"]:
+            if road_direction in ["Left", "Right"]:
                 return True
 
         return False
@@ -561,6 +569,7 @@ class Car(CellAgent):
 
         return True
 
+    @timed("lane_change", on_result=count_lane_change)
     def try_lane_change(self):
         """
         Finds alternative lane if available.
@@ -591,11 +600,11 @@ class Car(CellAgent):
             if not adjacent_cell:
                 continue
 
-            has_road = any(isinstance(agent, Road) for agent in adjacent_cell.agents)
+            has_road = self.model.road_direction(adjacent_cell) is not None
             if not has_road:
                 continue
 
-            has_obstacle = any(isinstance(agent, Obstacle) for agent in adjacent_cell.agents)
+            has_obstacle = self.model.is_obstacle(adjacent_cell)
             if has_obstacle:
                 continue
 
@@ -622,26 +631,12 @@ class Car(CellAgent):
             bool: True if accessible
         """
         if goal and cell.coordinate == goal.coordinate:
-            has_obstacle = any(isinstance(agent, Obstacle) for agent in cell.agents)
-            return not has_obstacle
-
-        road_agent = None
-        traffic_light = None
-        has_obstacle = False
-        has_destination = False
-        has_car = False
-
-        for agent in cell.agents:
-            if isinstance(agent, Road):
-                road_agent = agent
-            elif isinstance(agent, Traffic_Light):
-                traffic_light = agent
-            elif isinstance(agent, Obstacle):
-                has_obstacle = True
-            elif isinstance(agent, Destination):
-                has_destination = True
-            elif isinstance(agent, Car) and check_cars:
-                has_car = True
+            return not self.model.is_obstacle(cell)
+
+        road_direction = self.model.road_direction(cell)
+        has_obstacle = self.model.is_obstacle(cell)
+        has_destination = self.model.is_destination(cell)
+        has_car = check_cars and any(isinstance(agent, Car) for agent in cell.agents)
 
         if has_obstacle:
             return False
@@ -655,15 +650,15 @@ class Car(CellAgent):
             else:
                 return False
 
-        if not road_agent:
+        if not road_direction:
             return False
 
         if direction_from_parent:
             if from_cell:
-                from_has_road = any(isinstance(agent, Road) for agent in from_cell.agents)
-                from_has_destination = any(isinstance(agent, Destination) for agent in from_cell.agents)
+                from_has_road = self.model.road_direction(from_cell) is not None
+                from_has_destination = self.model.is_destination(from_cell)
 
-                spawn_points = [(0, 0), (35, 0), (0, 34), (35, 34)]
+                spawn_points = self.model.spawn_point_set
                 is_spawn_point = from_cell.coordinate in spawn_points
 
                 if is_spawn_point:
@@ -686,16 +681,16 @@ class Car(CellAgent):
                     "Right": "Left"
                 }
 
-                vertical_opposite = opposite_directions.get(vertical_component) == road_agent.direction
-                horizontal_opposite = opposite_directions.get(horizontal_component) == road_agent.direction
+                vertical_opposite = opposite_directions.get(vertical_component) == road_direction
+                horizontal_opposite = opposite_directions.get(horizontal_component) == road_direction
 
                 if vertical_opposite or horizontal_opposite:
                     return False
 
-                if vertical_component == road_agent.direction:
+                if vertical_component == road_direction:
                     return True
 
-                if horizontal_component == road_agent.direction:
+                if horizontal_component == road_direction:
                     return True
 
                 return True
@@ -707,16 +702,17 @@ class Car(CellAgent):
                 "Right": "Left"
             }
 
-            if opposite_directions.get(direction_from_parent) == road_agent.direction:
+            if opposite_directions.get(direction_from_parent) == road_direction:
                 return False
 
-            if road_agent.direction == direction_from_parent:
+            if road_direction == direction_from_parent:
                 return True
 
             return True
 
         return True
 
+    @timed("vehicle_move")
     def move(self):
         """
         Moves agent along calculated path.
@@ -734,12 +730,10 @@ class Car(CellAgent):
         dest_coord = self.destination.coordinate
 
         if current_coord == dest_coord:
-            self.model.cars_arrived += 1
-
-            if self.cell is not None:
-                self.cell.remove_agent(self)
+            self.model.vehicle_arrived(self)
 
-            self.model.agents.remove(self)
+            # Deregisters the agent from the model and removes it from its cell
+            self.remove()
             return
 
         if self.path is None:
@@ -764,7 +758,8 @@ class Car(CellAgent):
                 traffic_light_blocking = agent
                 break
 
-        if self.stuck_counter >= 5:
+        # In a gridlock the model resolves the blockage (see gridlock.py)
+        if self.stuck_counter >= 5 and not self.gridlocked:
             if not (traffic_light_blocking and not traffic_light_blocking.state):
                 alternative_lane = self.try_lane_change()
                 if alternative_lane:
@@ -807,11 +802,13 @@ class Car(CellAgent):
             return
 
         if traffic_light_blocking and not traffic_light_blocking.state:
+            self.waiting_light = traffic_light_blocking
             self.stuck_counter += 1
             return
 
-        has_car = any(isinstance(agent, Car) for agent in next_cell.agents)
-        if has_car:
+        blocker = next((agent for agent in next_cell.agents if isinstance(agent, Car)), None)
+        if blocker is not None:
+            self.blocked_by = blocker
             self.stuck_counter += 1
             return
 
@@ -819,7 +816,7 @@ class Car(CellAgent):
         if future_cell:
             has_car_ahead = any(isinstance(agent, Car) for agent in future_cell.agents)
             if has_car_ahead:
-                if random.random() < 0.3:
+                if self.model.driver_random.random() < 0.3:
                     self.stuck_counter += 1
                     return
 
@@ -832,6 +829,8 @@ class Car(CellAgent):
         """ 
         Determines the new direction it will take, and then moves
         """
+        self.blocked_by = None
+        self.waiting_light = None
         self.move()
         
 
@@ -853,6 +852,7 @@ class Traffic_Light(FixedAgent):
         self.state = state
         self.timeToChange = timeToChange
 
+    @timed("lights")
     def step(self):
         """
         To change the state (green or red) of the traffic light in case you consider the time to change of each traffic light.
@@ -860,52 +860,6 @@ class Traffic_Light(FixedAgent):
         if self.model.current_step % self.timeToChange == 0:
             self.state = not self.state
 
-class Destination(FixedAgent):
-    """
-    Destination agent. Where each car should go.
-    """
-    def __init__(self, model, cell):
-        """
-        Creates a new destination agent
-        Args:
-            model: Model reference for the agent
-            cell: The initial position of the agent
-        """
-        super().__init__(model)
-        self.cell = cell
-        destinations.append(self.cell)
-
-
-class Obstacle(FixedAgent):
-    """
-    Obstacle agent. Just to add obstacles to the grid.
-    """
-    def __init__(self, model, cell):
-        """
-        Creates a new obstacle.
-        
-        Args:
-            model: Model reference for the agent
-            cell: The initial position of the agent
-        """
-        super().__init__(model)
-        self.cell = cell
-
-class Road(FixedAgent):
-    """
-    Road agent. Determines where the cars can move, and in which direction.
-    """
-    def __init__(self, model, cell, direction= "Left"):
-        """
-        Creates a new road.
-        Args:
-            model: Model reference for the agent
-            cell: The initial position of the agent
-        """
-        super().__init__(model)
-        self.cell = cell
-        self.direction = direction
-
 class Borrachito(Car):
     """
     Special agent with different behavior.
@@ -941,6 +895,7 @@ class Borrachito(Car):
         """
         return super().is_walkable(cell, direction_from_parent, goal, allow_lane_change, check_cars, from_cell)
 
+    @timed("lane_change", on_result=count_lane_change)
     def try_lane_change(self):
         """
         Borrachito's aggressive lane change - less safety checks.
@@ -954,16 +909,12 @@ class Borrachito(Car):
             current_x, current_y = current_cell.coordinate
 
             # Obtener dirección actual del road
-            current_road = None
-            for agent in current_cell.agents:
-                if isinstance(agent, Road):
-                    current_road = agent
-                    break
+            current_road = self.model.road_direction(current_cell)
 
             if not current_road:
                 return None
 
-            movement_direction = current_road.direction
+            movement_direction = current_road
         else:
             current_cell = self.cell
             next_in_path = self.path[self.path_index + 1]
@@ -982,7 +933,7 @@ class Borrachito(Car):
         ]
 
         # Aleatorizar para comportamiento impredecible
-        random.shuffle(adjacent_coords)
+        self.model.driver_random.shuffle(adjacent_coords)
 
         for adj_x, adj_y in adjacent_coords:
             adjacent_cell = self.get_cell_at(adj_x, adj_y)
@@ -990,11 +941,11 @@ class Borrachito(Car):
             if not adjacent_cell:
                 continue
 
-            has_road = any(isinstance(agent, Road) for agent in adjacent_cell.agents)
+            has_road = self.model.road_direction(adjacent_cell) is not None
             if not has_road:
                 continue
 
-            has_obstacle = any(isinstance(agent, Obstacle) for agent in adjacent_cell.agents)
+            has_obstacle = self.model.is_obstacle(adjacent_cell)
             if has_obstacle:
                 continue
 
@@ -1019,6 +970,7 @@ class Borrachito(Car):
 
         return None
 
+    @timed("vehicle_move")
     def move(self):
         """
         Moves agent with alternate behavior - MODO BORRACHITO: Sigue calles pero cambia mucho de carril.
@@ -1037,10 +989,9 @@ class Borrachito(Car):
         dest_coord = self.destination.coordinate
 
         if current_coord == dest_coord:
-            self.model.cars_arrived += 1
-            if self.cell is not None:
-                self.cell.remove_agent(self)
-            self.model.agents.remove(self)
+            self.model.vehicle_arrived(self)
+            # Deregisters the agent from the model and removes it from its cell
+            self.remove()
             return
 
         if self.path is None:
@@ -1058,9 +1009,9 @@ class Borrachito(Car):
                 return
 
         # BORRACHITO: Intenta cambiar de carril ocasionalmente antes de recalcular
-        if self.stuck_counter >= 2:  # Espera un poco más antes de cambiar
+        if self.stuck_counter >= 2 and not self.gridlocked:  # Espera un poco más antes de cambiar
             # 30% de probabilidad de intentar cambiar de carril
-            if random.random() < 0.3:
+            if self.model.driver_random.random() < 0.3:
                 alternative_lane = self.try_lane_change()
                 if alternative_lane:
                     self.move_to(alternative_lane)
@@ -1080,7 +1031,7 @@ class Borrachito(Car):
 
         # BORRACHITO: También intenta cambiar de carril aleatoriamente (10% de probabilidad)
         # incluso cuando no está bloqueado, para comportamiento ocasionalmente errático
-        if random.random() < 0.1 and self.path and self.path_index < len(self.path) - 1:
+        if self.model.driver_random.random() < 0.1 and self.path and self.path_index < len(self.path) - 1:
             alternative_lane = self.try_lane_change()
             if alternative_lane:
                 self.move_to(alternative_lane)
@@ -1089,7 +1040,7 @@ class Borrachito(Car):
                 return
 
         # MODO BORRACHITO: 20% de probabilidad de movimiento errático diagonal (reducido de 80%)
-        borrachito_mode = random.random() < 0.2
+        borrachito_mode = self.model.driver_random.random() < 0.2
 
         if borrachito_mode:
             # Movimientos diagonales y ortogonales aleatorios - SOLO adyacentes
@@ -1108,7 +1059,7 @@ class Borrachito(Car):
             ]
 
             # Barajar para movimientos impredecibles
-            random.shuffle(adjacent_offsets)
+            self.model.driver_random.shuffle(adjacent_offsets)
 
             moved = False
             for dx, dy in adjacent_offsets:
@@ -1118,9 +1069,9 @@ class Borrachito(Car):
 
                 if target_cell:
                     # Verificar si tiene camino (road) y NO tiene obstáculos
-                    has_road = any(isinstance(agent, Road) for agent in target_cell.agents)
-                    has_obstacle = any(isinstance(agent, Obstacle) for agent in target_cell.agents)
-                    has_destination = any(isinstance(agent, Destination) for agent in target_cell.agents)
+                    has_road = self.model.road_direction(target_cell) is not None
+                    has_obstacle = self.model.is_obstacle(target_cell)
+                    has_destination = self.model.is_destination(target_cell)
 
                     # No moverse a obstáculos ni a destinos que no sean el propio
                     if has_obstacle:
@@ -1141,11 +1092,14 @@ class Borrachito(Car):
                             # Solo chocar si están en el mismo carril
                             if self.are_in_same_lane(self.cell, target_cell):
                                 # Mayor probabilidad de choque en modo borrachito
-                                crash_chance = random.random()
+                                crash_chance = self.model.driver_random.random()
                                 if crash_chance < 0.5:  # 50% de probabilidad de choque
                                     self.crashed = True
                                     self.crash_timer = 0
                                     self.original_position = self.cell
+                                    self.model.crashes += 1
+                                    if self.model.metrics is not None:
+                                        self.model.metrics.count("crashes")
 
                                     other_car.crashed = True
                                     other_car.crash_timer = 0
@@ -1166,7 +1120,7 @@ class Borrachito(Car):
 
             if moved:
                 # Resetear el path ocasionalmente para más caos
-                if random.random() < 0.4:
+                if self.model.driver_random.random() < 0.4:
                     self.path = None
                 self.stuck_counter = 0
                 return
@@ -1208,11 +1162,14 @@ class Borrachito(Car):
         if other_car:
             # Solo chocar si las celdas son realmente adyacentes Y están en el mismo carril
             if self.are_cells_adjacent(self.cell, next_cell) and self.are_in_same_lane(self.cell, next_cell):
-                crash_chance = random.random()
+                crash_chance = self.model.driver_random.random()
                 if crash_chance < 0.5:  # Mayor probabilidad de choque
                     self.crashed = True
                     self.crash_timer = 0
                     self.original_position = self.cell
+                    self.model.crashes += 1
+                    if self.model.metrics is not None:
+                        self.model.metrics.count("crashes")
 
                     if isinstance(other_car, Borrachito):
                         other_car.crashed = True
@@ -1225,10 +1182,12 @@ class Borrachito(Car):
 
                     return
                 else:
+                    self.blocked_by = other_car
                     self.stuck_counter += 1
                     return
             else:
                 # No están adyacentes o no están en el mismo carril, solo se queda bloqueado
+                self.blocked_by = other_car
                 self.stuck_counter += 1
                 return
 
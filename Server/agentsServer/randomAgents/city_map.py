@@ -0,0 +1,526 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from functools import cached_property
+
+import numpy as np
+
+# Compiled city maps
+#
+# A map text file is compiled once into plain arrays and cached in CACHE_DIRECTORY as a
+# directory <digest>.v<COMPILED_VERSION> with one .npy file per array, where digest is the
+# sha1 of the map content. Editing a map changes its digest, so the stale compiled map is
+# simply never read again.
+#
+# The cached arrays are memory-mapped read-only: loading a map costs the same for any map
+# size, and every process that loads it (server workers, ensemble workers)
+# shares the same pages of the OS file cache instead of holding its own copy.
+# The models do not build an agent per road, obstacle or destination cell either: the
+# vehicles read these cells from the kind and direction arrays (see CityModel.road_direction).
+#
+# The distance field of a destination (moves along the road graph from every node to it) is
+# not compiled with the map: it is computed the first time it is used, and written next to
+# the arrays as distances_<destination>.npy so that the other processes map it too. Maps
+# with hundreds of destinations only pay for the ones their vehicles actually drive to.
+#
+# All the grid arrays are indexed [x, y] with grid coordinates (y = 0 is the last line of
+# the text file), the same coordinates used by the mesa grid.
+MAP_DIRECTORY = os.path.join(os.path.dirname(__file__), "city_files")
+CACHE_DIRECTORY = os.path.join(MAP_DIRECTORY, ".cache")
+DEFAULT_MAP = "2025_base"
+COMPILED_VERSION = 4
+
+# Cell kinds
+EMPTY, ROAD, LIGHT, OBSTACLE, DESTINATION = range(5)
+
+# Road directions, index 0 means no direction
+DIRECTIONS = (None, "Up", "Down", "Left", "Right")
+DIRECTION_CODES = {name: code for code, name in enumerate(DIRECTIONS) if name}
+DIRECTION_VECTORS = {"Up": (0, 1), "Down": (0, -1), "Left": (-1, 0), "Right": (1, 0)}
+OPPOSITE_DIRECTIONS = {"Up": "Down", "Down": "Up", "Left": "Right", "Right": "Left"}
+
+ROAD_GLYPHS = ("v", "^", ">", "<")
+
+LIGHT_SPEC_DTYPE = np.dtype([
+    ("x", "<i2"),
+    ("y", "<i2"),
+    ("state", "u1"),
+    ("time_to_change", "<i4"),
+])
+
+_maps = {}
+_maps_lock = threading.Lock()
+
+
+def available_maps():
+    """
+    Names of the maps shipped in city_files.
+
+    Returns:
+        list: Map names (file names without the .txt extension)
+    """
+    return sorted(name[:-4] for name in os.listdir(MAP_DIRECTORY) if name.endswith(".txt"))
+
+
+def map_path(name):
+    """
+    Path of a map file.
+
+    Args:
+        name: Map name, see available_maps()
+
+    Returns:
+        str: Path of the text file
+    """
+    if name not in available_maps():
+        raise ValueError(f"Unknown map {name!r}, available maps: {', '.join(available_maps())}")
+    return os.path.join(MAP_DIRECTORY, name + ".txt")
+
+
+class CityMap:
+    """
+    Compiled form of a city map: direction grid, cell kinds, traffic light specs,
+    destinations, spawn points and the road graph.
+    """
+    ARRAYS = (
+        "kind", "direction", "road_mask", "lights", "destinations", "spawn_points", "nodes",
+        "node_index", "graph_indptr", "graph_indices",
+    )
+
+    def __init__(self, name, digest, width, height, **arrays):
+        """
+        Creates a compiled map from its arrays.
+        Args:
+            name: Map name
+            digest: sha1 of the map content
+            width: Grid width
+            height: Grid height
+            **arrays: The arrays listed in CityMap.ARRAYS
+        """
+        self.name = name
+        self.digest = digest
+        self.width = width
+        self.height = height
+        for key in self.ARRAYS:
+            setattr(self, key, arrays[key])
+        # Directory of the compiled map, where the distance fields are cached (None: memory only)
+        self.path = None
+        # Destination index -> distance field
+        self._fields = {}
+        self._fields_lock = threading.Lock()
+
+    @cached_property
+    def reverse_graph(self):
+        """Predecessors of every node, as CSR (indptr, indices)."""
+        n = len(self.nodes)
+        tails = np.repeat(np.arange(n, dtype=np.int32), np.diff(self.graph_indptr))
+        reverse_indices = tails[np.argsort(self.graph_indices, kind="stable")]
+        reverse_indptr = np.zeros(n + 1, dtype=np.int32)
+        np.cumsum(np.bincount(self.graph_indices, minlength=n), out=reverse_indptr[1:])
+        return reverse_indptr, reverse_indices
+
+    def distance_field(self, destination):
+        """
+        Moves along the road graph from every node to a destination, computed on first use.
+
+        Args:
+            destination: Index of the destination in self.destinations
+
+        Returns:
+            np.ndarray: uint16 (uint32 on huge maps) per node, the largest value of the dtype
+            if the node cannot reach the destination
+        """
+        field = self._fields.get(destination)
+        if field is not None:
+            return field
+
+        with self._fields_lock:
+            field = self._fields.get(destination)
+            if field is None:
+                field = self._cached_field(destination)
+            if field is None:
+                x, y = self.destinations[destination].tolist()
+                field = _distance_field(*self.reverse_graph, self.node_index[x, y])
+                field = self._save_field(destination, field)
+            self._fields[destination] = field
+        return field
+
+    def _field_path(self, destination):
+        return os.path.join(self.path, f"distances_{destination}.npy")
+
+    def _cached_field(self, destination):
+        if self.path is None:
+            return None
+        try:
+            return np.load(self._field_path(destination), mmap_mode="r", allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+
+    def _save_field(self, destination, field):
+        """Writes a distance field to the compiled map and maps it back (written under a temporary name)."""
+        if self.path is None:
+            return field
+        path = self._field_path(destination)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.save(f, field)
+            os.replace(tmp_path, path)
+            return np.load(path, mmap_mode="r", allow_pickle=False)
+        except (OSError, ValueError) as e:
+            # A read-only cache still works, every process keeps its own copy
+            print(f"[MAP] Could not cache distance field {path}:", e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return field
+
+    def cells(self):
+        """
+        Iterates over the non-empty cells in the order of the text file (line by line,
+        left to right), the order of the static layers served by the API.
+
+        Returns:
+            Iterator[tuple]: (x, y, kind, direction name)
+        """
+        rows, xs = np.nonzero(self.kind.T[::-1])
+        ys = self.height - 1 - rows
+        for x, y in zip(xs.tolist(), ys.tolist()):
+            yield x, y, int(self.kind[x, y]), DIRECTIONS[self.direction[x, y]]
+
+    def successors(self, x, y):
+        """
+        Cells reachable in one orthogonal move from a cell of the road graph.
+
+        Args:
+            x: X coordinate
+            y: Y coordinate
+
+        Returns:
+            np.ndarray: (n, 2) coordinates
+        """
+        node = self.node_index[x, y]
+        if node < 0:
+            return np.zeros((0, 2), dtype=self.nodes.dtype)
+        return self.nodes[self.graph_indices[self.graph_indptr[node]:self.graph_indptr[node + 1]]]
+
+    def distance_to_destination(self, destination, x, y):
+        """
+        Length of the shortest path along the road graph from a cell to a destination
+        (see distance_field).
+
+        Args:
+            destination: Index of the destination in self.destinations
+            x: X coordinate
+            y: Y coordinate
+
+        Returns:
+            int: Moves, or None if the cell is not a road or cannot reach the destination
+        """
+        node = self.node_index[x, y]
+        if node < 0:
+            return None
+        field = self.distance_field(destination)
+        distance = int(field[node])
+        return None if distance == np.iinfo(field.dtype).max else distance
+
+    def save(self, path):
+        """
+        Writes the compiled map as a directory of .npy files. The directory is written under
+        a temporary name and renamed, so concurrent loads never see half a map.
+        """
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(tmp_path)
+        try:
+            for key in self.ARRAYS:
+                np.save(os.path.join(tmp_path, key + ".npy"), np.ascontiguousarray(getattr(self, key)))
+            with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+                json.dump({"digest": self.digest, "width": self.width, "height": self.height}, f)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # Another process saved the same map first
+                if not os.path.isdir(path):
+                    raise
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.path = path
+
+    @classmethod
+    def load(cls, path, name):
+        """Memory-maps (read-only) a compiled map written by save()."""
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+
+        arrays = {}
+        for key in cls.ARRAYS:
+            array_path = os.path.join(path, key + ".npy")
+            try:
+                arrays[key] = np.load(array_path, mmap_mode="r", allow_pickle=False)
+            except ValueError:
+                # Empty arrays (e.g. a map without traffic lights) cannot be mapped
+                arrays[key] = np.load(array_path, allow_pickle=False)
+        city_map = cls(name, meta["digest"], meta["width"], meta["height"], **arrays)
+        city_map.path = path
+        return city_map
+
+
+def _light_direction(lines, r, c):
+    """Direction of the road under a traffic light, taken from the first road next to it."""
+    for nr, nc in ((r - 1, c), (r + 1, c), (r, c - 1), (r, c + 1)):
+        if 0 <= nr < len(lines) and 0 <= nc < len(lines[nr]) and lines[nr][nc] in ROAD_GLYPHS:
+            return lines[nr][nc]
+    return None
+
+
+def _nearest_road(road_mask, x, y):
+    roads = np.argwhere(road_mask)
+    if not len(roads):
+        return None
+    distances = np.abs(roads[:, 0] - x) + np.abs(roads[:, 1] - y)
+    return tuple(roads[np.argmin(distances)].tolist())
+
+
+def _distance_field(reverse_indptr, reverse_indices, source):
+    """
+    Breadth-first search from a destination over the reversed road graph, a whole level
+    at a time.
+
+    Args:
+        reverse_indptr: Reversed road graph (CSR offsets)
+        reverse_indices: Reversed road graph (CSR targets)
+        source: Node of the destination
+
+    Returns:
+        np.ndarray: Moves from every node to the destination, the largest value of the dtype if unreachable
+    """
+    distances = np.full(len(reverse_indptr) - 1, -1, dtype=np.int32)
+    distances[source] = 0
+    frontier = np.array([source])
+    level = 0
+    while len(frontier):
+        level += 1
+        starts = reverse_indptr[frontier]
+        counts = reverse_indptr[frontier + 1] - starts
+        # Predecessors of the whole frontier
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        frontier = np.unique(reverse_indices[offsets])
+        frontier = frontier[distances[frontier] < 0]
+        distances[frontier] = level
+
+    dtype = np.uint16 if level < np.iinfo(np.uint16).max else np.uint32
+    field = distances.astype(dtype)
+    field[distances < 0] = np.iinfo(dtype).max
+    return field
+
+
+def compile_map(name, text, digest):
+    """
+    Compiles the text of a map. Works on whole arrays, so maps of millions of cells
+    compile in seconds.
+
+    Args:
+        name: Map name
+        text: Content of the map file
+        digest: sha1 of the content
+
+    Returns:
+        CityMap: Compiled map
+    """
+    with open(os.path.join(MAP_DIRECTORY, "mapDictionary.json")) as f:
+        dataDictionary = json.load(f)
+
+    lines = text.splitlines()
+    # Trailing empty lines are not part of the grid
+    while lines and not lines[-1]:
+        lines.pop()
+
+    width = max(len(line) for line in lines)
+    height = len(lines)
+
+    # Glyphs as bytes, one row per line (row 0 is the top of the map, y = height - 1)
+    glyphs = np.full((height, width), ord(" "), dtype=np.uint8)
+    for r, line in enumerate(lines):
+        glyphs[r, :len(line)] = np.frombuffer(line.encode("ascii", errors="replace"), dtype=np.uint8)
+
+    kind_table = np.zeros(256, dtype=np.uint8)
+    direction_table = np.zeros(256, dtype=np.uint8)
+    for glyph in ROAD_GLYPHS:
+        kind_table[ord(glyph)] = ROAD
+        direction_table[ord(glyph)] = DIRECTION_CODES[dataDictionary[glyph]]
+    kind_table[ord("S")] = kind_table[ord("s")] = LIGHT
+    kind_table[ord("#")] = OBSTACLE
+    kind_table[ord("D")] = DESTINATION
+
+    # Rows to [x, y]
+    kind = np.ascontiguousarray(kind_table[glyphs][::-1].T)
+    direction = np.ascontiguousarray(direction_table[glyphs][::-1].T)
+
+    # Traffic lights and destinations, in the order of the text file
+    lights = []
+    for r, c in np.argwhere(kind_table[glyphs] == LIGHT).tolist():
+        glyph = lines[r][c]
+        road_glyph = _light_direction(lines, r, c)
+        x, y = c, height - r - 1
+        direction[x, y] = DIRECTION_CODES[dataDictionary[road_glyph] if road_glyph else "Left"]
+        lights.append((x, y, glyph == "s", int(dataDictionary[glyph])))
+
+    destination_rows = np.argwhere(glyphs == ord("D"))
+    destinations = np.stack([destination_rows[:, 1], height - 1 - destination_rows[:, 0]], axis=1)
+
+    road_mask = (kind == ROAD) | (kind == LIGHT)
+
+    # Spawn points: the road cell closest to each corner of the map
+    spawn_points = []
+    for corner in ((0, 0), (width - 1, 0), (0, height - 1), (width - 1, height - 1)):
+        point = _nearest_road(road_mask, *corner)
+        if point is not None and point not in spawn_points:
+            spawn_points.append(point)
+
+    # Road graph: roads, traffic lights and destinations. A road cell connects to its
+    # orthogonal neighbours unless the move goes against the neighbour's direction;
+    # destinations are only entered, never left.
+    nodes = np.argwhere(road_mask | (kind == DESTINATION)).astype(np.int16)
+    node_index = np.full((width, height), -1, dtype=np.int32)
+    node_index[nodes[:, 0], nodes[:, 1]] = np.arange(len(nodes), dtype=np.int32)
+
+    # Padded copies, so the neighbour in every direction is a shifted view
+    padded_index = np.pad(node_index, 1, constant_values=-1)
+    padded_road = np.pad(road_mask, 1)
+    padded_direction = np.pad(direction, 1)
+
+    sources, moves, targets = [], [], []
+    for i, (move, (dx, dy)) in enumerate(DIRECTION_VECTORS.items()):
+        window = (slice(1 + dx, 1 + dx + width), slice(1 + dy, 1 + dy + height))
+        target = padded_index[window]
+        against = padded_road[window] & (padded_direction[window] == DIRECTION_CODES[OPPOSITE_DIRECTIONS[move]])
+        edges = road_mask & (target >= 0) & ~against
+        sources.append(node_index[edges])
+        targets.append(target[edges])
+        moves.append(np.full(int(edges.sum()), i, dtype=np.int8))
+
+    sources = np.concatenate(sources)
+    targets = np.concatenate(targets)
+    order = np.lexsort((np.concatenate(moves), sources))
+
+    graph_indptr = np.zeros(len(nodes) + 1, dtype=np.int32)
+    np.cumsum(np.bincount(sources, minlength=len(nodes)), out=graph_indptr[1:])
+    graph_indices = targets[order].astype(np.int32)
+    destinations = destinations.astype(np.int16).reshape(-1, 2)
+
+    return CityMap(
+        name, digest, width, height,
+        kind=kind,
+        direction=direction,
+        road_mask=road_mask,
+        lights=np.array(lights, dtype=LIGHT_SPEC_DTYPE),
+        destinations=destinations,
+        spawn_points=np.array(spawn_points, dtype=np.int16).reshape(-1, 2),
+        nodes=nodes,
+        node_index=node_index,
+        graph_indptr=graph_indptr,
+        graph_indices=graph_indices,
+    )
+
+
+def compiled_path(digest):
+    return os.path.join(CACHE_DIRECTORY, f"{digest}.v{COMPILED_VERSION}")
+
+
+def load_map(name=DEFAULT_MAP, use_cache=True):
+    """
+    Returns the compiled form of a map. Compiled maps are kept in memory and on disk,
+    keyed by the digest of the map content; a map is only compiled when it changed.
+
+    Args:
+        name: Map name, see available_maps()
+        use_cache: Read and write the compiled maps cache (False always compiles)
+
+    Returns:
+        CityMap: Compiled map
+    """
+    with open(map_path(name)) as f:
+        text = f.read()
+    digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    if not use_cache:
+        return compile_map(name, text, digest)
+
+    city_map = _maps.get((name, digest))
+    if city_map is not None:
+        return city_map
+
+    path = compiled_path(digest)
+    city_map = None
+    if os.path.isdir(path):
+        try:
+            city_map = CityMap.load(path, name)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"[MAP] Ignoring compiled map {path}:", e)
+
+    if city_map is None:
+        city_map = compile_map(name, text, digest)
+        try:
+            os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+            city_map.save(path)
+        except OSError as e:
+            # A read-only checkout still works, it just compiles every time
+            print(f"[MAP] Could not cache compiled map {path}:", e)
+
+    with _maps_lock:
+        _maps[(name, digest)] = city_map
+    return city_map
+
+
+def benchmark(names, repeat=5):
+    """
+    Measures compiling, loading and model construction times of maps.
+
+    Args:
+        names: Maps to measure
+        repeat: Runs of each measure (the best one is kept)
+
+    Returns:
+        list: One dict per map, times in milliseconds
+    """
+    from .model import CityModel
+
+    def best(function):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            times.append((time.perf_counter() - start) * 1000)
+        return min(times)
+
+    results = []
+    for name in names:
+        path = compiled_path(load_map(name).digest)
+        _maps.clear()
+        results.append({
+            "map": name,
+            "compile_ms": best(lambda: load_map(name, use_cache=False)),
+            "load_ms": best(lambda: (_maps.clear(), CityMap.load(path, name))),
+            "construct_ms": best(lambda: CityModel(N=0, map_name=name, report_url=None)),
+        })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile the city maps and measure model construction")
+    parser.add_argument("maps", nargs="*", help="Maps to use (all by default)")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each measure")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    results = benchmark(args.maps or available_maps(), args.repeat)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'map':<12}{'compile ms':>12}{'load ms':>10}{'construct ms':>14}")
+        for result in results:
+            print(f"{result['map']:<12}{result['compile_ms']:>12.2f}{result['load_ms']:>10.2f}{result['construct_ms']:>14.2f}")
@@ -0,0 +1,232 @@
+from .instrumentation import timed
+
+# Gridlock detection on the waits-for graph.
+#
+# A vehicle that cannot move because another vehicle is on the next cell of its route
+# waits for that vehicle (Car.blocked_by, set during its move). Every vehicle waits for
+# at most one other, so the waits-for graph is a set of chains, and a chain that closes
+# on itself is a gridlock: nobody in the cycle can move until one of them leaves it.
+#
+# The graph is kept from step to step and only the edges that changed are checked: a
+# changed edge ends the gridlocks it was part of, and a new edge can only close a cycle
+# through itself, which is found by following the chain from the vehicle it waits for.
+#
+# While a vehicle is in a gridlock its own escalation (replans and lane changes after
+# being stuck for a few steps) is switched off, since it costs a search every few steps
+# and the policy takes over. Instead, once the gridlock lasted `patience` steps, the
+# resolution policy moves one of the vehicles (a different one on every attempt):
+#   "lane_change"  the vehicle changes lanes if a neighbour lane is free, otherwise it
+#                  gets a route that avoids the cars
+#   "reroute"      the vehicle gets a route that avoids the cars
+#   "none"         gridlocks are only detected and counted, the vehicles keep their own
+#                  escalation (vehicle.gridlocked is never set)
+GRIDLOCK_POLICIES = ("lane_change", "reroute", "none")
+
+# Counters stored in snapshots
+GRIDLOCK_COUNTERS = ("detected", "resolved", "interventions", "total_steps", "longest")
+
+
+class Gridlock:
+    """
+    Cycle of vehicles that wait for each other.
+    """
+    def __init__(self, vehicles, step):
+        """
+        Creates a gridlock found in a step.
+        Args:
+            vehicles: Vehicles of the cycle, in waiting order
+            step: Step it was detected in
+        """
+        self.vehicles = vehicles
+        self.start_step = step
+        self.attempts = 0
+
+
+class GridlockMonitor:
+    """
+    Waits-for graph of the vehicles of a model, its gridlocks and their counters.
+    """
+    def __init__(self, model, policy="lane_change", patience=3):
+        """
+        Creates an empty monitor.
+        Args:
+            model: CityModel whose vehicles are watched
+            policy: Resolution policy, one of GRIDLOCK_POLICIES
+            patience: Steps a gridlock lasts before (and between) resolution attempts
+        """
+        if policy not in GRIDLOCK_POLICIES:
+            raise ValueError(f"Unknown gridlock policy {policy!r}, use one of {GRIDLOCK_POLICIES}")
+
+        self.model = model
+        self.policy = policy
+        self.patience = patience
+        # Vehicle -> vehicle it waits for
+        self.waits_for = {}
+        # Vehicle -> its current gridlock
+        self.gridlock_of = {}
+        self.detected = 0
+        self.resolved = 0
+        self.interventions = 0
+        # Steps spent in gridlocks that ended, and the longest one
+        self.total_steps = 0
+        self.longest = 0
+
+    @property
+    def active(self):
+        """Current gridlocks."""
+        return list({id(gridlock): gridlock for gridlock in self.gridlock_of.values()}.values())
+
+    @timed("gridlock")
+    def update(self):
+        """
+        Updates the waits-for graph after the vehicles moved, finds the new gridlocks
+        and runs the resolution policy on the ones that lasted long enough.
+        """
+        model = self.model
+        step = model.current_step
+
+        waits_for = {}
+        for vehicle in model.vehicles():
+            blocker = vehicle.blocked_by
+            # The blocker may have arrived (and been removed) later in the step
+            if blocker is not None and blocker.cell is not None:
+                waits_for[vehicle] = blocker
+
+        changed = [v for v, blocker in waits_for.items() if self.waits_for.get(v) is not blocker]
+        changed.extend(v for v in self.waits_for if v not in waits_for)
+        self.waits_for = waits_for
+
+        for vehicle in changed:
+            gridlock = self.gridlock_of.get(vehicle)
+            if gridlock is not None:
+                self._end(gridlock, step)
+
+        for vehicle in changed:
+            if vehicle in waits_for and vehicle not in self.gridlock_of:
+                cycle = self._cycle_through(vehicle)
+                if cycle is not None:
+                    self._start(cycle, step)
+
+        if self.policy != "none":
+            for gridlock in self.active:
+                age = step - gridlock.start_step
+                if age and age % self.patience == 0:
+                    self._resolve(gridlock)
+
+    def _cycle_through(self, vehicle):
+        """Vehicles of the cycle closed by the edge of a vehicle, or None."""
+        cycle = [vehicle]
+        current = self.waits_for[vehicle]
+        while current is not vehicle:
+            current_next = self.waits_for.get(current)
+            # The chain ends, or joins a cycle that does not contain the vehicle
+            if current_next is None or current in self.gridlock_of or len(cycle) > len(self.waits_for):
+                return None
+            cycle.append(current)
+            current = current_next
+        return cycle
+
+    def _start(self, cycle, step):
+        gridlock = Gridlock(cycle, step)
+        for vehicle in cycle:
+            self.gridlock_of[vehicle] = gridlock
+            vehicle.gridlocked = self.policy != "none"
+        self.detected += 1
+        if self.model.metrics is not None:
+            self.model.metrics.count("gridlocks")
+
+    def _end(self, gridlock, step):
+        for vehicle in gridlock.vehicles:
+            del self.gridlock_of[vehicle]
+            vehicle.gridlocked = False
+        duration = step - gridlock.start_step
+        self.resolved += 1
+        self.total_steps += duration
+        self.longest = max(self.longest, duration)
+        if self.model.metrics is not None:
+            self.model.metrics.count("gridlock_steps", duration)
+
+    def _resolve(self, gridlock):
+        """Moves or reroutes one vehicle of a gridlock (the next one on every attempt)."""
+        ordered = sorted(gridlock.vehicles, key=lambda vehicle: vehicle.unique_id)
+        vehicle = ordered[gridlock.attempts % len(ordered)]
+        gridlock.attempts += 1
+
+        if self.policy == "lane_change":
+            lane = vehicle.try_lane_change()
+            if lane:
+                vehicle.move_to(lane)
+                vehicle.path = None
+                vehicle.stuck_counter = 0
+                self._intervened()
+                return
+
+        path = vehicle.aStar(avoid_cars=True)
+        if path is not None:
+            vehicle.path = path
+            vehicle.path_index = 0
+            vehicle.stuck_counter = 0
+            self._intervened()
+
+    def _intervened(self):
+        self.interventions += 1
+        if self.model.metrics is not None:
+            self.model.metrics.count("gridlock_interventions")
+
+    def stats(self):
+        """
+        Counters of the gridlocks of the model.
+
+        Returns:
+            dict: Detected, resolved and active gridlocks, durations (in steps) and interventions
+        """
+        active = self.active
+        step = self.model.current_step
+        return {
+            "policy": self.policy,
+            "patience": self.patience,
+            "waiting": len(self.waits_for),
+            "detected": self.detected,
+            "resolved": self.resolved,
+            "interventions": self.interventions,
+            "meanDuration": self.total_steps / self.resolved if self.resolved else 0.0,
+            "longest": max([self.longest] + [step - gridlock.start_step for gridlock in active]),
+            "active": [
+                {
+                    "vehicles": [vehicle.unique_id for vehicle in gridlock.vehicles],
+                    "cells": [list(vehicle.cell.coordinate) for vehicle in gridlock.vehicles],
+                    "since": gridlock.start_step,
+                    "attempts": gridlock.attempts,
+                }
+                for gridlock in active
+            ],
+        }
+
+    def get_state(self):
+        """Counters, waits-for graph and gridlocks, with the vehicles as unique ids (for snapshots)."""
+        state = {name: getattr(self, name) for name in GRIDLOCK_COUNTERS}
+        state["waits_for"] = [(vehicle.unique_id, blocker.unique_id) for vehicle, blocker in self.waits_for.items()]
+        state["gridlocks"] = [
+            ([vehicle.unique_id for vehicle in gridlock.vehicles], gridlock.start_step, gridlock.attempts)
+            for gridlock in self.active
+        ]
+        return state
+
+    def set_state(self, state, vehicles):
+        """
+        Restores the state returned by get_state.
+
+        Args:
+            state: Dict from get_state
+            vehicles: Dict unique id -> vehicle of the restored model
+        """
+        for name in GRIDLOCK_COUNTERS:
+            setattr(self, name, state[name])
+        self.waits_for = {vehicles[vehicle]: vehicles[blocker] for vehicle, blocker in state["waits_for"]}
+        self.gridlock_of = {}
+        for ids, start_step, attempts in state["gridlocks"]:
+            gridlock = Gridlock([vehicles[i] for i in ids], start_step)
+            gridlock.attempts = attempts
+            for vehicle in gridlock.vehicles:
+                self.gridlock_of[vehicle] = gridlock
+                vehicle.gridlocked = self.policy != "none"
@@ -0,0 +1,244 @@
+import struct
+
+import numpy as np
+
+from .instrumentation import timed
+from .raster import encode_png
+
+# Congestion heatmaps: per-cell accumulators updated every step, with exponential decay so
+# that they show the last few hundred steps rather than the whole run.
+#
+#   occupancy  vehicles on the cell
+#   stops      vehicles on the cell that did not move (blocked by a car or a red light, or crashed)
+#   queue      at a traffic light cell, vehicles queued behind it: the ones stopped by the red
+#              light plus the ones waiting for them, following the waits-for graph (gridlock.py)
+#
+# Only the cells with vehicles are touched in a step. Instead of multiplying every cell by
+# the decay factor, each step adds its values with a weight that grows by 1 / decay, and
+# the accumulators are divided by the current weight when read (they are renormalized
+# when the weight gets large). A heatmap value is the weighted mean per step, e.g. the
+# mean number of vehicles on the cell over the recent steps.
+HEATMAP_LAYERS = ("occupancy", "stops", "queue")
+
+DEFAULT_HALF_LIFE = 100
+
+# Binary heatmap format (little-endian)
+#
+# Header, 20 bytes:
+#   4s  magic "TCHM"
+#   u16 format version
+#   u16 layer (index in HEATMAP_LAYERS)
+#   u16 width
+#   u16 height
+#   u32 step
+#   f32 scale: value of a cell = byte / 255 * scale
+#
+# Followed by width * height bytes, one row per y (row 0 is y = 0), x increasing
+# within a row, ready to upload as a LUMINANCE / R8 texture.
+HEATMAP_MAGIC = b"TCHM"
+HEATMAP_VERSION = 1
+HEADER = struct.Struct("<4sHHHHIf")
+
+# Weight at which the accumulators are renormalized
+RENORMALIZE_WEIGHT = 1e100
+
+
+class CongestionHeatmap:
+    """
+    Decaying per-cell accumulators of the congestion of a model.
+    """
+    def __init__(self, model, half_life=DEFAULT_HALF_LIFE):
+        """
+        Creates empty heatmaps of the grid of a model.
+        Args:
+            model: CityModel to watch
+            half_life: Steps after which a value counts half (None never forgets)
+        """
+        self.model = model
+        self.half_life = half_life
+        self.decay = 1.0 if half_life is None else 0.5 ** (1 / half_life)
+        self.layers = {layer: np.zeros((model.width, model.height)) for layer in HEATMAP_LAYERS}
+        # Weight of the current step, and the decayed number of steps (the divisor of the means)
+        self._weight = 1.0
+        self._steps = 0.0
+        self.steps = 0
+
+    @timed("heatmap")
+    def update(self):
+        """Adds the state of the model after its vehicles moved."""
+        if self.steps:
+            self._weight /= self.decay
+        self._steps = self._steps * self.decay + 1
+        self.steps += 1
+        if self._weight > RENORMALIZE_WEIGHT:
+            for values in self.layers.values():
+                values /= self._weight
+            self._weight = 1.0
+
+        cells = []
+        stopped = []
+        light_of = {}
+        for vehicle in self.model.vehicles():
+            cells.append(vehicle.cell.coordinate)
+            stopped.append(vehicle.crashed or vehicle.blocked_by is not None or vehicle.waiting_light is not None)
+            if vehicle.waiting_light is not None:
+                light_of[vehicle] = vehicle.waiting_light
+        if not cells:
+            return
+
+        xs, ys = np.array(cells, dtype=np.intp).T
+        np.add.at(self.layers["occupancy"], (xs, ys), self._weight)
+        stopped = np.array(stopped)
+        np.add.at(self.layers["stops"], (xs[stopped], ys[stopped]), self._weight)
+
+        queues = self.queue_lengths(light_of)
+        if queues:
+            coordinates = np.array([light.cell.coordinate for light in queues], dtype=np.intp)
+            self.layers["queue"][coordinates[:, 0], coordinates[:, 1]] += self._weight * np.array(list(queues.values()))
+
+    def queue_lengths(self, light_of):
+        """
+        Vehicles queued at each red light.
+
+        Args:
+            light_of: Vehicle -> Traffic_Light that stopped it in this step
+
+        Returns:
+            dict: Traffic_Light -> vehicles stopped by it or waiting (directly or not) for one of those
+        """
+        waits_for = self.model.gridlock.waits_for
+        resolved = dict(light_of)
+        for vehicle in waits_for:
+            chain = []
+            current = vehicle
+            # Follows the chain up to a vehicle at a light, a vehicle that is not waiting,
+            # or a cycle (a gridlock)
+            while current not in resolved and current in waits_for and current not in chain:
+                chain.append(current)
+                current = waits_for[current]
+            light = resolved.get(current)
+            for waiting in chain:
+                resolved[waiting] = light
+
+        queues = {}
+        for light in resolved.values():
+            if light is not None:
+                queues[light] = queues.get(light, 0) + 1
+        return queues
+
+    def values(self, layer):
+        """
+        Weighted mean per step of a layer.
+
+        Args:
+            layer: One of HEATMAP_LAYERS
+
+        Returns:
+            np.ndarray: (width, height) array
+        """
+        if not self.steps:
+            return np.zeros_like(self.layers[layer])
+        return self.layers[layer] / (self._weight * self._steps)
+
+    def hotspots(self, layer, top=10):
+        """
+        Cells with the highest values of a layer.
+
+        Returns:
+            list: Dicts with the x, z coordinates and the value, highest first
+        """
+        values = self.values(layer)
+        top = min(top, values.size)
+        if not top:
+            return []
+        flat = np.argpartition(values.ravel(), -top)[-top:]
+        flat = flat[np.argsort(values.ravel()[flat])[::-1]]
+        return [
+            {"x": int(x), "z": int(z), "value": round(float(values[x, z]), 4)}
+            for x, z in zip(*np.unravel_index(flat, values.shape))
+            if values[x, z] > 0
+        ]
+
+    def quantized(self, layer, scale=None):
+        """
+        Layer as bytes for a texture: one row per y, 0 to 255 over [0, scale].
+
+        Args:
+            layer: One of HEATMAP_LAYERS
+            scale: Value that maps to 255 (default: the maximum of the layer)
+
+        Returns:
+            tuple: (uint8 array of shape (height, width), scale used)
+        """
+        values = self.values(layer).T
+        if scale is None:
+            scale = float(values.max())
+        if scale <= 0:
+            return np.zeros(values.shape, dtype=np.uint8), 0.0
+        grid = np.rint(np.clip(values / scale, 0, 1) * 255).astype(np.uint8)
+        return grid, scale
+
+    def pack(self, layer, scale=None):
+        """Layer in the binary heatmap format (see HEADER)."""
+        grid, scale = self.quantized(layer, scale)
+        height, width = grid.shape
+        header = HEADER.pack(
+            HEATMAP_MAGIC, HEATMAP_VERSION, HEATMAP_LAYERS.index(layer), width, height,
+            self.model.current_step, scale,
+        )
+        return header + grid.tobytes()
+
+    def png(self, layer, scale=None):
+        """Layer as a grayscale PNG, north up (the top row is the highest y, as in the map files)."""
+        grid, _ = self.quantized(layer, scale)
+        return encode_png(grid[::-1])
+
+    def get_state(self):
+        """Plain data of the accumulators, for snapshots (each layer as little-endian float64 bytes)."""
+        return {
+            "half_life": self.half_life,
+            "weight": self._weight,
+            "decayed_steps": self._steps,
+            "steps": self.steps,
+            "layers": {layer: values.astype("<f8").tobytes() for layer, values in self.layers.items()},
+        }
+
+    def set_state(self, state):
+        """
+        Restores the state returned by get_state.
+
+        Args:
+            state: Dict from get_state, taken on a grid of the same size
+
+        Raises:
+            ValueError: If the layers do not match the grid of the model
+        """
+        half_life = state["half_life"]
+        if half_life is not None and (type(half_life) not in (int, float) or half_life <= 0):
+            raise ValueError("The heatmap half-life must be a positive number")
+        for name in ("weight", "decayed_steps"):
+            if type(state[name]) is not float or not state[name] >= 0:
+                raise ValueError(f"Invalid heatmap {name}")
+
+        shape = (self.model.width, self.model.height)
+        layers = {}
+        for layer in HEATMAP_LAYERS:
+            data = state["layers"].get(layer)
+            if not isinstance(data, bytes) or len(data) != shape[0] * shape[1] * 8:
+                raise ValueError(f"The {layer} heatmap does not match the grid of the map")
+            layers[layer] = np.frombuffer(data, dtype="<f8").reshape(shape).astype(float)
+
+        self.half_life = half_life
+        self.decay = 1.0 if self.half_life is None else 0.5 ** (1 / self.half_life)
+        self.layers = layers
+        self._weight = state["weight"]
+        self._steps = state["decayed_steps"]
+        self.steps = state["steps"]
+
+    def reset(self):
+        """Forgets everything accumulated so far."""
+        for values in self.layers.values():
+            values[:] = 0
+        self._weight = 1.0
+        self._steps = 0.0
+        self.steps = 0
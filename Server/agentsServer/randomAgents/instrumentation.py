@@ -0,0 +1,159 @@
+import functools
+from bisect import bisect_left
+from time import perf_counter
+
+# Phases of a step, timed when the model has metrics (model.metrics is not None).
+# vehicle_move includes the A* searches and lane changes made by the vehicle.
+PHASES = {
+    "step": "Whole CityModel.step",
+    "spawn": "Spawn queues and new vehicles",
+    "vehicle_move": "Move of a vehicle (Car.move, Borrachito.move)",
+    "astar": "A* search",
+    "lane_change": "Lane change check (try_lane_change)",
+    "lights": "Traffic light toggle",
+    "gridlock": "Waits-for graph update and gridlock resolution (see gridlock.py)",
+    "heatmap": "Congestion heatmap update (see heatmap.py)",
+    "report": "POST of the counters to the metrics API",
+}
+
+COUNTERS = {
+    "astar_calls": "A* searches",
+    "astar_expansions": "Nodes expanded by A* searches",
+    "astar_failures": "A* searches that found no path",
+    "lane_changes": "Lane changes made",
+    "crashes": "Crashes between vehicles",
+    "gridlocks": "Gridlocks detected (cycles of vehicles waiting for each other)",
+    "gridlock_steps": "Steps spent in gridlocks that ended",
+    "gridlock_interventions": "Vehicles moved or rerouted to break a gridlock",
+}
+
+# Upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+)
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets (counts are per bucket, not cumulative).
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+class StepMetrics:
+    """
+    Timing histograms of the phases of a step and event counters of a model.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        Creates empty metrics.
+        Args:
+            buckets: Upper bounds of the histogram buckets, in seconds
+        """
+        self.histograms = {phase: Histogram(buckets) for phase in PHASES}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+    def observe(self, phase, seconds):
+        self.histograms[phase].observe(seconds)
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def render(self, model=None, prefix="traffic_"):
+        """
+        Metrics in the Prometheus text exposition format.
+
+        Args:
+            model: Model whose current state is added as gauges (optional)
+            prefix: Prefix of every metric name
+
+        Returns:
+            str: Text document
+        """
+        lines = [
+            f"# HELP {prefix}phase_seconds Time spent in each phase of the simulation step",
+            f"# TYPE {prefix}phase_seconds histogram",
+        ]
+        for phase, histogram in self.histograms.items():
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{prefix}phase_seconds_bucket{{phase="{phase}",le="{bound}"}} {cumulative}')
+            lines.append(f'{prefix}phase_seconds_bucket{{phase="{phase}",le="+Inf"}} {histogram.count}')
+            lines.append(f'{prefix}phase_seconds_sum{{phase="{phase}"}} {histogram.sum}')
+            lines.append(f'{prefix}phase_seconds_count{{phase="{phase}"}} {histogram.count}')
+
+        for name, description in COUNTERS.items():
+            lines.append(f"# HELP {prefix}{name}_total {description}")
+            lines.append(f"# TYPE {prefix}{name}_total counter")
+            lines.append(f"{prefix}{name}_total {self.counters[name]}")
+
+        if model is not None:
+            gauges = {
+                "current_step": ("Current step of the model", model.current_step),
+                "vehicles": ("Vehicles in the simulation", sum(1 for _ in model.vehicles())),
+                "cars_spawned": ("Vehicles spawned since the model was created", model.cars_spawned),
+                "cars_arrived": ("Vehicles that reached their destination", model.cars_arrived),
+                "spawn_backlog": ("Vehicles waiting at the spawn gates", model.spawn_queue.backlog),
+                "gridlocks_active": ("Current gridlocks", len(model.gridlock.active)),
+                "vehicles_waiting": ("Vehicles waiting for another vehicle", len(model.gridlock.waits_for)),
+            }
+            for name, (description, value) in gauges.items():
+                lines.append(f"# HELP {prefix}{name} {description}")
+                lines.append(f"# TYPE {prefix}{name} gauge")
+                lines.append(f"{prefix}{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+def timed(phase, on_result=None, of_model=False):
+    """
+    Decorator that adds the duration of a method to a phase of the model metrics.
+    When the model has no metrics the method is called directly.
+
+    Args:
+        phase: Key of PHASES
+        on_result: Function (metrics, instance, result) called after the method, to update counters
+        of_model: The method belongs to the model (self.metrics) instead of an agent (self.model.metrics)
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            metrics = self.metrics if of_model else self.model.metrics
+            if metrics is None:
+                return method(self, *args, **kwargs)
+
+            start = perf_counter()
+            try:
+                result = method(self, *args, **kwargs)
+            finally:
+                metrics.observe(phase, perf_counter() - start)
+            if on_result is not None:
+                on_result(metrics, self, result)
+            return result
+        return wrapper
+    return decorator
+
+
+def count_search(metrics, car, path):
+    """Counters of an A* search (see timed)."""
+    metrics.count("astar_calls")
+    metrics.count("astar_expansions", car.last_expansions)
+    if path is None:
+        metrics.count("astar_failures")
+
+
+def count_lane_change(metrics, car, cell):
+    """Counts the lane changes: every caller moves to the cell try_lane_change returns."""
+    if cell is not None:
+        metrics.count("lane_changes")
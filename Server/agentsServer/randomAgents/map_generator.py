@@ -0,0 +1,190 @@
+import argparse
+import hashlib
+import os
+import random
+import time
+
+import numpy as np
+
+from .city_map import MAP_DIRECTORY, compile_map
+
+# Procedural city maps, written in the city_files text format with the glyphs of
+# mapDictionary.json:
+#
+#   - a ring road of `lanes` lanes around the map, counter-clockwise (v on the left
+#     column, > on the bottom rows, ^ on the right column, < on the top rows)
+#   - one-way interior streets every `block_size` cells, alternating directions
+#   - traffic lights on the approaches of a fraction of the interior intersections:
+#     "s" (starts green, 7 steps) before the crossing on streets, "S" (starts red,
+#     15 steps) on avenues
+#   - destinations on block cells next to a street
+#
+# The text grid is built as an array of row strings (row 0 is the top of the map,
+# the last row is y = 0), so maps of 2000x2000 cells take a few seconds.
+GENERATED_PREFIX = "generated_"
+
+
+def _street_positions(size, lanes, block_size):
+    """First row/column of every interior street (the ring takes `lanes` on each side)."""
+    positions = []
+    start = lanes + block_size
+    while start + lanes + 1 <= size - lanes:
+        positions.append(start)
+        start += lanes + block_size
+    return positions
+
+
+def generate_map(width=200, height=200, block_size=8, lanes=2, signal_density=0.5, destinations=50, seed=0):
+    """
+    Generates a city map.
+
+    Args:
+        width: Columns of the map
+        height: Rows of the map
+        block_size: Cells between two parallel streets (at least 3)
+        lanes: Lanes of every street and of the ring road
+        signal_density: Fraction of the interior intersections with traffic lights (0 to 1)
+        destinations: Number of destinations
+        seed: Seed of the random placement of lights and destinations
+
+    Returns:
+        str: Map in the city_files text format
+    """
+    if block_size < 3:
+        raise ValueError("block_size must be at least 3")
+    if lanes < 1:
+        raise ValueError("lanes must be at least 1")
+    if width < 2 * lanes + block_size or height < 2 * lanes + block_size:
+        raise ValueError("The map is too small for the ring road")
+
+    rng = random.Random(seed)
+    grid = np.full((height, width), "#", dtype="<U1")
+
+    columns = _street_positions(width, lanes, block_size)
+    rows = _street_positions(height, lanes, block_size)
+    column_glyphs = ["^" if i % 2 == 0 else "v" for i in range(len(columns))]
+    row_glyphs = [">" if i % 2 == 0 else "<" for i in range(len(rows))]
+
+    # Interior avenues (columns) first, streets (rows) then overwrite the crossings
+    for x, glyph in zip(columns, column_glyphs):
+        grid[:, x:x + lanes] = glyph
+    for r, glyph in zip(rows, row_glyphs):
+        grid[r:r + lanes, :] = glyph
+
+    # Ring road, counter-clockwise, with corners that turn into the next side
+    grid[:, :lanes] = "v"
+    grid[-lanes:, :] = ">"
+    grid[:, -lanes:] = "^"
+    grid[:lanes, :] = "<"
+    grid[:lanes, :lanes] = "v"
+    grid[-lanes:, :lanes] = ">"
+    grid[-lanes:, -lanes:] = "^"
+    grid[:lanes, -lanes:] = "<"
+
+    # Traffic lights on the approaches of the chosen intersections. The light on an
+    # avenue going up is placed one cell further, so the road next to it above (which
+    # is where city_map takes the direction of a light from) is still the avenue.
+    for x, column_glyph in zip(columns, column_glyphs):
+        for r, row_glyph in zip(rows, row_glyphs):
+            if rng.random() >= signal_density:
+                continue
+
+            light_column = x - 1 if row_glyph == ">" else x + lanes
+            grid[r:r + lanes, light_column] = "s"
+
+            light_row = r - 1 if column_glyph == "v" else r + lanes + 1
+            grid[light_row, x:x + lanes] = "S"
+
+    # Destinations: block cells with a road on one of their sides
+    is_road = grid != "#"
+    next_to_road = np.zeros_like(is_road)
+    next_to_road[1:, :] |= is_road[:-1, :]
+    next_to_road[:-1, :] |= is_road[1:, :]
+    next_to_road[:, 1:] |= is_road[:, :-1]
+    next_to_road[:, :-1] |= is_road[:, 1:]
+    candidates = np.argwhere(~is_road & next_to_road)
+
+    if destinations > len(candidates):
+        raise ValueError(f"The map only has room for {len(candidates)} destinations")
+    for i in rng.sample(range(len(candidates)), destinations):
+        r, x = candidates[i]
+        grid[r, x] = "D"
+
+    return "\n".join("".join(row) for row in grid) + "\n"
+
+
+def check_map(text, name="generated"):
+    """
+    Checks that every destination can be reached from every spawn point of a map.
+
+    Args:
+        text: Map in the city_files text format
+        name: Name used in the compiled map
+
+    Returns:
+        tuple: (compiled map, list of unreachable (spawn point, destination) pairs)
+    """
+    city_map = compile_map(name, text, hashlib.sha1(text.encode("utf-8")).hexdigest())
+
+    # One breadth-first search from all the spawn points at once: every node keeps a bit per
+    # spawn point that reaches it (at most 4, one per corner), and a node goes back in the
+    # frontier whenever it gains a bit
+    spawn_points = city_map.spawn_points
+    starts = city_map.node_index[spawn_points[:, 0], spawn_points[:, 1]]
+    reached = np.zeros(len(city_map.nodes), dtype=np.uint8)
+    np.bitwise_or.at(reached, starts, (1 << np.arange(len(starts))).astype(np.uint8))
+    frontier = np.unique(starts)
+    indptr, indices = city_map.graph_indptr, city_map.graph_indices
+    while len(frontier):
+        starts = indptr[frontier]
+        counts = indptr[frontier + 1] - starts
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        successors = indices[offsets]
+        gained = np.repeat(reached[frontier], counts) & ~reached[successors]
+        successors, gained = successors[gained != 0], gained[gained != 0]
+        np.bitwise_or.at(reached, successors, gained)
+        frontier = np.unique(successors)
+
+    targets = city_map.node_index[city_map.destinations[:, 0], city_map.destinations[:, 1]]
+    unreachable = []
+    for i, spawn in enumerate(spawn_points.tolist()):
+        missing = (reached[targets] >> i) & 1 == 0
+        for destination in city_map.destinations[missing].tolist():
+            unreachable.append((tuple(spawn), tuple(destination)))
+
+    return city_map, unreachable
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a city map in the city_files format")
+    parser.add_argument("--width", type=int, default=200)
+    parser.add_argument("--height", type=int, default=200)
+    parser.add_argument("--block-size", type=int, default=8, help="Cells between two parallel streets")
+    parser.add_argument("--lanes", type=int, default=2, help="Lanes of every street")
+    parser.add_argument("--signal-density", type=float, default=0.5, help="Fraction of intersections with traffic lights")
+    parser.add_argument("--destinations", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help=f"File to write (default: city_files/{GENERATED_PREFIX}<width>x<height>_<seed>.txt)")
+    parser.add_argument("--check", action="store_true", help="Check that every destination is reachable from every spawn point")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    text = generate_map(
+        args.width, args.height, args.block_size, args.lanes,
+        args.signal_density, args.destinations, args.seed,
+    )
+    elapsed = time.perf_counter() - start
+
+    output = args.output or os.path.join(MAP_DIRECTORY, f"{GENERATED_PREFIX}{args.width}x{args.height}_{args.seed}.txt")
+    with open(output, "w") as f:
+        f.write(text)
+    print(f"Map written to {output} in {elapsed:.2f}s")
+
+    if args.check:
+        city_map, unreachable = check_map(text, os.path.splitext(os.path.basename(output))[0])
+        print(f"{len(city_map.nodes)} road cells, {len(city_map.lights)} traffic lights, "
+              f"{len(city_map.destinations)} destinations, spawn points {city_map.spawn_points.tolist()}")
+        if unreachable:
+            print(f"{len(unreachable)} unreachable (spawn point, destination) pairs, e.g. {unreachable[:5]}")
+        else:
+            print("Every destination is reachable from every spawn point")
@@ -1,10 +1,29 @@
 from mesa import Model
 from mesa.discrete_space import OrthogonalMooreGrid
-from .agent import Car, Traffic_Light, Destination, Obstacle, Road, Borrachito, destinations
+from .agent import Car, Traffic_Light, Borrachito
+from .vehicle_changes import VehicleChangeLog
+from .recorder import TrajectoryRecorder
+from .spawn_queue import SpawnQueue
+from .gridlock import GridlockMonitor
+from .trip_stats import TripStats
+from .heatmap import CongestionHeatmap
+from .instrumentation import StepMetrics, timed
+from .city_map import DEFAULT_MAP, OBSTACLE, DESTINATION, DIRECTIONS, DIRECTION_VECTORS, load_map, map_path
 import json
-import os
 import random
-import requests
+import numpy as np
+import time
+
+# Endpoint of the metrics API that receives the counters every 100 steps
+REPORT_URL = "http://localhost:5000/api/validate_attempt"
+
+# Independent random streams of a model (model.spawn_random, model.routing_random and
+# model.driver_random), all derived from its seed:
+#   spawn    destinations of new vehicles and borrachito spawns
+#   routing  tie breaking of the A* searches
+#   driver   decisions of the drivers (waiting behind a car, borrachito moves and crashes)
+# Separate streams keep e.g. a different spawn demand from changing the routes.
+RANDOM_STREAMS = ("spawn", "routing", "driver")
 
 class CityModel(Model):
     """
@@ -13,77 +32,153 @@ class CityModel(Model):
     Args:
         N: Number of agents in the simulation
         seed: Random seed for the model
+        spawn_of_cars: Steps between car spawns
+        report_url: Endpoint that receives the metrics every 100 steps (None to disable)
+        map_name: City map to load (a file of city_files, see city_map.available_maps)
+        spawn_points: (x, y) spawn gates (by default the ones derived from the map)
+        spawn_demand: Vehicles per step offered at each gate (None: one every spawn_of_cars steps)
+        admission: What happens to vehicles that cannot enter, "queue" or "drop" (see spawn_queue.py)
+        max_backlog: Vehicles that can wait at each gate
+        instrument: Time the phases of each step and count events (see instrumentation.py)
+        gridlock_policy: How gridlocks are broken, "lane_change", "reroute" or "none" (see gridlock.py)
     """
 
-    def __init__(self, N, seed=42, spawn_of_cars = 5):
+    def __init__(self, N, seed=42, spawn_of_cars = 5, report_url=REPORT_URL, map_name=DEFAULT_MAP, spawn_points=None,
+                 spawn_demand=None, admission="queue", max_backlog=50, instrument=True,
+                 gridlock_policy="lane_change"):
 
         super().__init__(seed=seed)
 
-        global destinations
-        destinations.clear()
-
-        base_path = os.path.dirname(__file__)
-        dataDictionary = json.load(open(os.path.join(base_path, "city_files/mapDictionary.json")))
+        for name in RANDOM_STREAMS:
+            setattr(self, f"{name}_random", random.Random(self.random.getrandbits(64)))
 
         self.num_agents = N
         self.car_spawn_rate = spawn_of_cars
         self.current_step = 0
         self.cars_spawned = 0
         self.cars_arrived = 0
+        self.crashes = 0
+        # Steps from spawn to arrival, summed over the vehicles that arrived
+        self.total_trip_steps = 0
+        # Origin-destination matrix of the finished trips (see trip_stats.py)
+        self.trip_stats = TripStats()
         self.borrachito_mode = False
+        self.vehicle_changes = VehicleChangeLog()
+        # Disabled while running several steps in a row, only the last one is recorded
+        self.track_changes = True
+        self.report_url = report_url
+        self.recorder = None
+        # None disables the instrumentation (the timed methods are then called directly)
+        self.metrics = StepMetrics() if instrument else None
+
+        # Compiled once per map content and cached (see city_map.py)
+        self.city_map = load_map(map_name)
+        self.map_name = map_name
+        self.map_file = map_path(map_name)
+        # Identifies the map content, used to cache the static layers
+        self.map_digest = self.city_map.digest
+        self.width = self.city_map.width
+        self.height = self.city_map.height
+        # Destination cell -> index of its distance field in the compiled map (computed on first use)
+        self.destination_fields = {
+            tuple(point): i for i, point in enumerate(self.city_map.destinations.tolist())
+        }
+
+        self.grid = OrthogonalMooreGrid(
+            [self.width, self.height], capacity=100, torus=False, random=self.random
+        )
+
+        # Number of vehicles in each cell, kept up to date by Car.cell
+        self.occupancy = np.zeros((self.width, self.height), dtype=np.int16)
+
+        # Roads, obstacles and destinations are not agents: the vehicles read them from these
+        # views of the compiled map, which every process shares (see road_direction)
+        self.cell_kinds = np.asarray(self.city_map.kind)
+        self.road_directions = np.asarray(self.city_map.direction)
+
+        # Destination cells of this model, in the order of the map file
+        self.destinations = [self.grid[point] for point in self.destination_fields]
+
+        for x, y, state, time_to_change in self.city_map.lights.tolist():
+            Traffic_Light(self, self.grid[(x, y)], bool(state), time_to_change)
+
+        # Spawn gates and, for each one, the cells a car can be spawned on (see build_spawn_candidates)
+        if spawn_points is None:
+            spawn_points = self.city_map.spawn_points.tolist()
+        self.spawn_points = [tuple(point) for point in spawn_points]
+        self.spawn_point_set = frozenset(self.spawn_points)
+        self.spawn_candidates = {point: self.build_spawn_candidates(point) for point in self.spawn_points}
+        self.spawn_queue = SpawnQueue(self, spawn_demand, admission, max_backlog)
+        self.gridlock = GridlockMonitor(self, gridlock_policy)
+        # Decaying per-cell occupancy, stops and red light queues (see heatmap.py)
+        self.heatmap = CongestionHeatmap(self)
 
-        with open(os.path.join(base_path, "city_files/2025_base.txt")) as baseFile:
-            lines = baseFile.readlines()
-            self.width = len(lines[0])
-            self.height = len(lines)
-
-            self.grid = OrthogonalMooreGrid(
-                [self.width, self.height], capacity=100, torus=False
-            )
-
-            for r, row in enumerate(lines):
-                for c, col in enumerate(row):
+        self.running = True
 
-                    cell = self.grid[(c, self.height - r - 1)]
+        if not self.destinations:
+            raise RuntimeError("Initialization failed: missing required data")
 
-                    if col in ["v", "^", ">", "<"]:
-                        agent = Road(self, cell, dataDictionary[col])
+    def vehicles(self):
+        """
+        Iterates over the vehicles (Car and Borrachito) currently in the simulation.
 
-                    elif col in ["S", "s"]:
-                        direction = "Left"
+        Returns:
+            Iterator[Car]: Vehicles in the model
+        """
+        for vehicle_type in (Car, Borrachito):
+            yield from self.agents_by_type.get(vehicle_type, [])
 
-                        if r > 0 and lines[r-1][c] in ["v", "^", ">", "<"]:
-                            direction = dataDictionary[lines[r-1][c]]
-                        elif r < len(lines)-1 and lines[r+1][c] in ["v", "^", ">", "<"]:
-                            direction = dataDictionary[lines[r+1][c]]
-                        elif c > 0 and lines[r][c-1] in ["v", "^", ">", "<"]:
-                            direction = dataDictionary[lines[r][c-1]]
-                        elif c < len(row)-1 and lines[r][c+1] in ["v", "^", ">", "<"]:
-                            direction = dataDictionary[lines[r][c+1]]
+    def road_direction(self, cell):
+        """
+        Direction of the road at a cell (traffic lights stand on a road too).
 
-                        agent = Road(self, cell, direction)
-                        agent = Traffic_Light(
-                            self,
-                            cell,
-                            False if col == "S" else True,
-                            int(dataDictionary[col]),
-                        )
+        Args:
+            cell: Cell to check
 
+        Returns:
+            str: "Up", "Down", "Left" or "Right", or None if the cell has no road
+        """
+        return DIRECTIONS[self.road_directions[cell.coordinate]]
 
+    def is_obstacle(self, cell):
+        """Whether a cell is an obstacle of the map."""
+        return self.cell_kinds[cell.coordinate] == OBSTACLE
 
-                    elif col == "#":
-                        agent = Obstacle(self, cell)
+    def is_destination(self, cell):
+        """Whether a cell is a destination of the map."""
+        return self.cell_kinds[cell.coordinate] == DESTINATION
 
-                    elif col == "D":
-                        agent = Destination(self, cell)
+    def vehicle_arrived(self, vehicle):
+        """
+        Counts a vehicle that reached its destination (it is removed by the caller).
 
+        Args:
+            vehicle: Car or Borrachito that arrived
+        """
+        self.cars_arrived += 1
+        self.total_trip_steps += self.current_step - vehicle.spawn_step
+        self.trip_stats.record(vehicle, self.current_step)
 
+    @property
+    def mean_trip_steps(self):
+        """Mean steps from spawn to arrival of the vehicles that arrived (None before the first one)."""
+        return self.total_trip_steps / self.cars_arrived if self.cars_arrived else None
 
+    def free_flow_steps(self, cell, destination):
+        """
+        Steps of the shortest route from a cell to a destination on the empty road graph.
 
-        self.running = True
+        Args:
+            cell: Start cell
+            destination: Destination cell
 
-        if not destinations:
-            raise RuntimeError("Initialization failed: missing required data")
+        Returns:
+            int: Steps, or None if the destination cannot be reached
+        """
+        field = self.destination_fields.get(destination.coordinate)
+        if field is None:
+            return None
+        return self.city_map.distance_to_destination(field, *cell.coordinate)
 
     def get_cell_at(self, x, y):
         """
@@ -139,141 +234,174 @@ class CityModel(Model):
 
         return self.get_cell_at(x, y)
 
-    def calculate_lane_congestion(self, cell, direction, lookahead=8):
+    def build_spawn_candidates(self, spawn_location, lookahead=8):
         """
-        Calcula el nivel de congestión en un carril mirando hacia adelante.
-
-        Args:
-            cell: Celda inicial
-            direction: Dirección a revisar
-            lookahead: Número de celdas a revisar hacia adelante
-
-        Returns:
-            int: Número de coches encontrados (mayor = más congestión)
-        """
-        congestion = 0
-
-        for i in range(1, lookahead + 1):
-            next_cell = self.get_cell_ahead(cell, direction, i)
-            if not next_cell:
-                break
-
-            car_count = sum(1 for agent in next_cell.agents if isinstance(agent, (Car, Borrachito)))
-            congestion += car_count
-
-            for agent in next_cell.agents:
-                if isinstance(agent, Traffic_Light) and not agent.state:
-                    congestion += 2
-
-        return congestion
-
-    def get_valid_spawn_cells(self, spawn_location):
-        """
-        Obtiene todas las celdas válidas alrededor de un spawn point.
+        Precomputes the cells where cars can be spawned around a spawn point: the point
+        itself and its 8 neighbours that have a road. Each candidate keeps the index of
+        the cells ahead of it and the traffic lights among them, so the congestion at
+        spawn time only reads the occupancy array and the light states.
 
         Args:
             spawn_location: Tupla (x, y) del spawn point
+            lookahead: Cells ahead that count for the congestion
 
         Returns:
-            List[Cell]: Lista de celdas válidas ordenadas por congestión
+            list: (cell, (xs, ys) of the cells ahead, traffic lights ahead) per candidate
         """
-        x, y = spawn_location
-        valid_cells = []
+        lights = {tl.cell.coordinate: tl for tl in self.agents_by_type.get(Traffic_Light, [])}
 
+        x, y = spawn_location
         neighbors = [
+            (x, y),
             (x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1),
             (x + 1, y + 1), (x - 1, y + 1), (x + 1, y - 1), (x - 1, y - 1)
         ]
 
-        neighbors.insert(0, spawn_location)
-
+        candidates = []
         for nx, ny in neighbors:
-            if 0 <= nx < self.width and 0 <= ny < self.height:
-                cell = self.grid[(nx, ny)]
+            if not (0 <= nx < self.width and 0 <= ny < self.height) or not self.city_map.road_mask[nx, ny]:
+                continue
 
-                has_road = any(isinstance(agent, Road) for agent in cell.agents)
-                if not has_road:
-                    continue
+            dx, dy = DIRECTION_VECTORS[DIRECTIONS[self.city_map.direction[nx, ny]]]
+            ahead = []
+            for i in range(1, lookahead + 1):
+                ax, ay = nx + dx * i, ny + dy * i
+                if not (0 <= ax < self.width and 0 <= ay < self.height):
+                    break
+                ahead.append((ax, ay))
 
-                has_obstacle = any(isinstance(agent, Obstacle) for agent in cell.agents)
-                if has_obstacle:
-                    continue
+            ahead_index = (np.array([c[0] for c in ahead], dtype=np.intp), np.array([c[1] for c in ahead], dtype=np.intp))
+            candidates.append((self.grid[(nx, ny)], ahead_index, [lights[c] for c in ahead if c in lights]))
 
-                has_car = any(isinstance(agent, (Car, Borrachito)) for agent in cell.agents)
-                if has_car:
-                    continue
-
-                road_agent = None
-                for agent in cell.agents:
-                    if isinstance(agent, Road):
-                        road_agent = agent
-                        break
-
-                if road_agent:
-                    valid_cells.append((cell, road_agent.direction))
-
-        if valid_cells:
-            cells_with_congestion = []
-            for cell, direction in valid_cells:
-                congestion = self.calculate_lane_congestion(cell, direction, lookahead=8)
-                cells_with_congestion.append((cell, congestion))
-
-            cells_with_congestion.sort(key=lambda x: x[1])
-            return [cell for cell, _ in cells_with_congestion]
-
-        return []
+        return candidates
 
+    @timed("step", of_model=True)
     def step(self):
         """Advance the model by one step."""
         self.agents.shuffle_do("step")
+        self.gridlock.update()
+        self.heatmap.update()
         self.current_step += 1
 
         # Send metrics to API every 100 steps
-        if self.current_step % 100 == 0:
-            url = "http://localhost:5000/api/"
-            endpoint = "validate_attempt"
+        if self.current_step % 100 == 0 and self.report_url:
+            self.report_metrics()
 
-            data = {
-                "year" : 2024,
-                "classroom" : 301,
-                "name" : "Equipo 1",
-                "current_cars": self.cars_spawned,
-                "total_arrived": self.cars_arrived
-            }
+        self.spawn_cars()
 
-            headers = {
-                "Content-Type": "application/json"
-            }
+        if self.track_changes:
+            self.vehicle_changes.record(self.current_step, self.vehicles())
 
-            response = requests.post(url+endpoint, data=json.dumps(data), headers=headers)
+        if self.recorder is not None:
+            self.recorder.record(self)
 
-            print("Request " + "successful" if response.status_code == 200 else "failed", "Status code:", response.status_code)
-            print("Response:", response.json())
+    def start_recording(self, path, **kwargs):
+        """
+        Records the trajectory of every following step (see recorder.py).
+
+        Args:
+            path: Directory of the recording
+            **kwargs: Options of TrajectoryRecorder
+        """
+        self.stop_recording()
+        self.recorder = TrajectoryRecorder(path, self, **kwargs)
+
+    def stop_recording(self):
+        """Writes the pending steps of the recording and stops recording."""
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    @timed("report", of_model=True)
+    def report_metrics(self):
+        """
+        Sends the current counters to the metrics API.
+        A failing or missing API is logged but does not interrupt the simulation.
+        """
+        data = {
+            "year" : 2024,
+            "classroom" : 301,
+            "name" : "Equipo 1",
+            "current_cars": self.cars_spawned,
+            "total_arrived": self.cars_arrived
+        }
 
-        spawn_locations = [(0, 0), (35, 0), (0, 34), (35, 34)]
+        headers = {
+            "Content-Type": "application/json"
+        }
 
-        if self.current_step % self.car_spawn_rate == 0:
-            if not destinations:
-                return
+        # Imported here, most runs never report (report_url=None)
+        import requests
 
-            spawn_borrachito = self.borrachito_mode and random.random() < 0.25
+        try:
+            response = requests.post(self.report_url, data=json.dumps(data), headers=headers, timeout=5)
 
-            borrachito_location = None
-            if spawn_borrachito:
-                borrachito_location = random.choice(spawn_locations)
+            print("Request " + "successful" if response.status_code == 200 else "failed", "Status code:", response.status_code)
+            print("Response:", response.json())
+        except (requests.RequestException, ValueError) as e:
+            print("Request failed:", e)
 
-            for location in spawn_locations:
-                valid_cells = self.get_valid_spawn_cells(location)
+    def run_steps(self, steps, time_budget=None, collect_metrics=False):
+        """
+        Advances the model several steps in a row.
+        Only the last step is recorded in the vehicle change log, so clients using
+        /getAgents?since= still get every change of the batch in one delta.
 
-                if valid_cells:
-                    try:
-                        cell = valid_cells[0]
+        Args:
+            steps: Number of steps to run
+            time_budget: Maximum seconds to spend (None for no limit)
+            collect_metrics: Collect per-step aggregate metrics
 
-                        if spawn_borrachito and location == borrachito_location:
-                            agent = Borrachito(self, cell)
-                            self.cars_spawned += 1
-                        else:
-                            agent = Car(self, cell)
-                            self.cars_spawned += 1
-                    except:
-                        pass
+        Returns:
+            dict: Steps run, elapsed seconds, whether every step was run and,
+            if requested, the metrics of each step as columns
+        """
+        metrics = {"step": [], "vehicles": [], "crashed": [], "carsSpawned": [], "carsArrived": [], "backlog": []} if collect_metrics else None
+
+        start = time.perf_counter()
+        steps_run = 0
+
+        try:
+            while steps_run < steps:
+                self.track_changes = (steps_run == steps - 1)
+                self.step()
+                steps_run += 1
+
+                if metrics is not None:
+                    crashed = 0
+                    vehicles = 0
+                    for vehicle in self.vehicles():
+                        vehicles += 1
+                        crashed += vehicle.crashed
+                    metrics["step"].append(self.current_step)
+                    metrics["vehicles"].append(vehicles)
+                    metrics["crashed"].append(crashed)
+                    metrics["carsSpawned"].append(self.cars_spawned)
+                    metrics["carsArrived"].append(self.cars_arrived)
+                    metrics["backlog"].append(self.spawn_queue.backlog)
+
+                if time_budget is not None and time.perf_counter() - start >= time_budget:
+                    break
+        finally:
+            if not self.track_changes:
+                # The batch stopped early: record where it ended
+                self.vehicle_changes.record(self.current_step, self.vehicles())
+            self.track_changes = True
+
+        result = {
+            "stepsRun": steps_run,
+            "elapsed": time.perf_counter() - start,
+            "completed": steps_run == steps,
+        }
+        if metrics is not None:
+            result["metrics"] = metrics
+
+        return result
+
+    @timed("spawn", of_model=True)
+    def spawn_cars(self):
+        """Adds the arrivals of the step to the spawn queues and spawns the waiting vehicles."""
+        if not self.destinations:
+            return
+
+        self.spawn_queue.step(self)
@@ -0,0 +1,152 @@
+import struct
+
+import numpy as np
+
+from .agent import Borrachito, Traffic_Light
+
+# Binary state format (little-endian)
+#
+# Header, 20 bytes:
+#   4s  magic "TCSB"
+#   u16 format version
+#   u16 record size in bytes
+#   u32 step
+#   u32 number of vehicle records
+#   u32 number of traffic light records
+#
+# Followed by the vehicle records and then the traffic light records. Every record
+# is 12 bytes and 4-byte aligned, so the client can view the buffer with typed arrays
+# (Int32Array for ids, Int16Array for coordinates, Uint8Array for flags/timers).
+STATE_MAGIC = b"TCSB"
+STATE_VERSION = 1
+HEADER = struct.Struct("<4sHHIII")
+
+# Bits of the vehicle flags field
+FLAG_BORRACHITO = 1
+FLAG_CRASHED = 2
+
+VEHICLE_DTYPE = np.dtype([
+    ("id", "<i4"),
+    ("x", "<i2"),
+    ("z", "<i2"),
+    ("flags", "u1"),
+    ("crash_timer", "u1"),
+    ("pad", "V2"),
+])
+
+LIGHT_DTYPE = np.dtype([
+    ("id", "<i4"),
+    ("x", "<i2"),
+    ("z", "<i2"),
+    ("state", "u1"),
+    ("pad", "V3"),
+])
+
+
+def vehicle_records(model):
+    """
+    Builds the vehicle records of the model.
+
+    Args:
+        model: CityModel to read
+
+    Returns:
+        np.ndarray: Array with VEHICLE_DTYPE records
+    """
+    vehicles = list(model.vehicles())
+
+    records = np.zeros(len(vehicles), dtype=VEHICLE_DTYPE)
+    if not vehicles:
+        return records
+
+    coordinates = np.array([v.cell.coordinate for v in vehicles], dtype=np.int16)
+    records["id"] = [v.unique_id for v in vehicles]
+    records["x"] = coordinates[:, 0]
+    records["z"] = coordinates[:, 1]
+    records["flags"] = [
+        (FLAG_BORRACHITO if isinstance(v, Borrachito) else 0) | (FLAG_CRASHED if v.crashed else 0)
+        for v in vehicles
+    ]
+    records["crash_timer"] = np.minimum([v.crash_timer for v in vehicles], 255)
+
+    return records
+
+
+def light_records(model):
+    """
+    Builds the traffic light records of the model.
+
+    Args:
+        model: CityModel to read
+
+    Returns:
+        np.ndarray: Array with LIGHT_DTYPE records
+    """
+    lights = list(model.agents_by_type.get(Traffic_Light, []))
+
+    records = np.zeros(len(lights), dtype=LIGHT_DTYPE)
+    if not lights:
+        return records
+
+    coordinates = np.array([tl.cell.coordinate for tl in lights], dtype=np.int16)
+    records["id"] = [tl.unique_id for tl in lights]
+    records["x"] = coordinates[:, 0]
+    records["z"] = coordinates[:, 1]
+    records["state"] = [tl.state for tl in lights]
+
+    return records
+
+
+def pack_records(step, vehicles, lights):
+    """
+    Packs already built records in the binary state format.
+
+    Args:
+        step: Step of the state
+        vehicles: Array with VEHICLE_DTYPE records
+        lights: Array with LIGHT_DTYPE records
+
+    Returns:
+        bytes: Header followed by the vehicle and traffic light records
+    """
+    header = HEADER.pack(
+        STATE_MAGIC, STATE_VERSION, VEHICLE_DTYPE.itemsize,
+        step, len(vehicles), len(lights),
+    )
+
+    return b"".join((header, vehicles.tobytes(), lights.tobytes()))
+
+
+def pack_state(model):
+    """
+    Packs the vehicles and traffic lights of the model in the binary state format.
+
+    Args:
+        model: CityModel to read
+
+    Returns:
+        bytes: Header followed by the vehicle and traffic light records
+    """
+    return pack_records(model.current_step, vehicle_records(model), light_records(model))
+
+
+def unpack_state(data):
+    """
+    Reads a buffer in the binary state format.
+
+    Args:
+        data: Bytes produced by pack_state
+
+    Returns:
+        tuple: (step, vehicle records, traffic light records)
+    """
+    magic, version, _, step, n_vehicles, n_lights = HEADER.unpack_from(data)
+    if magic != STATE_MAGIC or version != STATE_VERSION:
+        raise ValueError("Unknown binary state format")
+
+    offset = HEADER.size
+    vehicles = np.frombuffer(data, dtype=VEHICLE_DTYPE, count=n_vehicles, offset=offset)
+    offset += vehicles.nbytes
+    lights = np.frombuffer(data, dtype=LIGHT_DTYPE, count=n_lights, offset=offset)
+
+    return step, vehicles, lights
@@ -0,0 +1,287 @@
+import argparse
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from .city_map import EMPTY, ROAD, LIGHT, OBSTACLE, DESTINATION, load_map
+from .packing import FLAG_BORRACHITO, FLAG_CRASHED, light_records, vehicle_records
+
+# Raster frames of the simulation, drawn straight into a NumPy RGB array.
+#
+# Every cell is a cell_size x cell_size block of pixels, north up (the top row of the
+# frame is the highest y, as in the map files). The static layers (roads, obstacles,
+# destinations) are drawn once per map and cell size and cached; a frame is a copy of
+# that background with the traffic lights and vehicles painted on it as whole blocks,
+# so drawing a frame costs a copy of the image plus O(vehicles + lights).
+#
+# Frames are written as PPM files (uncompressed, one per frame), PNG files, or a single
+# raw RGB stream that ffmpeg reads directly:
+#
+#   ffmpeg -f rawvideo -pix_fmt rgb24 -s <width>x<height> -r 30 -i frames.rgb run.mp4
+
+# Colors (RGB)
+KIND_COLORS = {
+    EMPTY: (24, 24, 28),
+    ROAD: (92, 92, 100),
+    LIGHT: (92, 92, 100),
+    OBSTACLE: (46, 58, 48),
+    DESTINATION: (60, 110, 220),
+}
+LIGHT_COLORS = {False: (220, 40, 40), True: (40, 200, 80)}
+CAR_COLOR = (250, 250, 250)
+BORRACHITO_COLOR = (250, 190, 30)
+CRASHED_COLOR = (255, 0, 255)
+
+FRAME_FORMATS = ("ppm", "png", "raw")
+
+# Static backgrounds: (map digest, cell size) -> RGB array
+_backgrounds = {}
+_backgrounds_lock = threading.Lock()
+
+
+def background(city_map, cell_size):
+    """
+    Static layers of a map as an RGB image (cached per map content and cell size).
+
+    Args:
+        city_map: CityMap to draw
+        cell_size: Pixels per cell side
+
+    Returns:
+        np.ndarray: Read-only (height * cell_size, width * cell_size, 3) uint8 array
+    """
+    key = (city_map.digest, cell_size)
+    image = _backgrounds.get(key)
+    if image is not None:
+        return image
+
+    palette = np.zeros((max(KIND_COLORS) + 1, 3), dtype=np.uint8)
+    for kind, color in KIND_COLORS.items():
+        palette[kind] = color
+
+    # [x, y] to rows north up
+    cells = palette[np.asarray(city_map.kind).T[::-1]]
+    image = np.repeat(np.repeat(cells, cell_size, axis=0), cell_size, axis=1)
+    image.flags.writeable = False
+
+    with _backgrounds_lock:
+        _backgrounds[key] = image
+    return image
+
+
+def encode_png(image, level=6):
+    """
+    Encodes an image as PNG (no filtering, zlib only).
+
+    Args:
+        image: (height, width) grayscale or (height, width, 3) RGB uint8 array
+        level: zlib compression level (1 is fastest)
+
+    Returns:
+        bytes: PNG file
+    """
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    height, width = image.shape[:2]
+    color_type = 2 if image.ndim == 3 else 0
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    # Filter type 0 (none) at the start of every row
+    rows = np.hstack([np.zeros((height, 1), dtype=np.uint8), image.reshape(height, -1)]).tobytes()
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(rows, level))
+        + chunk(b"IEND", b"")
+    )
+
+
+class FrameRenderer:
+    """
+    Draws frames of a map from vehicle and traffic light records (see packing.py).
+    The frame array is reused: each render overwrites the previous frame.
+    """
+    def __init__(self, city_map, cell_size=4):
+        """
+        Prepares the background and the frame buffer.
+        Args:
+            city_map: CityMap of the frames
+            cell_size: Pixels per cell side
+        """
+        if cell_size < 1:
+            raise ValueError("cell_size must be at least 1")
+
+        self.city_map = city_map
+        self.cell_size = cell_size
+        self.background = background(city_map, cell_size)
+        self.frame = np.empty_like(self.background)
+        # The frame seen as blocks: [row, pixel row, column, pixel column, channel]
+        self._blocks = self.frame.reshape(city_map.height, cell_size, city_map.width, cell_size, 3)
+        # Vehicles are drawn inset in their cell, so that neighbours stay apart
+        inset = cell_size // 4
+        self._inset = slice(inset, cell_size - inset)
+
+    @property
+    def size(self):
+        """(width, height) of the frames in pixels."""
+        return self.frame.shape[1], self.frame.shape[0]
+
+    def _paint(self, x, y, colors, inset=slice(None)):
+        rows = self.city_map.height - 1 - np.asarray(y, dtype=np.intp)
+        self._blocks[rows, inset, np.asarray(x, dtype=np.intp), inset] = colors[:, None, None, :]
+
+    def render_records(self, vehicles, lights):
+        """
+        Draws a frame.
+
+        Args:
+            vehicles: VEHICLE_DTYPE records
+            lights: LIGHT_DTYPE records
+
+        Returns:
+            np.ndarray: The frame, (height, width, 3) uint8
+        """
+        np.copyto(self.frame, self.background)
+
+        if len(lights):
+            colors = np.where(
+                lights["state"].astype(bool)[:, None],
+                np.array(LIGHT_COLORS[True], dtype=np.uint8),
+                np.array(LIGHT_COLORS[False], dtype=np.uint8),
+            )
+            self._paint(lights["x"], lights["z"], colors)
+
+        if len(vehicles):
+            flags = vehicles["flags"]
+            colors = np.empty((len(vehicles), 3), dtype=np.uint8)
+            colors[:] = CAR_COLOR
+            colors[(flags & FLAG_BORRACHITO) != 0] = BORRACHITO_COLOR
+            colors[(flags & FLAG_CRASHED) != 0] = CRASHED_COLOR
+            self._paint(vehicles["x"], vehicles["z"], colors, self._inset)
+
+        return self.frame
+
+    def render(self, model):
+        """Draws the current state of a model (see render_records)."""
+        return self.render_records(vehicle_records(model), light_records(model))
+
+
+class FrameWriter:
+    """
+    Writes a sequence of frames to a directory.
+    """
+    def __init__(self, path, size, frame_format="ppm", png_level=1):
+        """
+        Creates the output directory.
+        Args:
+            path: Directory of the frames
+            size: (width, height) of the frames in pixels
+            frame_format: One of FRAME_FORMATS
+            png_level: zlib level of the png frames
+        """
+        if frame_format not in FRAME_FORMATS:
+            raise ValueError(f"Unknown frame format {frame_format!r}, use one of {FRAME_FORMATS}")
+
+        self.path = path
+        self.size = size
+        self.frame_format = frame_format
+        self.png_level = png_level
+        self.frames = 0
+        os.makedirs(path, exist_ok=True)
+
+        self._stream = None
+        if frame_format == "raw":
+            self._stream = open(os.path.join(path, "frames.rgb"), "wb")
+        self._ppm_header = b"P6\n%d %d\n255\n" % size
+
+    def write(self, frame, step):
+        """
+        Writes a frame.
+
+        Args:
+            frame: (height, width, 3) uint8 array
+            step: Step of the frame (names the ppm and png files)
+        """
+        if self.frame_format == "raw":
+            self._stream.write(frame.data)
+        else:
+            name = os.path.join(self.path, f"frame_{step:07d}.{self.frame_format}")
+            with open(name, "wb") as f:
+                if self.frame_format == "ppm":
+                    f.write(self._ppm_header)
+                    f.write(frame.data)
+                else:
+                    f.write(encode_png(frame, self.png_level))
+        self.frames += 1
+
+    def close(self):
+        """Closes the raw stream and writes frames.json (size and number of frames)."""
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        with open(os.path.join(self.path, "frames.json"), "w") as f:
+            json.dump({
+                "width": self.size[0], "height": self.size[1],
+                "frames": self.frames, "format": self.frame_format,
+            }, f)
+
+
+def render_recording(reader, output, cell_size=4, frame_format="ppm", first=None, last=None, every=1):
+    """
+    Draws the steps of a recording (see recorder.py) without simulating them.
+
+    Args:
+        reader: TrajectoryReader of the recording
+        output: Directory of the frames
+        cell_size: Pixels per cell side
+        frame_format: One of FRAME_FORMATS
+        first: First step (default: the first recorded)
+        last: Last step (default: the last recorded)
+        every: Steps between two frames
+
+    Returns:
+        int: Frames written
+    """
+    map_name = os.path.splitext(reader.meta["map_file"])[0]
+    city_map = load_map(map_name)
+    if city_map.digest != reader.map_digest:
+        raise ValueError(f"The map {map_name} changed since the recording was made")
+
+    renderer = FrameRenderer(city_map, cell_size)
+    writer = FrameWriter(output, renderer.size, frame_format)
+    try:
+        first = reader.first_step if first is None else first
+        last = reader.last_step if last is None else last
+        for step in range(first, last + 1, every):
+            writer.write(renderer.render_records(reader.vehicles(step), reader.lights(step)), step)
+    finally:
+        writer.close()
+    return writer.frames
+
+
+if __name__ == "__main__":
+    from .recorder import TrajectoryReader
+
+    parser = argparse.ArgumentParser(description="Draw the frames of a recorded run")
+    parser.add_argument("recording", help="Directory of the recording (agents_server.py --record, headless.py --record)")
+    parser.add_argument("output", help="Directory of the frames")
+    parser.add_argument("--cell-size", type=int, default=4, help="Pixels per cell side")
+    parser.add_argument("--format", default="ppm", choices=FRAME_FORMATS)
+    parser.add_argument("--first", type=int)
+    parser.add_argument("--last", type=int)
+    parser.add_argument("--every", type=int, default=1, help="Steps between two frames")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    frames = render_recording(
+        TrajectoryReader(args.recording), args.output, args.cell_size, args.format,
+        args.first, args.last, args.every,
+    )
+    elapsed = time.perf_counter() - start
+    print(f"{frames} frames in {elapsed:.2f}s ({frames / elapsed:.0f} frames/s)")
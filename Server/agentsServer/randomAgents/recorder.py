@@ -0,0 +1,262 @@
+import json
+import os
+
+import numpy as np
+
+from .packing import VEHICLE_DTYPE, LIGHT_DTYPE, vehicle_records, light_records
+from .static_layers import STATIC_LAYERS, build_layer
+
+# Trajectory recording format (a directory)
+#
+#   meta.json                 map, grid size, chunk size and the static traffic light table
+#   static_<layer>.json       serialized static layers (roads, obstacles, destinations)
+#   index.bin                 one INDEX_DTYPE row per recorded step (step = first_step + row),
+#                             with the location of its vehicles and the model counters
+#   vehicles_<chunk>.bin      VEHICLE_DTYPE rows of every step of the chunk, step after step
+#   lights_<chunk>.bin        one uint8 state per traffic light and step
+#
+# Chunks hold `chunk_steps` consecutive steps. All the .bin files are plain arrays, so the
+# reader memory-maps them and can seek to any step without reading the previous ones.
+RECORDING_VERSION = 1
+
+INDEX_DTYPE = np.dtype([
+    ("chunk", "<i4"),
+    ("count", "<i4"),
+    ("offset", "<i8"),
+    ("cars_spawned", "<i4"),
+    ("cars_arrived", "<i4"),
+])
+
+
+def chunk_file(path, kind, chunk):
+    return os.path.join(path, f"{kind}_{chunk:05d}.bin")
+
+
+class TrajectoryRecorder:
+    """
+    Appends the state of a model to a recording after every step.
+    """
+    def __init__(self, path, model, chunk_steps=4096, flush_steps=256):
+        """
+        Creates a new recording and stores the current state of the model as its first step.
+        Args:
+            path: Directory of the recording (created if needed, previous data is replaced)
+            model: CityModel to record
+            chunk_steps: Steps stored in each chunk file
+            flush_steps: Steps kept in memory before writing them to disk
+        """
+        self.path = path
+        self.chunk_steps = chunk_steps
+        self.flush_steps = flush_steps
+
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):
+            if name.endswith(".bin"):
+                os.remove(os.path.join(path, name))
+
+        lights = light_records(model)
+        self.n_lights = len(lights)
+        self.first_step = model.current_step
+        self.steps = 0
+
+        meta = {
+            "version": RECORDING_VERSION,
+            "map_file": os.path.basename(model.map_file),
+            "map_digest": model.map_digest,
+            "width": model.width,
+            "height": model.height,
+            "first_step": self.first_step,
+            "chunk_steps": chunk_steps,
+            "lights": {
+                "id": lights["id"].tolist(),
+                "x": lights["x"].tolist(),
+                "z": lights["z"].tolist(),
+            },
+        }
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        for layer in STATIC_LAYERS:
+            with open(os.path.join(path, f"static_{layer}.json"), "wb") as f:
+                f.write(build_layer(model, layer))
+
+        # Rows waiting to be written
+        self._vehicles = []
+        self._lights = []
+        self._index = []
+        self._offset = 0
+
+        self.record(model)
+
+    def record(self, model):
+        """
+        Appends the current state of the model.
+
+        Args:
+            model: CityModel that just stepped
+        """
+        chunk = self.steps // self.chunk_steps
+        if self.steps % self.chunk_steps == 0:
+            self._offset = 0
+
+        vehicles = vehicle_records(model)
+        states = light_records(model)["state"]
+
+        self._vehicles.append((chunk, vehicles))
+        self._lights.append((chunk, states))
+        self._index.append((chunk, len(vehicles), self._offset, model.cars_spawned, model.cars_arrived))
+        self._offset += len(vehicles)
+        self.steps += 1
+
+        if len(self._index) >= self.flush_steps:
+            self.flush()
+
+    def flush(self):
+        """Writes the pending steps to disk (data first, then the index)."""
+        if not self._index:
+            return
+
+        for kind, rows in (("vehicles", self._vehicles), ("lights", self._lights)):
+            chunk_rows = {}
+            for chunk, data in rows:
+                chunk_rows.setdefault(chunk, []).append(data)
+            for chunk, data in chunk_rows.items():
+                with open(chunk_file(self.path, kind, chunk), "ab") as f:
+                    for array in data:
+                        f.write(array.tobytes())
+
+        with open(os.path.join(self.path, "index.bin"), "ab") as f:
+            f.write(np.array(self._index, dtype=INDEX_DTYPE).tobytes())
+
+        self._vehicles.clear()
+        self._lights.clear()
+        self._index.clear()
+
+    def close(self):
+        self.flush()
+
+
+class TrajectoryReader:
+    """
+    Random access to the steps of a recording, through memory-mapped files.
+    """
+    def __init__(self, path):
+        """
+        Opens a recording.
+        Args:
+            path: Directory of the recording
+        """
+        self.path = path
+
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != RECORDING_VERSION:
+            raise ValueError("Unsupported recording version")
+
+        self.map_digest = self.meta["map_digest"]
+        self.first_step = self.meta["first_step"]
+
+        lights = self.meta["lights"]
+        self.light_table = np.zeros(len(lights["id"]), dtype=LIGHT_DTYPE)
+        self.light_table["id"] = lights["id"]
+        self.light_table["x"] = lights["x"]
+        self.light_table["z"] = lights["z"]
+
+        self._chunks = {}
+        self.refresh()
+
+    def refresh(self):
+        """Maps the index again, to see the steps written since the recording was opened."""
+        index_path = os.path.join(self.path, "index.bin")
+        size = os.path.getsize(index_path) if os.path.exists(index_path) else 0
+        rows = size // INDEX_DTYPE.itemsize
+        self.index = np.memmap(index_path, dtype=INDEX_DTYPE, mode="r", shape=(rows,)) if rows else np.zeros(0, INDEX_DTYPE)
+        self._chunks.clear()
+
+    @property
+    def steps(self):
+        return len(self.index)
+
+    @property
+    def last_step(self):
+        return self.first_step + self.steps - 1
+
+    def _chunk(self, kind, chunk, dtype):
+        key = (kind, chunk)
+        array = self._chunks.get(key)
+        if array is None:
+            array = np.memmap(chunk_file(self.path, kind, chunk), dtype=dtype, mode="r")
+            self._chunks[key] = array
+        return array
+
+    def _row(self, step):
+        row = step - self.first_step
+        if not 0 <= row < self.steps:
+            raise IndexError(f"Step {step} is not in the recording ({self.first_step}-{self.last_step})")
+        return self.index[row], row
+
+    def counters(self, step):
+        """
+        Model counters of a step.
+
+        Args:
+            step: Step to read
+
+        Returns:
+            tuple: (cars_spawned, cars_arrived)
+        """
+        entry, _ = self._row(step)
+        return int(entry["cars_spawned"]), int(entry["cars_arrived"])
+
+    def vehicles(self, step):
+        """
+        Vehicle records of a step.
+
+        Args:
+            step: Step to read
+
+        Returns:
+            np.ndarray: VEHICLE_DTYPE records (a view on the mapped file)
+        """
+        entry, _ = self._row(step)
+        if entry["count"] == 0:
+            return np.zeros(0, dtype=VEHICLE_DTYPE)
+
+        data = self._chunk("vehicles", int(entry["chunk"]), VEHICLE_DTYPE)
+        offset = int(entry["offset"])
+        return data[offset:offset + int(entry["count"])]
+
+    def lights(self, step):
+        """
+        Traffic light records of a step.
+
+        Args:
+            step: Step to read
+
+        Returns:
+            np.ndarray: LIGHT_DTYPE records
+        """
+        entry, row = self._row(step)
+        n_lights = len(self.light_table)
+        if n_lights == 0:
+            return self.light_table.copy()
+
+        data = self._chunk("lights", int(entry["chunk"]), np.uint8)
+        start = (row % self.meta["chunk_steps"]) * n_lights
+
+        lights = self.light_table.copy()
+        lights["state"] = data[start:start + n_lights]
+        return lights
+
+    def static_layer(self, layer):
+        """
+        Serialized static layer stored with the recording.
+
+        Args:
+            layer: Key of STATIC_LAYERS
+
+        Returns:
+            bytes: JSON document
+        """
+        with open(os.path.join(self.path, f"static_{layer}.json"), "rb") as f:
+            return f.read()
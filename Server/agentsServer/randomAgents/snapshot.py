@@ -0,0 +1,348 @@
+import io
+import itertools
+import pickle
+
+from mesa import Agent
+
+from .agent import Car, Borrachito, Traffic_Light
+from .city_map import available_maps, load_map
+from .gridlock import GRIDLOCK_POLICIES
+from .model import CityModel, RANDOM_STREAMS
+from .spawn_queue import ADMISSION_POLICIES
+from .trip_stats import TripStats
+
+# Snapshot format: SNAPSHOT_MAGIC followed by a pickle that only contains plain data
+# (dicts, lists, tuples, numbers, strings). It is loaded with a restricted unpickler
+# that refuses any class or function, so loading a snapshot cannot run code.
+#
+# Snapshots can be uploaded by clients, so the model parameters they carry are not
+# trusted either: only the ones in MODEL_PARAMS are used, within the limits below (see
+# validate_params). The metrics endpoint (report_url) is never stored in a snapshot, it
+# is given by whoever restores it.
+SNAPSHOT_MAGIC = b"TCSNAP6\n"
+
+MODEL_PARAMS = (
+    "N", "seed", "spawn_of_cars", "map_name", "spawn_points", "spawn_demand", "admission",
+    "max_backlog", "instrument", "gridlock_policy",
+)
+
+# Limits of the restored parameters
+MAX_AGENTS = 10000
+MAX_SPAWN_INTERVAL = 1000
+MAX_DEMAND = 100
+MAX_BACKLOG = 10000
+
+VEHICLE_CLASSES = {"Car": Car, "Borrachito": Borrachito}
+
+# Attributes of a vehicle that hold cells; they are stored as coordinates
+CELL_ATTRIBUTES = ("destination", "original_position", "target_lane")
+VALUE_ATTRIBUTES = (
+    "path_index", "stuck_counter", "crashed", "crash_timer", "lane_change_state",
+    "lane_change_progress", "speed", "max_speed", "steps_until_move", "spawn_step",
+    "origin", "free_flow_steps",
+)
+
+
+class _DataUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"Snapshots cannot contain objects ({module}.{name})")
+
+
+def _coordinate(cell):
+    return None if cell is None else cell.coordinate
+
+
+def _next_unique_id(model):
+    """Next unique_id mesa will give to an agent of the model (without consuming it)."""
+    next_id = next(Agent._ids[model])
+    Agent._ids[model] = itertools.count(next_id)
+    return next_id
+
+
+def snapshot_model(model):
+    """
+    Captures the state of a model: map reference, parameters, counters, traffic light
+    phases, vehicles (in scheduling order) and random number generator states.
+
+    Args:
+        model: CityModel to capture
+
+    Returns:
+        bytes: Snapshot
+    """
+    vehicles = []
+    # model.agents keeps the scheduling order, which shuffle_do depends on
+    for vehicle in model.agents:
+        if not isinstance(vehicle, Car):
+            continue
+        data = {
+            "type": type(vehicle).__name__,
+            "unique_id": vehicle.unique_id,
+            "cell": vehicle.cell.coordinate,
+            "path": None if vehicle.path is None else [cell.coordinate for cell in vehicle.path],
+        }
+        for name in CELL_ATTRIBUTES:
+            data[name] = _coordinate(getattr(vehicle, name, None))
+        for name in VALUE_ATTRIBUTES:
+            data[name] = getattr(vehicle, name)
+        if isinstance(vehicle, Borrachito):
+            data["crash_partner"] = None if vehicle.crash_partner is None else vehicle.crash_partner.unique_id
+        vehicles.append(data)
+
+    lights = [
+        (tl.unique_id, tl.state, tl.timeToChange)
+        for tl in model.agents_by_type.get(Traffic_Light, [])
+    ]
+
+    state = {
+        "map_file": model.map_file,
+        "map_digest": model.map_digest,
+        "params": {
+            "N": model.num_agents,
+            "seed": model._seed,
+            "spawn_of_cars": model.car_spawn_rate,
+            "map_name": model.map_name,
+            "spawn_points": model.spawn_points,
+            "spawn_demand": model.spawn_queue.demand,
+            "admission": model.spawn_queue.admission,
+            "max_backlog": model.spawn_queue.max_backlog,
+            "instrument": model.metrics is not None,
+            "gridlock_policy": model.gridlock.policy,
+        },
+        "borrachito_mode": model.borrachito_mode,
+        "current_step": model.current_step,
+        "cars_spawned": model.cars_spawned,
+        "cars_arrived": model.cars_arrived,
+        "crashes": model.crashes,
+        "total_trip_steps": model.total_trip_steps,
+        "spawn_queue": model.spawn_queue.get_state(),
+        "gridlock": model.gridlock.get_state(),
+        "trips": model.trip_stats.get_state(),
+        "heatmap": model.heatmap.get_state(),
+        "next_unique_id": _next_unique_id(model),
+        "lights": lights,
+        "vehicles": vehicles,
+        "random": model.random.getstate(),
+        "rng": model.rng.bit_generator.state,
+        "streams": {name: getattr(model, f"{name}_random").getstate() for name in RANDOM_STREAMS},
+    }
+
+    return SNAPSHOT_MAGIC + pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_snapshot(data):
+    """
+    Reads the state stored in a snapshot.
+
+    Args:
+        data: Bytes produced by snapshot_model
+
+    Returns:
+        dict: Snapshot state
+
+    Raises:
+        ValueError: If the data is not a snapshot, or it is truncated or corrupt
+    """
+    if not data.startswith(SNAPSHOT_MAGIC):
+        raise ValueError("Not a model snapshot")
+    try:
+        state = _DataUnpickler(io.BytesIO(data[len(SNAPSHOT_MAGIC):])).load()
+    except Exception as e:
+        raise ValueError(f"Corrupt snapshot ({e})") from e
+    if not isinstance(state, dict):
+        raise ValueError("Corrupt snapshot (no state)")
+    return state
+
+
+def _check_value(name, value):
+    """Values of VALUE_ATTRIBUTES are numbers, strings, None or an (x, y) pair (origin)."""
+    if value is None or type(value) in (bool, int, float, str):
+        return value
+    if isinstance(value, (list, tuple)) and len(value) == 2 and all(type(c) is int for c in value):
+        return tuple(value)
+    raise ValueError(f"Invalid {name} {value!r} in a vehicle of the snapshot")
+
+
+def _integer(params, name, low, high):
+    value = params[name]
+    if type(value) is not int or not low <= value <= high:
+        raise ValueError(f"{name} must be an integer between {low} and {high}")
+    return value
+
+
+def validate_params(params):
+    """
+    Checks the model parameters of a snapshot.
+
+    Args:
+        params: Parameters stored by snapshot_model
+
+    Returns:
+        dict: Keyword arguments of CityModel, only the ones in MODEL_PARAMS
+
+    Raises:
+        ValueError: If a parameter is missing or out of its limits
+    """
+    missing = [name for name in MODEL_PARAMS if name not in params]
+    if missing:
+        raise ValueError(f"The snapshot has no {', '.join(missing)}")
+
+    valid = {
+        "N": _integer(params, "N", 0, MAX_AGENTS),
+        "spawn_of_cars": _integer(params, "spawn_of_cars", 1, MAX_SPAWN_INTERVAL),
+        "max_backlog": _integer(params, "max_backlog", 0, MAX_BACKLOG),
+        "seed": params["seed"],
+        "instrument": bool(params["instrument"]),
+    }
+    if params["seed"] is not None and type(params["seed"]) is not int:
+        raise ValueError("seed must be an integer")
+
+    demand = params["spawn_demand"]
+    if demand is not None and (type(demand) not in (int, float) or not 0 <= demand <= MAX_DEMAND):
+        raise ValueError(f"spawn_demand must be a number between 0 and {MAX_DEMAND}")
+    valid["spawn_demand"] = demand
+
+    if params["admission"] not in ADMISSION_POLICIES:
+        raise ValueError(f"admission must be one of {', '.join(ADMISSION_POLICIES)}")
+    valid["admission"] = params["admission"]
+    if params["gridlock_policy"] not in GRIDLOCK_POLICIES:
+        raise ValueError(f"gridlock_policy must be one of {', '.join(GRIDLOCK_POLICIES)}")
+    valid["gridlock_policy"] = params["gridlock_policy"]
+
+    if params["map_name"] not in available_maps():
+        raise ValueError(f"Unknown map {params['map_name']!r}")
+    valid["map_name"] = params["map_name"]
+
+    spawn_points = params["spawn_points"]
+    if spawn_points is not None:
+        road_mask = load_map(valid["map_name"]).road_mask
+        width, height = road_mask.shape
+        points = []
+        for point in spawn_points:
+            if (
+                not isinstance(point, (list, tuple)) or len(point) != 2
+                or any(type(c) is not int for c in point)
+                or not (0 <= point[0] < width and 0 <= point[1] < height)
+                or not road_mask[point[0], point[1]]
+            ):
+                raise ValueError(f"Spawn point {point!r} is not a road cell of the map")
+            points.append(tuple(point))
+        if len(set(points)) != len(points):
+            raise ValueError("Repeated spawn points")
+        spawn_points = points
+    valid["spawn_points"] = spawn_points
+
+    return valid
+
+
+def restore_model(data, report_url=None):
+    """
+    Builds a new model from a snapshot.
+
+    Args:
+        data: Bytes produced by snapshot_model
+        report_url: Endpoint that receives the metrics of the restored model (None to disable)
+
+    Returns:
+        CityModel: Model in the same state as when the snapshot was taken
+
+    Raises:
+        ValueError: If the data is not a snapshot, or its parameters or records are not valid
+    """
+    state = load_snapshot(data)
+
+    try:
+        model = CityModel(report_url=report_url, **validate_params(state["params"]))
+        if model.map_digest != state["map_digest"]:
+            raise ValueError(f"The map {state['map_file']} changed since the snapshot was taken")
+        _restore_state(model, state)
+    except (KeyError, TypeError, IndexError, AttributeError) as e:
+        # Missing fields or records of the wrong shape
+        raise ValueError(f"Malformed snapshot ({e!r})") from e
+
+    return model
+
+
+def _restore_state(model, state):
+    """Applies the counters, lights, vehicles and random states of a snapshot to a new model."""
+    model.borrachito_mode = state["borrachito_mode"]
+    model.current_step = state["current_step"]
+    model.cars_spawned = state["cars_spawned"]
+    model.cars_arrived = state["cars_arrived"]
+    model.crashes = state["crashes"]
+    model.total_trip_steps = state["total_trip_steps"]
+    model.spawn_queue.set_state(state["spawn_queue"])
+    model.trip_stats = TripStats.from_state(state["trips"])
+    model.heatmap.set_state(state["heatmap"])
+
+    lights = list(model.agents_by_type.get(Traffic_Light, []))
+    if [tl.unique_id for tl in lights] != [data[0] for data in state["lights"]]:
+        raise ValueError("The traffic lights of the snapshot do not match the map")
+    for tl, (_, light_state, time_to_change) in zip(lights, state["lights"]):
+        tl.state = light_state
+        tl.timeToChange = time_to_change
+
+    grid = model.grid
+
+    def cell_at(coordinate):
+        if coordinate is None:
+            return None
+        if (
+            not isinstance(coordinate, (list, tuple)) or len(coordinate) != 2
+            or any(type(c) is not int for c in coordinate)
+            or not (0 <= coordinate[0] < model.width and 0 <= coordinate[1] < model.height)
+        ):
+            raise ValueError(f"Cell {coordinate!r} of the snapshot is outside the grid")
+        return grid[tuple(coordinate)]
+
+    restored = {}
+    for data in state["vehicles"]:
+        vehicle_class = VEHICLE_CLASSES.get(data["type"])
+        if vehicle_class is None:
+            raise ValueError(f"Unknown vehicle type {data['type']!r} in the snapshot")
+        cell = cell_at(data["cell"])
+        if cell is None:
+            raise ValueError("A vehicle of the snapshot has no cell")
+        vehicle = vehicle_class(model, cell)
+        vehicle.unique_id = data["unique_id"]
+        vehicle.path = None if data["path"] is None else [cell_at(c) for c in data["path"]]
+        for name in CELL_ATTRIBUTES:
+            setattr(vehicle, name, cell_at(data[name]))
+        for name in VALUE_ATTRIBUTES:
+            setattr(vehicle, name, _check_value(name, data[name]))
+        if vehicle.destination is None:
+            raise ValueError("A vehicle of the snapshot has no destination")
+        if vehicle.path is not None and not (type(vehicle.path_index) is int and 0 <= vehicle.path_index <= len(vehicle.path)):
+            raise ValueError("A vehicle of the snapshot is outside its path")
+        restored[vehicle.unique_id] = (vehicle, data)
+
+    for vehicle, data in restored.values():
+        if isinstance(vehicle, Borrachito) and data["crash_partner"] is not None:
+            partner = restored.get(data["crash_partner"])
+            vehicle.crash_partner = partner[0] if partner else None
+
+    model.gridlock.set_state(state["gridlock"], {unique_id: vehicle for unique_id, (vehicle, _) in restored.items()})
+
+    # Restored last, creating the vehicles above draws random numbers
+    Agent._ids[model] = itertools.count(state["next_unique_id"])
+    model.random.setstate(state["random"])
+    model.rng.bit_generator.state = state["rng"]
+    for name, stream_state in state["streams"].items():
+        if name not in RANDOM_STREAMS:
+            raise ValueError(f"Unknown random stream {name!r} in the snapshot")
+        getattr(model, f"{name}_random").setstate(stream_state)
+
+    model.vehicle_changes.reset(model.current_step, model.vehicles())
+
+
+def fork_model(model):
+    """
+    Creates an independent copy of a model in its current state (reporting to the same endpoint).
+
+    Args:
+        model: CityModel to copy
+
+    Returns:
+        CityModel: New model
+    """
+    return restore_model(snapshot_model(model), model.report_url)
@@ -0,0 +1,202 @@
+from collections import deque
+
+import numpy as np
+
+from .agent import Car, Borrachito
+
+# Admission policies
+#   "queue"  vehicles that cannot enter the network wait at their gate (up to max_backlog,
+#            arrivals beyond that are dropped)
+#   "drop"   vehicles that cannot enter the network in the step they arrive are dropped
+ADMISSION_POLICIES = ("queue", "drop")
+
+# Gate counters stored in snapshots
+GATE_COUNTERS = ("offered", "spawned", "dropped", "total_wait", "max_wait")
+
+
+class SpawnGate:
+    """
+    Spawn point with its queue of waiting vehicles and its counters.
+    """
+    def __init__(self, point, candidates):
+        """
+        Creates a new gate.
+        Args:
+            point: (x, y) of the spawn point
+            candidates: Spawn candidates of the point (see CityModel.build_spawn_candidates)
+        """
+        self.point = point
+        self.candidates = candidates
+        # Index of the candidate cells in the occupancy array, to check them all at once
+        self.cell_index = (
+            np.array([cell.coordinate[0] for cell, _, _ in candidates], dtype=np.intp),
+            np.array([cell.coordinate[1] for cell, _, _ in candidates], dtype=np.intp),
+        )
+        # Waiting vehicles: (arrival step, is borrachito)
+        self.backlog = deque()
+        self.offered = 0
+        self.spawned = 0
+        self.dropped = 0
+        self.total_wait = 0
+        self.max_wait = 0
+
+    def free_cell(self, occupancy):
+        """
+        Least congested free candidate cell (the first one on ties).
+
+        Args:
+            occupancy: Vehicles per cell (CityModel.occupancy)
+
+        Returns:
+            Cell: Cell to spawn on, or None when every candidate is taken
+        """
+        free = occupancy[self.cell_index] == 0
+        if not free.any():
+            return None
+
+        best = None
+        best_congestion = None
+        for i in np.flatnonzero(free).tolist():
+            cell, ahead, lights = self.candidates[i]
+            # Cars ahead, plus 2 for every red light
+            congestion = int(occupancy[ahead].sum()) + 2 * sum(1 for tl in lights if not tl.state)
+            if best is None or congestion < best_congestion:
+                best = cell
+                best_congestion = congestion
+        return best
+
+    def stats(self):
+        return {
+            "point": list(self.point),
+            "offered": self.offered,
+            "spawned": self.spawned,
+            "dropped": self.dropped,
+            "backlog": len(self.backlog),
+            "meanWait": self.total_wait / self.spawned if self.spawned else 0.0,
+            "maxWait": self.max_wait,
+        }
+
+
+class SpawnQueue:
+    """
+    Spawn demand and queues of every gate of a model.
+
+    Every step each gate receives `demand` new vehicles (a fraction accumulates until it
+    makes a whole vehicle). Without a demand, each gate receives one vehicle every
+    `car_spawn_rate` steps. A gate spawns its waiting vehicles in arrival order, each on
+    the least congested candidate cell still free, until the queue is empty or every
+    candidate cell is taken; the admission policy decides what happens to the vehicles
+    that could not enter.
+    """
+    def __init__(self, model, demand=None, admission="queue", max_backlog=50):
+        """
+        Creates the queues of the spawn points of a model.
+        Args:
+            model: CityModel with its spawn candidates already built
+            demand: Vehicles per step offered at each gate (None follows car_spawn_rate)
+            admission: Admission policy, one of ADMISSION_POLICIES
+            max_backlog: Vehicles that can wait at a gate with the "queue" policy
+        """
+        if admission not in ADMISSION_POLICIES:
+            raise ValueError(f"Unknown admission policy {admission!r}, use one of {ADMISSION_POLICIES}")
+
+        self.demand = demand
+        self.admission = admission
+        self.max_backlog = max_backlog
+        self.gates = [SpawnGate(point, model.spawn_candidates[point]) for point in model.spawn_points]
+        self._accumulated = 0.0
+
+    def arrivals(self, model):
+        """Vehicles that arrive at each gate in the current step."""
+        if self.demand is None:
+            return 0 if model.current_step % model.car_spawn_rate else 1
+
+        self._accumulated += self.demand
+        arrivals = int(self._accumulated)
+        self._accumulated -= arrivals
+        return arrivals
+
+    def step(self, model):
+        """
+        Adds the arrivals of the step to the queues and spawns the waiting vehicles.
+
+        Args:
+            model: CityModel that owns the queues
+        """
+        arrivals = self.arrivals(model)
+
+        borrachito_gate = None
+        if arrivals and model.borrachito_mode and model.spawn_random.random() < 0.25:
+            borrachito_gate = model.spawn_random.choice(self.gates)
+
+        for gate in self.gates:
+            for i in range(arrivals):
+                gate.offered += 1
+                if len(gate.backlog) >= self.max_backlog:
+                    gate.dropped += 1
+                else:
+                    gate.backlog.append((model.current_step, gate is borrachito_gate and i == 0))
+
+            # Spawning a vehicle marks its cell in model.occupancy, so the next one gets another cell
+            while gate.backlog:
+                cell = gate.free_cell(model.occupancy)
+                if cell is None:
+                    break
+                arrival_step, borrachito = gate.backlog.popleft()
+                vehicle = Borrachito(model, cell) if borrachito else Car(model, cell)
+                vehicle.origin = gate.point
+                model.cars_spawned += 1
+
+                wait = model.current_step - arrival_step
+                gate.spawned += 1
+                gate.total_wait += wait
+                gate.max_wait = max(gate.max_wait, wait)
+
+            if self.admission == "drop":
+                gate.dropped += len(gate.backlog)
+                gate.backlog.clear()
+
+    @property
+    def backlog(self):
+        """Vehicles waiting at every gate."""
+        return sum(len(gate.backlog) for gate in self.gates)
+
+    def stats(self):
+        """
+        Totals and per-gate counters of the spawn queues.
+
+        Returns:
+            dict: Offered, spawned and dropped vehicles, current backlog and waits (in steps)
+        """
+        gates = [gate.stats() for gate in self.gates]
+        spawned = sum(gate.spawned for gate in self.gates)
+        return {
+            "demand": self.demand,
+            "admission": self.admission,
+            "maxBacklog": self.max_backlog,
+            "offered": sum(gate.offered for gate in self.gates),
+            "spawned": spawned,
+            "dropped": sum(gate.dropped for gate in self.gates),
+            "backlog": self.backlog,
+            "meanWait": sum(gate.total_wait for gate in self.gates) / spawned if spawned else 0.0,
+            "maxWait": max((gate.max_wait for gate in self.gates), default=0),
+            "gates": gates,
+        }
+
+    def get_state(self):
+        """Plain-data state of the queues, stored in snapshots."""
+        return {
+            "accumulated": self._accumulated,
+            "gates": [
+                dict({name: getattr(gate, name) for name in GATE_COUNTERS}, backlog=list(gate.backlog))
+                for gate in self.gates
+            ],
+        }
+
+    def set_state(self, state):
+        """Restores a state returned by get_state."""
+        self._accumulated = state["accumulated"]
+        for gate, data in zip(self.gates, state["gates"]):
+            for name in GATE_COUNTERS:
+                setattr(gate, name, data[name])
+            gate.backlog = deque(tuple(item) for item in data["backlog"])
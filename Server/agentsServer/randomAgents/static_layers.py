@@ -0,0 +1,37 @@
+import json
+
+from .city_map import ROAD, LIGHT, OBSTACLE, DESTINATION
+
+# Static layers served by the API: cell kinds, y coordinate and extra fields per cell.
+# The layers are read from the compiled map (there are no agents for these cells); the ids
+# are prefixed with the layer so they never match a vehicle id.
+STATIC_LAYERS = {
+    "roads": ((ROAD, LIGHT), 0, lambda direction: {"direction": direction}),
+    "obstacles": ((OBSTACLE,), 0, None),
+    "destinations": ((DESTINATION,), 1, None),
+}
+
+
+def build_layer(model, layer):
+    """
+    Serializes the positions of a static layer, in the order of the map file.
+
+    Args:
+        model: CityModel to read the layer from
+        layer: Key of STATIC_LAYERS
+
+    Returns:
+        bytes: JSON document with the positions of the layer
+    """
+    kinds, y, extra = STATIC_LAYERS[layer]
+
+    positions = []
+    for x, z, kind, direction in model.city_map.cells():
+        if kind not in kinds:
+            continue
+        position = {"id": f"{layer}_{x}_{z}", "x": x, "y": y, "z": z}
+        if extra:
+            position.update(extra(direction))
+        positions.append(position)
+
+    return json.dumps({"positions": positions}, separators=(",", ":")).encode("utf-8")
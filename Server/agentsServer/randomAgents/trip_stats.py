@@ -0,0 +1,276 @@
+import math
+
+# Trip statistics: every vehicle that arrives adds its trip to an origin-destination (OD)
+# matrix, where each pair keeps the number of trips and quantile sketches of the travel
+# time and the delay, both in steps. Nothing is stored per trip, so the memory only grows
+# with the number of pairs (spawn gates x destinations), not with the number of trips.
+#
+#   travel time  steps from spawn to arrival
+#   delay        travel time minus the free-flow time, the length of the shortest route
+#                from the spawn cell to the destination on the empty road graph (see
+#                city_map.distance_to_destination). Diagonal lane changes can beat that
+#                route, so delays are clamped at 0.
+
+# Quantiles reported by default
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99)
+
+# Relative error of the quantiles of the sketches
+DEFAULT_ACCURACY = 0.01
+
+
+class QuantileSketch:
+    """
+    Streaming quantile sketch with relative error (logarithmic buckets, as in DDSketch).
+
+    A value x > 0 falls in bucket ceil(log(x) / log(gamma)), with gamma = (1 + a) / (1 - a),
+    so every quantile is within a relative error a of the exact one. Adding a value is O(1),
+    and two sketches with the same accuracy merge by adding their buckets, which is how
+    the sketches of several runs are combined.
+    """
+    def __init__(self, accuracy=DEFAULT_ACCURACY):
+        """
+        Creates an empty sketch.
+        Args:
+            accuracy: Relative error of the quantiles (between 0 and 1)
+        """
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self.gamma)
+        # Bucket index -> values
+        self.buckets = {}
+        # Values <= 0
+        self.zeros = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        if value > 0:
+            key = math.ceil(math.log(value) / self._log_gamma)
+            self.buckets[key] = self.buckets.get(key, 0) + 1
+        else:
+            self.zeros += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        """Adds the values of another sketch with the same accuracy."""
+        if other.accuracy != self.accuracy:
+            raise ValueError("Only sketches with the same accuracy can be merged")
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """
+        Estimated q-quantile of the values added.
+
+        Args:
+            q: Quantile, between 0 and 1
+
+        Returns:
+            float: Value, or None if the sketch is empty
+        """
+        if not self.count:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return max(self.min, 0.0)
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if rank < seen:
+                # Middle of the bucket (gamma^(key-1), gamma^key], in relative terms
+                value = 2 * self.gamma ** key / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def summary(self, quantiles=DEFAULT_QUANTILES):
+        """Count, mean, min, max and quantiles (as p50, p90, ...), rounded to 2 decimals."""
+        def rounded(value):
+            return None if value is None else round(value, 2)
+
+        result = {
+            "count": self.count,
+            "mean": rounded(self.mean),
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+        }
+        for q in quantiles:
+            result[f"p{q * 100:g}"] = rounded(self.quantile(q))
+        return result
+
+    def get_state(self):
+        return {
+            "accuracy": self.accuracy,
+            "buckets": [[key, count] for key, count in self.buckets.items()],
+            "zeros": self.zeros,
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        """Sketch from the plain data of get_state (snapshots, results files)."""
+        sketch = cls(state["accuracy"])
+        sketch.buckets = {key: count for key, count in state["buckets"]}
+        sketch.zeros = state["zeros"]
+        sketch.count = state["count"]
+        sketch.sum = state["sum"]
+        if sketch.count:
+            sketch.min = state["min"]
+            sketch.max = state["max"]
+        return sketch
+
+
+class ODPair:
+    """
+    Trips between a spawn gate and a destination.
+    """
+    def __init__(self, accuracy=DEFAULT_ACCURACY):
+        self.trips = 0
+        self.travel = QuantileSketch(accuracy)
+        self.delay = QuantileSketch(accuracy)
+
+    def add(self, travel, delay):
+        self.trips += 1
+        self.travel.add(travel)
+        if delay is not None:
+            self.delay.add(delay)
+
+    def merge(self, other):
+        self.trips += other.trips
+        self.travel.merge(other.travel)
+        self.delay.merge(other.delay)
+
+
+class TripStats:
+    """
+    Origin-destination matrix of the finished trips of a model.
+    Origins are spawn gates and destinations are Destination cells, both as (x, y).
+    """
+    def __init__(self, accuracy=DEFAULT_ACCURACY):
+        """
+        Creates an empty matrix.
+        Args:
+            accuracy: Relative error of the quantile sketches
+        """
+        self.accuracy = accuracy
+        # (origin, destination) -> ODPair; origin is None for vehicles that did not
+        # enter through a spawn gate
+        self.pairs = {}
+        self.total = ODPair(accuracy)
+
+    def record(self, vehicle, step):
+        """
+        Adds the trip of a vehicle that arrived.
+
+        Args:
+            vehicle: Car or Borrachito, with its origin, spawn_step and free_flow_steps
+            step: Step of the arrival
+        """
+        travel = step - vehicle.spawn_step
+        delay = None if vehicle.free_flow_steps is None else max(travel - vehicle.free_flow_steps, 0)
+
+        key = (vehicle.origin, vehicle.destination.coordinate)
+        pair = self.pairs.get(key)
+        if pair is None:
+            pair = self.pairs[key] = ODPair(self.accuracy)
+        pair.add(travel, delay)
+        self.total.add(travel, delay)
+
+    def merge(self, other):
+        """Adds the trips of another matrix (e.g. another run of an ensemble)."""
+        for key, other_pair in other.pairs.items():
+            pair = self.pairs.get(key)
+            if pair is None:
+                pair = self.pairs[key] = ODPair(self.accuracy)
+            pair.merge(other_pair)
+        self.total.merge(other.total)
+
+    def matrix(self):
+        """
+        Trip counts as a dense matrix.
+
+        Returns:
+            dict: Origins, destinations and trips[origin][destination]
+        """
+        origins = sorted({origin for origin, _ in self.pairs}, key=lambda o: (o is None, o))
+        destinations = sorted({destination for _, destination in self.pairs})
+        trips = [[0] * len(destinations) for _ in origins]
+        row = {origin: i for i, origin in enumerate(origins)}
+        column = {destination: j for j, destination in enumerate(destinations)}
+        for (origin, destination), pair in self.pairs.items():
+            trips[row[origin]][column[destination]] = pair.trips
+        return {
+            "origins": [None if origin is None else list(origin) for origin in origins],
+            "destinations": [list(destination) for destination in destinations],
+            "trips": trips,
+        }
+
+    def stats(self, quantiles=DEFAULT_QUANTILES):
+        """
+        Totals, OD matrix and the travel time and delay of every pair.
+
+        Args:
+            quantiles: Quantiles of the travel time and delay
+
+        Returns:
+            dict: Summary of the trips (times in steps)
+        """
+        pairs = sorted(self.pairs.items(), key=lambda item: -item[1].trips)
+        return {
+            "trips": self.total.trips,
+            "accuracy": self.accuracy,
+            "travel": self.total.travel.summary(quantiles),
+            "delay": self.total.delay.summary(quantiles),
+            "matrix": self.matrix(),
+            "pairs": [
+                {
+                    "origin": None if origin is None else list(origin),
+                    "destination": list(destination),
+                    "trips": pair.trips,
+                    "travel": pair.travel.summary(quantiles),
+                    "delay": pair.delay.summary(quantiles),
+                }
+                for (origin, destination), pair in pairs
+            ],
+        }
+
+    def get_state(self):
+        """Plain data of the matrix, for snapshots and results files."""
+        return {
+            "accuracy": self.accuracy,
+            "pairs": [
+                [origin, destination, pair.trips, pair.travel.get_state(), pair.delay.get_state()]
+                for (origin, destination), pair in self.pairs.items()
+            ],
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        """Matrix from the plain data of get_state."""
+        trip_stats = cls(state["accuracy"])
+        for origin, destination, trips, travel, delay in state["pairs"]:
+            pair = ODPair(trip_stats.accuracy)
+            pair.trips = trips
+            pair.travel = QuantileSketch.from_state(travel)
+            pair.delay = QuantileSketch.from_state(delay)
+            key = (None if origin is None else tuple(origin), tuple(destination))
+            trip_stats.pairs[key] = pair
+            trip_stats.total.merge(pair)
+        return trip_stats
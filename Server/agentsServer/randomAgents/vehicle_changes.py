@@ -0,0 +1,101 @@
+from collections import deque
+
+
+class VehicleChangeLog:
+    """
+    Bounded ring buffer with the vehicles that changed on each step.
+
+    After every step the model calls record() with its current vehicles. The log
+    compares them with the previous recorded step and stores which ids moved, spawned
+    or changed crash state, and which ids arrived (were removed). Clients can then ask
+    only for what changed since the last step they saw.
+    """
+    def __init__(self, capacity=256):
+        """
+        Creates a new change log.
+        Args:
+            capacity: Number of steps kept; older clients get a full snapshot
+        """
+        self.capacity = capacity
+        self.entries = deque(maxlen=capacity)
+        self.last_state = {}
+        self.last_step = 0
+
+    @staticmethod
+    def vehicle_state(vehicle):
+        """
+        Part of the vehicle state that the clients render.
+
+        Args:
+            vehicle: Car or Borrachito agent
+
+        Returns:
+            tuple: (coordinate, crashed, crash_timer, type name)
+        """
+        return (vehicle.cell.coordinate, vehicle.crashed, vehicle.crash_timer, type(vehicle).__name__)
+
+    def reset(self, step, vehicles):
+        """
+        Starts the log again from the given state, without any entries.
+
+        Args:
+            step: Current step
+            vehicles: Iterable with the vehicles alive at that step
+        """
+        self.entries.clear()
+        self.last_state = {v.unique_id: self.vehicle_state(v) for v in vehicles}
+        self.last_step = step
+
+    def record(self, step, vehicles):
+        """
+        Stores the changes since the previous recorded step.
+        Steps that are not recorded (e.g. in the middle of a batch) are merged into the next entry.
+
+        Args:
+            step: Step that just finished
+            vehicles: Iterable with the vehicles alive after the step
+        """
+        state = {}
+        changed = set()
+        last_state = self.last_state
+
+        for vehicle in vehicles:
+            vehicle_state = self.vehicle_state(vehicle)
+            state[vehicle.unique_id] = vehicle_state
+            if last_state.get(vehicle.unique_id) != vehicle_state:
+                changed.add(vehicle.unique_id)
+
+        removed = last_state.keys() - state.keys()
+
+        self.entries.append((self.last_step, step, changed, removed))
+        self.last_state = state
+        self.last_step = step
+
+    def changes_since(self, since):
+        """
+        Collects the changes of every entry after `since`.
+
+        Args:
+            since: Last step the client has
+
+        Returns:
+            tuple: (changed ids, removed ids), or None if the step is no longer
+            in the buffer (or was never recorded) and a full snapshot is needed
+        """
+        if since == self.last_step:
+            return set(), set()
+
+        # The client state must match the start of one of the entries
+        start = next((i for i, entry in enumerate(self.entries) if entry[0] == since), None)
+        if start is None:
+            return None
+
+        changed = set()
+        removed = set()
+        for i in range(start, len(self.entries)):
+            changed |= self.entries[i][2]
+            removed |= self.entries[i][3]
+
+        # A vehicle that arrived and an id that is alive are mutually exclusive
+        alive = self.last_state.keys()
+        return changed & alive, removed - alive
@@ -0,0 +1,106 @@
+# TC2008B. Sistemas Multiagentes y Gráficas Computacionales
+# Cached payloads for the static layers of the city (roads, obstacles, destinations).
+
+import gzip
+import hashlib
+import threading
+
+from flask import Response
+from randomAgents.static_layers import build_layer
+
+# Responses smaller than this are not worth compressing
+GZIP_MIN_SIZE = 1024
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+class StaticPayload:
+    """
+    Serialized body of a static layer, with its ETag and a lazily compressed copy.
+    """
+    def __init__(self, body):
+        """
+        Creates a new payload.
+        Args:
+            body: JSON document already encoded as bytes
+        """
+        self.body = body
+        self.etag = hashlib.sha1(body).hexdigest()
+        self._gzip_body = None
+
+    @property
+    def gzip_body(self):
+        """Gzip-compressed body, computed the first time it is requested."""
+        if self._gzip_body is None:
+            self._gzip_body = gzip.compress(self.body, compresslevel=6, mtime=0)
+        return self._gzip_body
+
+
+def cached_payload(key, build):
+    """
+    Returns the payload stored under `key`, building it the first time.
+
+    Args:
+        key: Cache key
+        build: Function that returns the body (bytes) of the payload
+
+    Returns:
+        StaticPayload: Cached payload
+    """
+    payload = _cache.get(key)
+    if payload is None:
+        with _cache_lock:
+            payload = _cache.get(key)
+            if payload is None:
+                payload = StaticPayload(build())
+                _cache[key] = payload
+
+    return payload
+
+
+def get_payload(model, layer):
+    """
+    Returns the cached payload of a static layer, building it once per map file.
+
+    Args:
+        model: CityModel to read the layer from
+        layer: Key of randomAgents.static_layers.STATIC_LAYERS
+
+    Returns:
+        StaticPayload: Cached payload
+    """
+    return cached_payload((model.map_digest, layer), lambda: build_layer(model, layer))
+
+
+def make_response(payload, request):
+    """
+    Builds the HTTP response for a payload.
+    Answers 304 when the client already has the current version (If-None-Match),
+    and compresses the body when the client accepts gzip.
+
+    Args:
+        payload: StaticPayload to send
+        request: Current flask request
+
+    Returns:
+        Response: Flask response
+    """
+    use_gzip = (
+        len(payload.body) >= GZIP_MIN_SIZE
+        and "gzip" in request.headers.get("Accept-Encoding", "")
+        and request.args.get("gzip", "1") != "0"
+    )
+
+    if use_gzip:
+        response = Response(payload.gzip_body, mimetype="application/json")
+        response.headers["Content-Encoding"] = "gzip"
+        response.set_etag(payload.etag + "-gz")
+    else:
+        response = Response(payload.body, mimetype="application/json")
+        response.set_etag(payload.etag)
+
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = "no-cache"
+
+    return response.make_conditional(request)
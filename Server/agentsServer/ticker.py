@@ -0,0 +1,230 @@
+# TC2008B. Sistemas Multiagentes y Gráficas Computacionales
+# Background ticker that advances the model and pushes each tick to streaming clients.
+
+import json
+import threading
+import time
+
+from randomAgents.agent import Traffic_Light
+
+
+def vehicle_json(unique_id, state):
+    """
+    Serializes a vehicle from its change log state, with the same fields as /getAgents.
+
+    Args:
+        unique_id: Id of the vehicle
+        state: Tuple from VehicleChangeLog.vehicle_state
+
+    Returns:
+        dict: Vehicle position for WebGL
+    """
+    (x, z), crashed, crash_timer, type_name = state
+    return {
+        "id": str(unique_id),
+        "x": x,
+        "y": 1,
+        "z": z,
+        "type": type_name,
+        "crashed": crashed,
+        "crash_timer": crash_timer,
+    }
+
+
+class Tick:
+    """
+    State of the model after one step, shared by every subscriber.
+
+    The vehicle state is captured when the tick is created, and the delta and full
+    messages are serialized at most once, the first time a subscriber needs them,
+    so the cost of a tick does not grow with the number of clients.
+    """
+    def __init__(self, model):
+        """
+        Captures the state of the model.
+        Args:
+            model: CityModel that just stepped
+        """
+        log = model.vehicle_changes
+        self.step = model.current_step
+        self.counters = {
+            "currentStep": model.current_step,
+            "carsSpawned": model.cars_spawned,
+            "carsArrived": model.cars_arrived,
+        }
+        self.lights = [
+            {"id": str(tl.unique_id), "state": "green" if tl.state else "red"}
+            for tl in model.agents_by_type.get(Traffic_Light, [])
+        ]
+
+        # The change log creates a new dict each step, so keeping a reference is safe
+        self.vehicles = log.last_state
+        self.previous_step = None
+        self.changed, self.removed = None, None
+        if log.entries and log.entries[-1][1] == self.step:
+            self.previous_step, _, self.changed, self.removed = log.entries[-1]
+
+        self._messages = {}
+        self._lock = threading.Lock()
+
+    def message(self, full):
+        """
+        Returns the SSE data of the tick.
+
+        Args:
+            full: Send every vehicle instead of the ones that changed in this step
+
+        Returns:
+            str: JSON document
+        """
+        full = full or self.changed is None
+
+        with self._lock:
+            if full not in self._messages:
+                ids = self.vehicles.keys() if full else self.changed
+                message = dict(self.counters)
+                message["step"] = self.step
+                message["full"] = full
+                message["positions"] = [vehicle_json(i, self.vehicles[i]) for i in ids]
+                message["removed"] = [] if full else [str(i) for i in self.removed]
+                message["lights"] = self.lights
+                self._messages[full] = json.dumps(message, separators=(",", ":"))
+
+            return self._messages[full]
+
+
+class Subscription:
+    """
+    Mailbox of a streaming client. Only the latest tick is kept: a slow client skips
+    the intermediate ticks (and then receives a full snapshot) instead of queueing them.
+    """
+    def __init__(self):
+        self.latest = None
+        self.last_step = None
+        self.dropped = 0
+        self._ready = threading.Condition()
+
+    def offer(self, tick):
+        """Replaces the pending tick with a newer one."""
+        with self._ready:
+            if self.latest is not None:
+                self.dropped += 1
+            self.latest = tick
+            self._ready.notify()
+
+    def next(self, timeout):
+        """
+        Waits for the next tick.
+
+        Args:
+            timeout: Seconds to wait
+
+        Returns:
+            str: SSE data of the tick, or None if nothing arrived in time
+        """
+        with self._ready:
+            if self.latest is None:
+                self._ready.wait(timeout)
+            tick, self.latest = self.latest, None
+
+        if tick is None:
+            return None
+
+        # A delta is only valid if the client has the step the tick was compared with
+        full = self.last_step is None or tick.previous_step != self.last_step
+        self.last_step = tick.step
+        return tick.message(full)
+
+
+class Broadcaster:
+    """
+    Set of subscriptions that receive every published tick.
+    """
+    def __init__(self):
+        self.subscriptions = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        subscription = Subscription()
+        with self._lock:
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self.subscriptions.discard(subscription)
+
+    def reset(self):
+        """Forgets the last step of every client, so they get a full snapshot next (new model)."""
+        with self._lock:
+            for subscription in self.subscriptions:
+                subscription.last_step = None
+
+    def has_subscribers(self):
+        return bool(self.subscriptions)
+
+    def publish(self, tick):
+        with self._lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            subscription.offer(tick)
+
+
+class Ticker:
+    """
+    Thread that steps the model at a fixed interval and publishes every tick.
+    It runs on its own, no matter how many clients are subscribed.
+    """
+    def __init__(self, get_model, lock, broadcaster, interval=0.1):
+        """
+        Creates a new ticker (stopped).
+        Args:
+            get_model: Function that returns the current model (it may be replaced by /init)
+            lock: Lock that guards the model
+            broadcaster: Broadcaster that receives the ticks
+            interval: Seconds between steps
+        """
+        self.get_model = get_model
+        self.lock = lock
+        self.broadcaster = broadcaster
+        self.interval = interval
+        self._running = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._running.is_set()
+
+    def start(self, interval=None):
+        if interval is not None:
+            self.interval = interval
+        if self.running:
+            return
+        self._running.set()
+        self._thread = threading.Thread(target=self._run, name="ticker", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running.clear()
+
+    def _run(self):
+        next_time = time.perf_counter()
+        while self._running.is_set():
+            with self.lock:
+                model = self.get_model()
+                tick = None
+                if model is not None:
+                    try:
+                        model.step()
+                        # Nobody to send it to: skip capturing the tick
+                        if self.broadcaster.has_subscribers():
+                            tick = Tick(model)
+                    except Exception as e:
+                        print("[TICKER] Error during step:", e)
+
+            if tick is not None:
+                self.broadcaster.publish(tick)
+
+            # Fixed rate; if a step took longer than the interval, start the next one right away
+            next_time = max(next_time + self.interval, time.perf_counter())
+            time.sleep(max(0.0, next_time - time.perf_counter()))
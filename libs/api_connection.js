@@ -20,9 +20,16 @@ const roads = [];
 const tlights= [];
 const destinations = [];
 let currentStep = 0;
+// Last step received from getAgents, used to ask only for the vehicles that changed
+let agentsStep = null;
 let carsSpawned = 0;
 let carsArrived = 0;
 
+// Use the packed binary state (getStateBinary) instead of the JSON getters on every update.
+// Opt-in with ?binary in the page URL: it sends every vehicle on each update, while
+// getAgents?since= only sends the vehicles that changed, which is smaller for most frames.
+const useBinaryState = new URLSearchParams(window.location.search).has("binary");
+
 // Define the data object
 const initData = {
     NAgents: 20,
@@ -49,6 +56,7 @@ async function initAgentsModel() {
         if (response.ok) {
             // Parse the response as JSON and log the message
             let result = await response.json();
+            agentsStep = null;
             console.log(result.message);
         }
 
@@ -63,13 +71,12 @@ async function initAgentsModel() {
  */
 async function getAgents() {
     try {
-        let response = await fetch(agent_server_uri + "getAgents");
+        const query = agentsStep === null ? "" : `?since=${agentsStep}`;
+        let response = await fetch(agent_server_uri + "getAgents" + query);
 
         if (response.ok) {
             let result = await response.json();
 
-            const serverAgentIds = new Set(result.positions.map(agent => agent.id));
-
             // Update existing agents and add new ones
             for (const agent of result.positions) {
                 const current_agent = agents.find((object3d) => object3d.id == agent.id);
@@ -91,11 +98,20 @@ async function getAgents() {
             }
 
             // Eliminar agentes que ya no están en el servidor (llegaron a su destino)
+            // In a full snapshot every missing agent is gone, otherwise the server lists them
+            const serverAgentIds = new Set(result.positions.map(agent => agent.id));
+            const removedIds = new Set(result.removed || []);
             for (let i = agents.length - 1; i >= 0; i--) {
-                if (!serverAgentIds.has(agents[i].id)) {
+                const gone = result.full ? !serverAgentIds.has(agents[i].id) : removedIds.has(agents[i].id);
+                if (gone) {
                     agents.splice(i, 1);
+                } else if (!result.full && !serverAgentIds.has(agents[i].id)) {
+                    // Unchanged agents stay in place
+                    agents[i].oldPosArray = agents[i].posArray;
                 }
             }
+
+            agentsStep = result.step;
         }
 
     } catch (error) {
@@ -214,6 +230,140 @@ async function getTlights() {
     }
 }
 
+/*
+ * Retrieves vehicles and traffic lights in the packed binary format of the server.
+ * Header: magic "TCSB", u16 version, u16 record size, u32 step, u32 vehicles, u32 lights.
+ * Each record is 12 bytes: i32 id, i16 x, i16 z, u8 flags/state, u8 crash timer.
+ */
+async function getStateBinary() {
+    try {
+        let response = await fetch(agent_server_uri + "getStateBinary");
+
+        if (response.ok) {
+            const buffer = await response.arrayBuffer();
+            const header = new DataView(buffer, 0, 20);
+            const recordSize = header.getUint16(6, true);
+            const nVehicles = header.getUint32(12, true);
+            const nLights = header.getUint32(16, true);
+
+            // Typed views over the records (the client is little-endian, like the server format)
+            const ints = new Int32Array(buffer, 20);
+            const shorts = new Int16Array(buffer, 20);
+            const bytes = new Uint8Array(buffer, 20);
+            const intStride = recordSize / 4;
+            const shortStride = recordSize / 2;
+
+            const agentsById = new Map(agents.map(agent => [agent.id, agent]));
+            const serverAgentIds = new Set();
+
+            for (let i = 0; i < nVehicles; i++) {
+                const id = String(ints[i * intStride]);
+                const x = shorts[i * shortStride + 2];
+                const z = shorts[i * shortStride + 3];
+                const flags = bytes[i * recordSize + 8];
+                serverAgentIds.add(id);
+
+                let current_agent = agentsById.get(id);
+                if (current_agent == undefined) {
+                    current_agent = new Object3D(id, [x, 1, z]);
+                    agents.push(current_agent);
+                }
+                current_agent.oldPosArray = current_agent.posArray;
+                current_agent.position = {x: x, y: 1, z: z};
+                current_agent.type = (flags & 1) ? "Borrachito" : "Car";
+                current_agent.crashed = (flags & 2) != 0;
+                current_agent.crash_timer = bytes[i * recordSize + 9];
+            }
+
+            // Eliminar agentes que ya no están en el servidor (llegaron a su destino)
+            for (let i = agents.length - 1; i >= 0; i--) {
+                if (!serverAgentIds.has(agents[i].id)) {
+                    agents.splice(i, 1);
+                }
+            }
+
+            const lightsById = new Map(tlights.map(tl => [tl.id, tl]));
+            for (let i = nVehicles; i < nVehicles + nLights; i++) {
+                const id = String(ints[i * intStride]);
+                const x = shorts[i * shortStride + 2];
+                const z = shorts[i * shortStride + 3];
+
+                let light = lightsById.get(id);
+                if (light == undefined) {
+                    light = new Object3D(id, [x, 1, z]);
+                    tlights.push(light);
+                }
+                light.state = bytes[i * recordSize + 8] ? "green" : "red";
+            }
+
+            agentsStep = null;
+        }
+
+    } catch (error) {
+        console.log(error);
+    }
+}
+
+/*
+ * Subscribes to the /stream endpoint (Server-Sent Events) instead of polling update().
+ * The server pushes every tick of its ticker; each event has the counters, the vehicles
+ * that changed (or all of them when "full" is true), the arrived ids and the lights.
+ * Returns the EventSource so the caller can close it.
+ */
+function startStream(interval = 0.1) {
+    fetch(agent_server_uri + "ticker", {
+        method: 'POST',
+        headers: { 'Content-Type':'application/json' },
+        body: JSON.stringify({ running: true, interval: interval })
+    }).catch(error => console.log(error));
+
+    const source = new EventSource(agent_server_uri + "stream");
+
+    source.addEventListener("tick", (event) => {
+        const result = JSON.parse(event.data);
+        currentStep = result.currentStep;
+        carsSpawned = result.carsSpawned;
+        carsArrived = result.carsArrived;
+
+        const agentsById = new Map(agents.map(agent => [agent.id, agent]));
+        const serverAgentIds = new Set();
+
+        for (const agent of result.positions) {
+            serverAgentIds.add(agent.id);
+            let current_agent = agentsById.get(agent.id);
+            if (current_agent == undefined) {
+                current_agent = new Object3D(agent.id, [agent.x, agent.y, agent.z]);
+                agents.push(current_agent);
+            }
+            current_agent.oldPosArray = current_agent.posArray;
+            current_agent.position = {x: agent.x, y: agent.y, z: agent.z};
+            current_agent.type = agent.type;
+            current_agent.crashed = agent.crashed;
+            current_agent.crash_timer = agent.crash_timer;
+        }
+
+        const removedIds = new Set(result.removed);
+        for (let i = agents.length - 1; i >= 0; i--) {
+            const gone = result.full ? !serverAgentIds.has(agents[i].id) : removedIds.has(agents[i].id);
+            if (gone) {
+                agents.splice(i, 1);
+            }
+        }
+
+        const lightsById = new Map(tlights.map(tl => [tl.id, tl]));
+        for (const tl of result.lights) {
+            const light = lightsById.get(tl.id);
+            if (light) {
+                light.state = tl.state;
+                light.color = tl.state === "green" ? [0,1,0,1] : [1,0,0,1];
+            }
+        }
+    });
+
+    source.onerror = (error) => console.log(error);
+    return source;
+}
+
 /*
  * Updates the agent positions by sending a request to the agent server.
  */
@@ -230,8 +380,12 @@ async function update() {
             carsArrived = result.carsArrived || 0;
 
             // Retrieve the updated agent positions
-            await getAgents();
-            await getTlights();
+            if (useBinaryState) {
+                await getStateBinary();
+            } else {
+                await getAgents();
+                await getTlights();
+            }
             for (const tl of tlights){
                 if (tl.state === "red")
                     tl.color = [1,0,0,1];
@@ -250,4 +404,4 @@ async function update() {
     }
 }
 
-export { agents, obstacles, roads, destinations, initAgentsModel, update, getAgents, getObstacles, getRoads, tlights, getTlights, getDestinations, currentStep, carsSpawned, carsArrived };
+export { agents, obstacles, roads, destinations, initAgentsModel, update, getAgents, getObstacles, getRoads, tlights, getTlights, getDestinations, getStateBinary, startStream, currentStep, carsSpawned, carsArrived };